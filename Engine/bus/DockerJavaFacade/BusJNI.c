@@ -7,6 +7,8 @@
 #include "com_urv_zion_bus_BusJNI.h"
 #include "bus.h"
 
+/* First byte of binary (version 2) files metadata. JSON starts with '{' */
+#define BUS_DATAGRAM_V2	2
 
 static int 	g_JavaAccessorsInitialized = 0;
 
@@ -15,6 +17,7 @@ static jclass 		g_ClassRawMessage 		= NULL;
 static jmethodID 	g_RawMessageCTOR 		= NULL;
 static jfieldID 	g_FieldFDs 				= NULL;
 static jfieldID 	g_FieldMetadata 		= NULL;
+static jfieldID 	g_FieldBinMetadata 		= NULL;
 static jfieldID 	g_FieldParams 			= NULL;
 
 static jclass 		g_ClassFileDescriptor 	= NULL;
@@ -64,6 +67,12 @@ int init_java_accessors( JNIEnv* env )
     if( NULL == g_FieldMetadata )
         return -1;
 
+    g_FieldBinMetadata =
+    		(*env)->GetFieldID( env, g_ClassRawMessage,
+    							"binMetadata_", "[B");
+    if( NULL == g_FieldBinMetadata )
+        return -1;
+
     /*------------------------------------------------------------------------
      * Reflecting java.io.FileDescriptor
      * */
@@ -296,11 +305,30 @@ Java_com_urv_zion_bus_BusJNI_receiveRawMessage( 	JNIEnv* env,
 			// Assign obtained object
 			(*env)->SetObjectField(env,RawMsgObj, g_FieldFDs, jFileDscrArr );
 
-			jstring jstrMetadata = (*env)->NewStringUTF(env, strMetadata );
-			(*env)->SetObjectField( env,
-					                RawMsgObj,
-					                g_FieldMetadata,
-					                jstrMetadata );
+			if( 0 < nMetadataLen &&
+				BUS_DATAGRAM_V2 == (unsigned char) strMetadata[0] )
+			{
+				// Binary metadata may hold any byte, pass it as is
+				jbyteArray jbinMetadata =
+						(*env)->NewByteArray( env, nMetadataLen );
+				(*env)->SetByteArrayRegion( env,
+						                    jbinMetadata,
+						                    0,
+						                    nMetadataLen,
+						                    (jbyte*) strMetadata );
+				(*env)->SetObjectField( env,
+						                RawMsgObj,
+						                g_FieldBinMetadata,
+						                jbinMetadata );
+			}
+			else
+			{
+				jstring jstrMetadata = (*env)->NewStringUTF(env, strMetadata );
+				(*env)->SetObjectField( env,
+						                RawMsgObj,
+						                g_FieldMetadata,
+						                jstrMetadata );
+			}
 		}
 		syslog(LOG_DEBUG, "receiveRawMessage: %d files", nFiles );
 
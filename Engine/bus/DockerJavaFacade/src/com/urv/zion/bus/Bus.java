@@ -54,6 +54,26 @@ public class Bus
         return Dtg;
     }
     
+    /*------------------------------------------------------------------------
+     * listen
+     * 
+     * Listen to another bus handler, e.g. a channel received through the Bus
+     * */
+    public void listen( final BusHandler hBus ) throws IOException 
+    {
+        BusBack_.listenBus( hBus );
+    }
+
+    /*------------------------------------------------------------------------
+     * receive
+     * */
+    public BusDatagram receive( final BusHandler hBus ) throws IOException 
+    {
+        BusRawMessage Msg = BusBack_.receiveRawMessage( hBus );
+        BusDatagram Dtg = new BusDatagram( Msg );
+        return Dtg;
+    }
+    
     /*------------------------------------------------------------------------
      * send
      * */
@@ -1,6 +1,8 @@
 package com.urv.zion.bus;
 
 import java.io.FileDescriptor;
+import java.nio.ByteBuffer;
+import java.nio.charset.StandardCharsets;
 import java.util.ArrayList;
 import java.util.HashMap;
 import java.util.List;
@@ -61,6 +63,28 @@ public class BusDatagram
 		private eFileDescription(int n){}
 	};	
 	
+	/*------------------------------------------------------------------------
+	 * Binary (version 2) files metadata format
+	 * 
+	 * The format and the string table should be synchronized with their
+	 * Python counterpart
+	 * */
+	public final static int DATAGRAM_V2 = 2;
+	private final static int FIELD_MAP = 1;
+	private final static int STRING_INDEX_FLAG = 0x80000000;
+	private final static String[] STRING_TABLE = {
+		"type", "OUTPUT_FD", "COMMAND_FD", "INPUT_FD", "CHANNEL_FD",
+		"inline", "inline_output_max_size", "true", "false",
+		"object_metadata", "request_headers", "parameters",
+		"Content-Length", "Content-Type", "Etag", "Last-Modified",
+		"X-Timestamp", "X-Backend-Timestamp", "X-Trans-Id",
+		"X-Openstack-Request-Id", "X-Auth-Token", "X-Storage-Token",
+		"Host", "User-Agent", "Accept", "Accept-Encoding",
+		"X-Current-Server", "X-Current-Location", "X-Method",
+		"X-Project-Id", "X-Container", "X-Object", "object", "proxy",
+		"get", "put", "application/octet-stream"
+	};
+	
 	// Array of open file descriptors (FDs)
 	private FileDescriptor[] hFiles_;
 	// Number of open file descriptors
@@ -68,10 +92,12 @@ public class BusDatagram
 	// Command to execute
 	private eStorletCommand eCommand_;
 	// identifier for the task
-        private static String taskId_; 
+	private String taskId_;
 	// Metadata for the file descriptors
 	// Descriptor usage intents - input, output, etc
     private HashMap<String, String>[] FilesMetadata_;
+    // Map fields of the FDs metadata, only in binary datagrams
+    private HashMap<String, HashMap<String, String>>[] FilesSections_;
     // Additional execution parameters for the storlet
     private HashMap<String, String> ExecParams_;
     
@@ -88,6 +114,7 @@ public class BusDatagram
     	this.nFiles_ 		= 0;
     	this.eCommand_ 		= eStorletCommand.BUS_CMD_NOP;
     	this.FilesMetadata_	= null;
+    	this.FilesSections_	= null;
     	this.ExecParams_ 	= null;
     	this.taskId_            = null;
     }
@@ -99,7 +126,10 @@ public class BusDatagram
     {
     	setFiles( RawMsg.getFiles() );
     	setCommandAndParamsFromJSON( RawMsg.getParams() );
-    	setFilesMetadataFromJSON( RawMsg.getMetadata() );	    
+    	if( null != RawMsg.getBinMetadata() )
+    		setFilesMetadataFromBinary( RawMsg.getBinMetadata() );
+    	else
+    		setFilesMetadataFromJSON( RawMsg.getMetadata() );	    
     }
     
     /*------------------------------------------------------------------------
@@ -154,6 +184,68 @@ public class BusDatagram
         setFilesMetadata( FilesMetadata );
     }
     
+    /*------------------------------------------------------------------------
+     * setFilesMetadataFromBinary
+     * 
+     * Single pass decoding of the version 2 format: u8 version, u16 number
+     * of files and, for each one, u16 number of fields followed by (key,
+     * kind, value). Map values are u16 number of pairs and (key, value).
+     * */    
+    @SuppressWarnings("unchecked")
+    private void setFilesMetadataFromBinary( byte[] binMetadata )
+    {
+        ByteBuffer buffer = ByteBuffer.wrap( binMetadata );
+        buffer.get(); // version
+        int nFiles = buffer.getShort() & 0xffff;
+        
+        HashMap<String, String>[] FilesMetadata = 
+                (HashMap<String, String>[]) new HashMap[nFiles];
+        HashMap<String, HashMap<String, String>>[] FilesSections = 
+                (HashMap<String, HashMap<String, String>>[]) new HashMap[nFiles];
+        for( int i = 0; i < nFiles; ++i )
+        {
+            FilesMetadata[i] = new HashMap<String, String>();
+            FilesSections[i] = new HashMap<String, HashMap<String, String>>();
+            int nFields = buffer.getShort() & 0xffff;
+            for( int j = 0; j < nFields; ++j )
+            {
+                String strKey = readString( buffer );
+                if( FIELD_MAP == buffer.get() )
+                {
+                    int nPairs = buffer.getShort() & 0xffff;
+                    HashMap<String, String> Section = new HashMap<String, String>();
+                    for( int k = 0; k < nPairs; ++k )
+                        Section.put( readString( buffer ), readString( buffer ) );
+                    FilesSections[i].put( strKey, Section );
+                }
+                else
+                {
+                    String strValue = readString( buffer );
+                    if( strKey.equals("type") )
+                        strValue = convertFileTypeToString( strValue );
+                    FilesMetadata[i].put( strKey, strValue );
+                }
+            }
+        }
+        setFilesMetadata( FilesMetadata );
+        FilesSections_ = FilesSections;
+    }
+    
+    /*------------------------------------------------------------------------
+     * readString
+     * 
+     * Auxiliary method for binary parsing
+     * */    
+    private String readString( ByteBuffer buffer )
+    {
+        int nLength = buffer.getInt();
+        if( 0 != ( nLength & STRING_INDEX_FLAG ) )
+            return STRING_TABLE[ nLength & ~STRING_INDEX_FLAG ];
+        byte[] bytes = new byte[nLength];
+        buffer.get( bytes );
+        return new String( bytes, StandardCharsets.UTF_8 );
+    }
+    
     /*------------------------------------------------------------------------
      * prepareMetadata
      * 
@@ -368,6 +460,18 @@ public class BusDatagram
 	{
 		FilesMetadata_ = filesMetadata;
 	}
+	/*------------------------------------------------------------------------
+	 * getFileSection
+	 * 
+	 * Map field of the metadata of a file, null if the datagram was not
+	 * binary encoded or the file has no such field
+	 * */    
+	public HashMap<String, String> getFileSection(int nFile, String strName) 
+	{
+		if (null == FilesSections_)
+			return null;
+		return FilesSections_[nFile].get(strName);
+	}
 	public HashMap<String, String> getExecParams() 
 	{
 		return ExecParams_;
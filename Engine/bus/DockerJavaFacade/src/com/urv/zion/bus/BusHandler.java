@@ -1,5 +1,9 @@
 package com.urv.zion.bus;
 
+import java.io.FileDescriptor;
+import java.io.IOException;
+import java.lang.reflect.Field;
+
 /*----------------------------------------------------------------------------
  * This class encapsulates OS level file descriptor used 
  * in Transport Layer APIs. 
@@ -18,6 +22,26 @@ public class BusHandler
 		nFD_ = nFD;
 	}
 
+	/*------------------------------------------------------------------------
+	 * fromFileDescriptor
+	 * 
+	 * Wraps a descriptor received through the bus, e.g. a channel socket
+	 * */
+	public static BusHandler fromFileDescriptor( FileDescriptor fd ) 
+			                                                throws IOException
+	{
+		try
+		{
+			Field field = FileDescriptor.class.getDeclaredField( "fd" );
+			field.setAccessible( true );
+			return new BusHandler( field.getInt( fd ) );
+		}
+		catch( ReflectiveOperationException e )
+		{
+			throw new IOException( "Unable to get the raw descriptor", e );
+		}
+	}
+
 	/*------------------------------------------------------------------------
 	 * Getter
 	 * */
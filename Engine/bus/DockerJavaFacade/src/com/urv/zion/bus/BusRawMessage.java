@@ -21,6 +21,9 @@ public class BusRawMessage
 	// JSON-encoded string describing the FDs
 	private String strMetadata_;
 	
+	// Binary (version 2) encoding describing the FDs, instead of strMetadata_
+	private byte[] binMetadata_;
+	
 	// JSON-encoded string with additional information 
 	// for micro-controller execution 
 	private String strParams_;
@@ -32,6 +35,7 @@ public class BusRawMessage
 	{
 		hFiles_      = null;
 		strMetadata_ = null;
+		binMetadata_ = null;
 		strParams_   = null;
 	}
 
@@ -58,6 +62,16 @@ public class BusRawMessage
 		this.strMetadata_ = strMetadata;
 	}
 
+	public byte[] getBinMetadata()
+	{
+		return binMetadata_;
+	}
+
+	public void setBinMetadata( byte[] binMetadata )
+	{
+		this.binMetadata_ = binMetadata;
+	}
+
 	public String getParams()
 	{
 		return strParams_;
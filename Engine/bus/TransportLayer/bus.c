@@ -486,8 +486,9 @@ int bus_recv_msg(	int		n_sbus_handler,
 	recv_msg.msg_namelen = sizeof(str_name );
 
 	int n_msg_len = recvmsg( n_sbus_handler, &recv_msg, 0 );
-	if( n_msg_len < 0 )
+	if( n_msg_len <= 0 )
 	{
+		// 0 means that the peer of a connected channel was closed
 		syslog(LOG_ERR, "bus_recv_msg: recvmsg failed. %s", strerror(errno));
 		close(n_sbus_handler);
 		n_status = -1;
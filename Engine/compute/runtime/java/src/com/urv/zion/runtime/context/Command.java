@@ -0,0 +1,82 @@
+package com.urv.zion.runtime.context;
+
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.nio.ByteBuffer;
+
+import org.json.simple.JSONObject;
+
+
+/*----------------------------------------------------------------------------
+ * Command
+ *
+ * Sends the function commands to Swift, either through the command pipe
+ * of the invocation or through the persistent channel of the gateway.
+ * In the latter case every record is tagged with the invocation id.
+ * 
+ * Each command is a frame: JSON payload length and binary block length
+ * (big-endian ints), the JSON payload and the optional binary block.
+ * */
+public class Command {
+	private FileOutputStream stream;
+	private String invocationId;
+
+	public Command(FileDescriptor commandFd) {
+		this.stream = new FileOutputStream(commandFd);
+		this.invocationId = null;
+	}
+
+	public Command(FileOutputStream channel, String invocationId) {
+		this.stream = channel;
+		this.invocationId = invocationId;
+	}
+
+	public boolean isChannel() {
+		return this.invocationId != null;
+	}
+
+	public static byte[] frame(JSONObject message, byte[] block) {
+		byte[] payload = message.toString().getBytes();
+		int blockLength = (block == null) ? 0 : block.length;
+		ByteBuffer frame = ByteBuffer.allocate(8 + payload.length + blockLength);
+		frame.putInt(payload.length);
+		frame.putInt(blockLength);
+		frame.put(payload);
+		if (blockLength > 0)
+			frame.put(block);
+		return frame.array();
+	}
+
+	public void send(JSONObject message) throws IOException {
+		send(message, null);
+	}
+
+	@SuppressWarnings("unchecked")
+	public void send(JSONObject message, byte[] block) throws IOException {
+		if (!isChannel()) {
+			stream.write(frame(message, block));
+			stream.flush();
+			return;
+		}
+		JSONObject record = new JSONObject(message);
+		record.put("id", invocationId);
+		// One write is one record in the SEQPACKET channel
+		synchronized (stream) {
+			stream.write(frame(record, block));
+		}
+	}
+
+	@SuppressWarnings("unchecked")
+	public void event(String event) {
+		if (!isChannel())
+			return;
+		JSONObject record = new JSONObject();
+		record.put("event", event);
+		try {
+			send(record);
+		} catch (IOException e) {
+			// The gateway closed the channel
+		}
+	}
+}
@@ -20,9 +20,10 @@ public class Context {
 	public Function function;
 
 
-	public Context(FileDescriptor inputStreamFd, FileDescriptor outputStreamFd, Map<String, String> functionParameters, 
-				   FileOutputStream functionLog, FileDescriptor commandFd, Map<String, String> objectMd, 
-				   Map<String, String> reqMd, Logger localLog, Swift swift) 
+	public Context(FileDescriptor inputStreamFd, FileDescriptor outputStreamFd, boolean inlineInput, 
+				   long inputOffset, long inputLength, int inlineOutputMaxSize, Map<String, String> functionParameters, FileOutputStream functionLog, 
+				   Command command, Map<String, String> objectMd, Map<String, String> reqMd, Logger localLog, 
+				   Swift swift) 
 	{	
 		String currentObject = reqMd.get("X-Container")+"/"+reqMd.get("X-Object");
 		
@@ -30,8 +31,9 @@ public class Context {
 		log = new Log(functionLog, logger_);
 		function = new Function(functionParameters, logger_);
 		response = new Response(logger_);
-		request = new Request(commandFd, reqMd, response, logger_);
-		object = new Object(inputStreamFd, outputStreamFd, commandFd, objectMd, currentObject, request, response, swift, logger_);
+		request = new Request(command, reqMd, response, logger_);
+		object = new Object(inputStreamFd, outputStreamFd, inlineInput, inputOffset, inputLength, 
+							inlineOutputMaxSize, command, objectMd, currentObject, request, response, swift, logger_);
 		
 		request.setObjectCtx(object);
 
@@ -39,8 +41,9 @@ public class Context {
 	}
 
 	public void close(){
-		request.forward();
+		// Closing the stream first sends the deferred write command of inline outputs
 		object.stream.close();
+		request.forward();
 		object.metadata.flush();
 	}
 }
\ No newline at end of file
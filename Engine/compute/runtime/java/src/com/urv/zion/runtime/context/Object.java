@@ -2,6 +2,7 @@ package com.urv.zion.runtime.context;
 
 import java.io.BufferedReader;
 import java.io.BufferedWriter;
+import java.io.ByteArrayOutputStream;
 import java.io.FileDescriptor;
 import java.io.FileInputStream;
 import java.io.FileOutputStream;
@@ -11,6 +12,8 @@ import java.io.InputStreamReader;
 import java.io.OutputStream;
 import java.io.OutputStreamWriter;
 import java.io.UnsupportedEncodingException;
+import java.nio.ByteBuffer;
+import java.nio.channels.FileChannel;
 import java.util.Map;
 
 import org.json.simple.JSONObject;
@@ -34,14 +37,15 @@ public class Object {
 	public String contentLength;
 	public String backendTimestamp;
 	public String contentType;
-	private FileOutputStream command;
+	private Command command;
 		
-	public Object(FileDescriptor inputStreamFd, FileDescriptor outputStreamFd, FileDescriptor commandFd,
-			      Map<String, String> objectMetadata, String currentObject, Request req, Response resp, 
-			      Swift apiSwift, Logger logger) {
+	public Object(FileDescriptor inputStreamFd, FileDescriptor outputStreamFd, boolean inlineInput, 
+			      long inputOffset, long inputLength, int inlineOutputMaxSize, Command commandChannel, Map<String, String> objectMetadata, 
+			      String currentObject, Request req, Response resp, Swift apiSwift, Logger logger) {
 		
-		stream = new Stream(inputStreamFd, outputStreamFd);
-		command = new FileOutputStream(commandFd);
+		stream = new Stream(inputStreamFd, outputStreamFd, inlineInput, inputOffset, inputLength, 
+							inlineOutputMaxSize);
+		command = commandChannel;
 		object = currentObject;
 		request = req;
 		response = resp;
@@ -72,11 +76,25 @@ public class Object {
 		private BufferedReader br;
 		private BufferedWriter bw;
 		boolean dataRead = false, dataWrite = false;
+		private long outputLength = -1;
 		private JSONObject outMetadata = new JSONObject();
+		private InlineOutputStream inlineOutput = null;
 		
-		private Stream(FileDescriptor inputStreamFd, FileDescriptor outputStreamFd){
+		private Stream(FileDescriptor inputStreamFd, FileDescriptor outputStreamFd, boolean inlineInput, 
+					   long inputOffset, long inputLength, int inlineOutputMaxSize){
 			inputStream = ((InputStream) (new FileInputStream(inputStreamFd)));
+			if (inputOffset >= 0) {
+				// Byte range of a disk file: read in place, without moving the fd offset
+				inputStream = new RangeInputStream(((FileInputStream) inputStream).getChannel(), 
+												   inputOffset, inputLength);
+			}
 			outputStream = ((OutputStream) (new FileOutputStream(outputStreamFd)));
+			if (inlineOutputMaxSize > 0) {
+				inlineOutput = new InlineOutputStream(outputStream, inlineOutputMaxSize);
+				outputStream = inlineOutput;
+			}
+			// Inline input is already in the fd, Swift does not wait for a read command
+			dataRead = inlineInput;
 			
 			try {
 				br = new BufferedReader(new InputStreamReader(inputStream, "UTF-8"));
@@ -94,12 +112,28 @@ public class Object {
 			return inputStream;
 		}
 		
+		/**
+		 * Declares the length of the output before writing it, so that Swift
+		 * can send the Content-Length to the client.
+		 */
+		public void setLength(long length){
+			if (dataWrite == true)
+				logger_.error("CTX Object: Output length must be set before writing");
+			outputLength = length;
+		}
+		
 		public OutputStream getOutputStream(){
+			this.startWrite();
+			return outputStream;
+		}
+		
+		private void startWrite(){
 			if (dataWrite == false){
 				dataWrite = true;
-				this.sendWriteCommand();
+				// Inline outputs send the write command once their size is known
+				if (inlineOutput == null)
+					this.sendWriteCommand();
 			}
-			return outputStream;
 		}
 		
 		public byte[] readBytes(){
@@ -192,10 +226,7 @@ public class Object {
 		
 		public void writeBytes(byte[] data){
 			try {
-				if (dataWrite == false){
-					dataWrite = true;
-					this.sendWriteCommand();
-				}
+				this.startWrite();
 				outputStream.write(data);
 			} catch (IOException e) {
 				logger_.error("CTX Object: Error while writing out data");
@@ -205,10 +236,7 @@ public class Object {
 		
 		public void write(String data){
 			try {
-				if (dataWrite == false){
-					dataWrite = true;
-					this.sendWriteCommand();
-				}
+				this.startWrite();
 				bw.write(data);
 			} catch (IOException e) {
 				logger_.error("CTX Object: Error while writing out data");
@@ -235,37 +263,152 @@ public class Object {
 
 		}
 		
-		@SuppressWarnings("unchecked")
 		public void sendWriteCommand() {
+			this.sendWriteCommand(null);
+		}
+		
+		@SuppressWarnings("unchecked")
+		public void sendWriteCommand(byte[] inlineData) {
 			// Prevent to send the write command without have sent before the read command
 			if (dataRead == false){
 				dataRead = true;
 				this.sendReadCommand();
 			}
-			outMetadata.put("cmd","DW");
-			this.sendDataToSwift();
-			
 			outMetadata.clear();
+			outMetadata.put("cmd","DW");
 			if (metadata.isModified())
 				outMetadata.put("object_metadata", metadata.getAll());
 			if (response.headers.isModified())
 				outMetadata.put("response_headers",response.headers.getAll());
 			if (request.headers.isModified())
 				outMetadata.put("request_headers", request.headers.getAll());
-			this.sendDataToSwift();
+			if (inlineData != null)
+				outMetadata.put("inline_length", inlineData.length);
+			else if (outputLength >= 0)
+				outMetadata.put("content_length", outputLength);
+			this.sendDataToSwift(inlineData);
 			
 			request.command_sent = true;
 		}
 		
 		public void sendDataToSwift() {
+			this.sendDataToSwift(null);
+		}
+		
+		public void sendDataToSwift(byte[] block) {
 			try {
-				command.write(outMetadata.toString().getBytes());
-				command.flush();
+				command.send(outMetadata, block);
 			} catch (IOException e) {
 				logger_.error("CTX Object: Error sending "+ outMetadata.toString() + " command");
 			}
 		}
 		
+		/*--------------------------------------------------------------------
+		 * RangeInputStream
+		 * 
+		 * Reads a byte range of a file with positional reads (pread), so
+		 * only the requested region of the object is read from the disk.
+		 * */
+		private class RangeInputStream extends InputStream {
+			private FileChannel channel;
+			private long position;
+			private long remaining;
+			
+			private RangeInputStream(FileChannel channel, long offset, long length){
+				this.channel = channel;
+				this.position = offset;
+				this.remaining = length;
+			}
+			
+			@Override
+			public int read() throws IOException {
+				byte[] b = new byte[1];
+				return this.read(b, 0, 1) == -1 ? -1 : (b[0] & 0xff);
+			}
+			
+			@Override
+			public int read(byte[] b, int off, int len) throws IOException {
+				if (remaining <= 0)
+					return -1;
+				if (len == 0)
+					return 0;
+				ByteBuffer buffer = ByteBuffer.wrap(b, off, (int) Math.min(len, remaining));
+				int n = channel.read(buffer, position);
+				if (n == -1) {
+					remaining = 0;
+					return -1;
+				}
+				position += n;
+				remaining -= n;
+				return n;
+			}
+			
+			@Override
+			public int available() {
+				return (int) Math.min(remaining, Integer.MAX_VALUE);
+			}
+			
+			@Override
+			public void close() throws IOException {
+				channel.close();
+			}
+		}
+		
+		/*--------------------------------------------------------------------
+		 * InlineOutputStream
+		 * 
+		 * Buffers the output up to a maximum size. If the function finishes
+		 * before, the output is returned to Swift within the write command;
+		 * otherwise the write command is sent and the output is streamed
+		 * through the output pipe as usual.
+		 * */
+		private class InlineOutputStream extends OutputStream {
+			private OutputStream pipe;
+			private int maxSize;
+			private ByteArrayOutputStream buffer = new ByteArrayOutputStream();
+			private boolean spilled = false, closed = false;
+			
+			private InlineOutputStream(OutputStream pipe, int maxSize){
+				this.pipe = pipe;
+				this.maxSize = maxSize;
+			}
+			
+			@Override
+			public void write(int b) throws IOException {
+				this.write(new byte[] {(byte) b}, 0, 1);
+			}
+			
+			@Override
+			public void write(byte[] b, int off, int len) throws IOException {
+				if (spilled) {
+					pipe.write(b, off, len);
+					return;
+				}
+				buffer.write(b, off, len);
+				if (buffer.size() > maxSize) {
+					spilled = true;
+					sendWriteCommand();
+					buffer.writeTo(pipe);
+					buffer = null;
+				}
+			}
+			
+			@Override
+			public void flush() throws IOException {
+				if (spilled)
+					pipe.flush();
+			}
+			
+			@Override
+			public void close() throws IOException {
+				if (closed)
+					return;
+				closed = true;
+				if (!spilled && dataWrite)
+					sendWriteCommand(buffer.toByteArray());
+				pipe.close();
+			}
+		}
 	}
 
 	public class Metadata { 
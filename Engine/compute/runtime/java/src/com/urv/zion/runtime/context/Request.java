@@ -1,7 +1,5 @@
 package com.urv.zion.runtime.context;
 
-import java.io.FileDescriptor;
-import java.io.FileOutputStream;
 import java.io.IOException;
 import java.util.Map;
 
@@ -10,7 +8,7 @@ import org.slf4j.Logger;
 
 
 public class Request {
-	private FileOutputStream command;
+	private Command command;
 	private JSONObject outMetadata = new JSONObject();
 	private Object object;
 	private Response response;
@@ -18,8 +16,8 @@ public class Request {
 	public Headers headers;
 	public boolean command_sent = false;
 
-	public Request(FileDescriptor commandFd, Map<String, String> requestHeaders, Response resp, Logger logger) {
-		command = new FileOutputStream(commandFd);
+	public Request(Command commandChannel, Map<String, String> requestHeaders, Response resp, Logger logger) {
+		command = commandChannel;
 		headers = new Headers(requestHeaders);
 		response = resp;
 		logger_ = logger;
@@ -37,16 +35,12 @@ public class Request {
 			this.command_sent = true;
 			logger_.info("Sending command: CONTINUE");
 			outMetadata.put("cmd","RC");
-			this.sendDataToSwift();
-	
-			outMetadata.clear();
-			// TODO: is it necessary to offload object metadata here?
 			if (object.metadata.isModified())
 				outMetadata.put("object_metadata", object.metadata.getAll());
 			if (response.headers.isModified())
 				outMetadata.put("response_headers",response.headers.getAll());
 			if (this.headers.isModified())
-				outMetadata.put("request_headers", headers);
+				outMetadata.put("request_headers", headers.getAll());
 			this.sendDataToSwift();
 		}
 	}
@@ -69,8 +63,7 @@ public class Request {
 	
 	private void sendDataToSwift() {
 		try {
-			command.write(outMetadata.toString().getBytes());
-			command.flush();
+			command.send(outMetadata);
 		} catch (IOException e) {
 			logger_.trace("Error sending command on CTX Request: "+e);
 		}
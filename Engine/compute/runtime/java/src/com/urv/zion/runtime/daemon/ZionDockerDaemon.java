@@ -10,11 +10,19 @@ import ch.qos.logback.classic.Level;
 import redis.clients.jedis.Jedis;
 
 import com.urv.zion.bus.*;
+import com.urv.zion.runtime.context.Command;
 import com.urv.zion.runtime.function.Function;
 import com.urv.zion.runtime.function.FunctionExecutionTask;
 
 import java.util.HashMap;
 import java.util.Properties;
+import java.util.concurrent.Executors;
+import java.util.concurrent.PriorityBlockingQueue;
+import java.util.concurrent.ThreadPoolExecutor;
+import java.util.concurrent.TimeUnit;
+
+import org.json.simple.JSONArray;
+import org.json.simple.JSONObject;
 
 
 
@@ -24,6 +32,8 @@ public class ZionDockerDaemon {
 	private static Bus bus_;
 	private static Function function_ = null;
 	private static FileOutputStream functionLog_;
+	private static ThreadPoolExecutor executor_ = null;
+	private static int maxConcurrency_ = 0;
 	
 	private static String configFile = "/opt/zion/runtime/java/worker.config";
 	private static Properties prop_;
@@ -133,7 +143,121 @@ public class ZionDockerDaemon {
 		}
 	}
 	
+	/*------------------------------------------------------------------------
+	 * createExecutor
+	 * 
+	 * Invocations beyond maxConcurrency are queued instead of running
+	 * each one in a new thread, interactive ones first. 0 means unlimited
+	 * concurrency.
+	 * */
+	private static ThreadPoolExecutor createExecutor(int maxConcurrency){
+		if (maxConcurrency <= 0)
+			return (ThreadPoolExecutor) Executors.newCachedThreadPool();
+		return new ThreadPoolExecutor(maxConcurrency, maxConcurrency, 60L, TimeUnit.SECONDS,
+									  new PriorityBlockingQueue<Runnable>());
+	}
+	
+	/*------------------------------------------------------------------------
+	 * reportPing
+	 * 
+	 * Answers the liveness checks of the gateways
+	 * */
+	private static void reportPing(BusDatagram dtg){
+		FileOutputStream out = new FileOutputStream(dtg.getFiles()[0]);
+		try {
+			out.write("OK".getBytes());
+			out.close();
+		} catch (IOException e) {
+			logger_.error("Failed to answer ping: "+e);
+		}
+	}
+	
+	/*------------------------------------------------------------------------
+	 * reportStatus
+	 * 
+	 * Writes the active and queued invocations to the received fd
+	 * */
+	@SuppressWarnings("unchecked")
+	private static void reportStatus(BusDatagram dtg){
+		JSONObject status = new JSONObject();
+		int active = 0, queued = 0;
+		if (executor_ != null){
+			active = executor_.getActiveCount();
+			queued = executor_.getQueue().size();
+		}
+		status.put("active", active);
+		status.put("queued", queued);
+		status.put("max_concurrency", maxConcurrency_);
+		
+		FileOutputStream out = new FileOutputStream(dtg.getFiles()[0]);
+		try {
+			out.write(status.toString().getBytes());
+			out.close();
+		} catch (IOException e) {
+			logger_.error("Failed to report worker status: "+e);
+		}
+	}
+	
+	/*------------------------------------------------------------------------
+	 * serveChannel
+	 * 
+	 * Receives the invocations of a gateway process through its persistent
+	 * channel. Commands and events are sent back through the same channel.
+	 * */
+	@SuppressWarnings("unchecked")
+	private static void serveChannel(FileDescriptor channelFd){
+		FileOutputStream channel = new FileOutputStream(channelFd);
+		BusHandler handler;
+		try {
+			handler = BusHandler.fromFileDescriptor(channelFd);
+			JSONObject hello = new JSONObject();
+			hello.put("event", "HELLO");
+			hello.put("max_concurrency", maxConcurrency_);
+			JSONArray versions = new JSONArray();
+			versions.add(1);
+			versions.add(BusDatagram.DATAGRAM_V2);
+			hello.put("datagram_versions", versions);
+			channel.write(Command.frame(hello, null));
+		} catch (IOException e) {
+			logger_.error("Failed to open invocation channel: "+e);
+			return;
+		}
+		
+		logger_.trace("Invocation channel opened");
+		while (true) {
+			BusDatagram dtg = null;
+			try {
+				bus_.listen(handler);
+				dtg = bus_.receive(handler);
+			} catch (IOException e) {
+				logger_.trace("Invocation channel closed");
+				break;
+			}
+			logger_.trace("Got Function invocation request through channel");
+			FunctionExecutionTask functionTask = new FunctionExecutionTask(dtg, prop_, redis_, function_, functionLog_, channel, logger_);
+			executor_.execute(functionTask);
+		}
+	}
+	
 	private static void processDatagram(BusDatagram dtg){
+		if (dtg.getCommand() == BusDatagram.eStorletCommand.BUS_CMD_PING){
+			reportPing(dtg);
+			return;
+		}
+		
+		if (dtg.getCommand() == BusDatagram.eStorletCommand.BUS_CMD_DAEMON_STATUS){
+			logger_.trace("Got worker status request");
+			reportStatus(dtg);
+			return;
+		}
+		
+		if (dtg.getCommand() == BusDatagram.eStorletCommand.BUS_CMD_DESCRIPTOR){
+			logger_.trace("Got invocation channel");
+			final FileDescriptor channelFd = dtg.getFiles()[0];
+			new Thread(() -> serveChannel(channelFd)).start();
+			return;
+		}
+		
 		int command = dtg.getNFiles();
 
 		/*
@@ -150,8 +274,11 @@ public class ZionDockerDaemon {
 				functionLog_ = new FileOutputStream(logFd);
 				functionName = metadata[0].get("function");
 				mainClass = metadata[0].get("main_class");
+				if (metadata[0].containsKey("max_concurrency"))
+					maxConcurrency_ = Integer.parseInt(metadata[0].get("max_concurrency"));
 				logger_.trace("Got "+functionName+" Function");
 				function_ = new Function(functionName, mainClass, logger_);
+				executor_ = createExecutor(maxConcurrency_);
 			}
 		}
 		
@@ -161,7 +288,7 @@ public class ZionDockerDaemon {
 		if (command == 3){
 			logger_.trace("Got Function invocation request");
 			FunctionExecutionTask functionTask = new FunctionExecutionTask(dtg, prop_, redis_, function_, functionLog_, logger_);
-			new Thread(functionTask).start(); 	
+			executor_.execute(functionTask);
 		}
 	}
 }
@@ -3,6 +3,7 @@ package com.urv.zion.runtime.function;
 
 import com.urv.zion.bus.BusDatagram;
 import com.urv.zion.runtime.api.Api;
+import com.urv.zion.runtime.context.Command;
 import com.urv.zion.runtime.context.Context;
 
 import redis.clients.jedis.Jedis;
@@ -12,6 +13,7 @@ import java.io.FileOutputStream;
 import java.util.HashMap;
 import java.util.Map;
 import java.util.Properties;
+import java.util.concurrent.atomic.AtomicLong;
 
 import org.json.simple.JSONObject;
 import org.json.simple.parser.JSONParser;
@@ -19,12 +21,15 @@ import org.json.simple.parser.ParseException;
 import org.slf4j.Logger;
 
 
-public class FunctionExecutionTask implements Runnable {
+public class FunctionExecutionTask implements Runnable, Comparable<FunctionExecutionTask> {
+	private static final AtomicLong sequence_ = new AtomicLong();
+	
 	private Logger logger_;
 	private Properties prop_;
 	private Function function_;
 	private BusDatagram dtg_;
 	private FileOutputStream functionLog_;
+	private FileOutputStream channel_;
 	private Jedis redis_;
 	
 	private Context ctx;
@@ -37,22 +42,57 @@ public class FunctionExecutionTask implements Runnable {
 	private FileDescriptor inputStreamFd = null;
 	private FileDescriptor outputStreamFd = null;
 	private FileDescriptor commandFd = null;
+	private Command command = null;
+	private boolean inlineInput = false;
+	private long inputOffset = -1;
+	private long inputLength = -1;
+	private int inlineOutputMaxSize = 0;
+	private long deadline = 0;
+	private boolean batch_ = false;
+	private long order_;
 
 	/*------------------------------------------------------------------------
 	 * CTOR
 	 * */
 	public FunctionExecutionTask(BusDatagram dtg, Properties prop, Jedis redis, Function function, FileOutputStream functionLog, Logger logger) {
+		this(dtg, prop, redis, function, functionLog, null, logger);
+	}
+	
+	/*------------------------------------------------------------------------
+	 * CTOR for invocations received through a persistent channel
+	 * */
+	public FunctionExecutionTask(BusDatagram dtg, Properties prop, Jedis redis, Function function, FileOutputStream functionLog, 
+								 FileOutputStream channel, Logger logger) {
 		this.dtg_ = dtg;
 		this.prop_ = prop;
 		this.function_ = function;
 		this.logger_ = logger;
 		this.functionLog_ = functionLog;
+		this.channel_ = channel;
 		this.redis_ = redis;
+		this.order_ = sequence_.getAndIncrement();
 		
+		HashMap<String, String>[] data = dtg.getFilesMetadata();
+		for (int i = 0; data != null && i < data.length; i++) {
+			if ("INPUT_FD".equals(data[i].get("type")))
+				batch_ = "batch".equals(data[i].get("priority"));
+		}
 		
 		logger_.trace("Function execution task created");	
 	}
 	
+	/*------------------------------------------------------------------------
+	 * compareTo
+	 * 
+	 * Queued interactive invocations run before the batch ones, each
+	 * class in arrival order
+	 * */
+	public int compareTo(FunctionExecutionTask other) {
+		if (this.batch_ != other.batch_)
+			return this.batch_ ? 1 : -1;
+		return Long.compare(this.order_, other.order_);
+	}
+	
 	
 	/*------------------------------------------------------------------------
 	 * processDatagram
@@ -62,29 +102,64 @@ public class FunctionExecutionTask implements Runnable {
 	@SuppressWarnings("unchecked")
 	private void processDatagram(){
 		HashMap<String, String>[] data = this.dtg_.getFilesMetadata();
+		FileDescriptor[] files = this.dtg_.getFiles();
+		String inputMetadata = null;
+		int inputIndex = -1;
 		JSONObject metadata;
 		
-		outputStreamFd = this.dtg_.getFiles()[0];
-		logger_.trace("Got object output stream");
-
-		commandFd = this.dtg_.getFiles()[1];
-		logger_.trace("Got Function command stream");
-			
-		inputStreamFd = this.dtg_.getFiles()[2];
-		try {
-			metadata = (JSONObject)new JSONParser().parse(data[2].get("data"));
-			object_metadata = (Map<String, String>) metadata.get("object_metadata");
-			request_headers = (Map<String, String>) metadata.get("request_headers");
-			functionParameters = (Map<String, String>) metadata.get("parameters");
-		} catch (ParseException e) {
-			logger_.trace("Error parsing object headers, request metadata and parameters");
+		for (int i = 0; i < files.length; i++) {
+			String type = data[i].get("type");
+			if ("OUTPUT_FD".equals(type)) {
+				outputStreamFd = files[i];
+				logger_.trace("Got object output stream");
+			} else if ("COMMAND_FD".equals(type)) {
+				commandFd = files[i];
+				logger_.trace("Got Function command stream");
+			} else if ("INPUT_FD".equals(type)) {
+				inputStreamFd = files[i];
+				inputIndex = i;
+				inputMetadata = data[i].get("data");
+				inlineInput = "true".equals(data[i].get("inline"));
+				if (data[i].get("input_offset") != null) {
+					// Byte range of the disk file passed as input fd
+					inputOffset = Long.parseLong(data[i].get("input_offset"));
+					inputLength = Long.parseLong(data[i].get("input_length"));
+				}
+				if (data[i].get("inline_output_max_size") != null)
+					inlineOutputMaxSize = Integer.parseInt(data[i].get("inline_output_max_size"));
+				if (data[i].get("deadline") != null)
+					// Absolute deadline of the request, in epoch seconds
+					deadline = (long) (Double.parseDouble(data[i].get("deadline")) * 1000);
+			}
+		}
+		
+		if (channel_ != null)
+			command = new Command(channel_, this.dtg_.getTaskId());
+		else
+			command = new Command(commandFd);
+		
+		if (inputMetadata == null && inputIndex >= 0) {
+			// Binary datagram: the sections are already decoded
+			object_metadata = this.dtg_.getFileSection(inputIndex, "object_metadata");
+			request_headers = this.dtg_.getFileSection(inputIndex, "request_headers");
+			functionParameters = this.dtg_.getFileSection(inputIndex, "parameters");
+		} else {
+			try {
+				metadata = (JSONObject)new JSONParser().parse(inputMetadata);
+				object_metadata = (Map<String, String>) metadata.get("object_metadata");
+				request_headers = (Map<String, String>) metadata.get("request_headers");
+				functionParameters = (Map<String, String>) metadata.get("parameters");
+			} catch (ParseException e) {
+				logger_.trace("Error parsing object headers, request metadata and parameters");
+			}
+			metadata = null;
 		}
-		metadata = null;
 		logger_.trace("Got object input stream, request headers, object metadata and function parameters");
 		
 		this.api = new Api(redis_, prop_, request_headers, logger_);
-		this.ctx = new Context(inputStreamFd, outputStreamFd, functionParameters, functionLog_, commandFd, 
-						  	   object_metadata, request_headers, logger_, api.swift);
+		this.ctx = new Context(inputStreamFd, outputStreamFd, inlineInput, inputOffset, inputLength, 
+							   inlineOutputMaxSize, functionParameters, 
+							   functionLog_, command, object_metadata, request_headers, logger_, api.swift);
 	}
 
 	
@@ -96,15 +171,28 @@ public class FunctionExecutionTask implements Runnable {
 	public void run() {
 		
 		processDatagram();
+		command.event("STARTED");
 		
 		IFunction function = this.function_.getFunction();
 		String functionName = this.function_.getName();
 		
-		logger_.trace("START: Going to execute '"+functionName+"' function");
-		function.invoke(this.ctx, this.api);
-		ctx.close();
-		api.close();
-		logger_.trace("END: Function '"+functionName+"' executed");
+		try {
+			if (deadline > 0 && System.currentTimeMillis() > deadline) {
+				// The invocation waited in the queue until the client gave up
+				logger_.trace("Deadline expired, '"+functionName+"' function not executed");
+				ctx.request.cancel("Deadline expired before running " + functionName);
+				ctx.close();
+				api.close();
+				return;
+			}
+			logger_.trace("START: Going to execute '"+functionName+"' function");
+			function.invoke(this.ctx, this.api);
+			ctx.close();
+			api.close();
+			logger_.trace("END: Function '"+functionName+"' executed");
+		} finally {
+			command.event("END");
+		}
 
 	}
 }
\ No newline at end of file
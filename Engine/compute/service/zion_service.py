@@ -1,6 +1,8 @@
 from zion.common.utils import get_object_metadata
 from zion.gateways.docker.bus import Bus
 from zion.gateways.docker.datagram import Datagram
+from zion.gateways.docker.worker import get_worker_status, QUEUED_INVOCATIONS_KEY, \
+    QUEUED_INTERACTIVE_INVOCATIONS_KEY
 # from daemonize import Daemonize
 from docker.errors import NotFound
 from subprocess import Popen
@@ -25,6 +27,8 @@ LOW_CPU_THRESHOLD = 0.15
 WORKERS = TOTAL_CPUS
 WORKER_TIMEOUT = 30  # seconds
 TIMEOUT_TO_GROW_UP = 5  # seconds
+# Dockers of the pool kept for functions with queued interactive invocations
+INTERACTIVE_RESERVED_DOCKERS = max(1, WORKERS // 4)
 
 # DIRS
 MAIN_DIR = '/opt/zion/'
@@ -38,6 +42,8 @@ DOCKER_IMAGE = 'adoptopenjdk/openjdk11:x86_64-ubuntu-jdk11u-nightly'
 TIMEOUT_HEADER = "X-Object-Meta-Function-Timeout"
 MEMORY_HEADER = "X-Object-Meta-Function-Memory"
 MAIN_HEADER = "X-Object-Meta-Function-Main"
+MAX_CONCURRENCY_HEADER = "X-Object-Meta-Function-Max-Concurrency"
+DEFAULT_MAX_CONCURRENCY = 0  # Unlimited
 
 swift_uid = shutil._get_uid('swift')
 swift_gid = shutil._get_gid('swift')
@@ -167,6 +173,8 @@ class Container(threading.Thread):
         else:
             memory = int(function_metadata[MEMORY_HEADER])
             main_class = function_metadata[MAIN_HEADER]
+            max_concurrency = int(function_metadata.get(MAX_CONCURRENCY_HEADER,
+                                                        DEFAULT_MAX_CONCURRENCY))
 
         function_log_name = function+'.log'
         function_log_obj = os.path.join(FUNCTIONS_DIR, scope, 'logs', function,
@@ -180,6 +188,7 @@ class Container(threading.Thread):
         md = dict()
         md['function'] = function+'.tar.gz'
         md['main_class'] = main_class
+        md['max_concurrency'] = str(max_concurrency)
         self.fdmd.append(md)
         dtg = Datagram()
         dtg.set_files(self.fds)
@@ -194,6 +203,18 @@ class Container(threading.Thread):
 
         # TODO: Update docker memory
 
+    def get_queued_invocations(self):
+        """
+        Returns the invocations queued in the runtime of the worker
+        """
+        channel = os.path.join(self.channel_dir, 'pipe')
+        try:
+            status = get_worker_status(channel)
+            return int(status['queued'])
+        except Exception as e:
+            logger.warning("Unable to get status of {}: {}".format(self.name, str(e)))
+            return 0
+
     def stop(self, message):
         if not self.stopped:
             self.stopped = True
@@ -216,8 +237,11 @@ class Container(threading.Thread):
                 pass
 
 
-def start_worker(containers, function):
+def start_worker(containers, function, reserve=0):
     r = redis.Redis(connection_pool=REDIS_CONN_POOL)
+    if r.llen('available_dockers') <= reserve:
+        logger.info("Dockers reserved to interactive invocations, not starting worker for: "+function)
+        return
     docker_id = r.lpop('available_dockers')
     if docker_id:
         logger.info("Starting new Function worker for: "+function)
@@ -277,6 +301,9 @@ def monitoring_info_auditor(containers, monitoring_info):
                     workers_to_grow[function] = 0
 
                 function_cpu_usage = 0
+                # Invocations waiting for a slot in the gateways
+                queued = int(r.hget(QUEUED_INVOCATIONS_KEY, function) or 0)
+                interactive_queued = int(r.hget(QUEUED_INTERACTIVE_INVOCATIONS_KEY, function) or 0)
                 workers = monitoring_info[function]
                 total_function_workers = len(workers)
                 active_function_workers = total_function_workers - len(workers_to_kill[function])
@@ -287,13 +314,15 @@ def monitoring_info_auditor(containers, monitoring_info):
                     if docker not in workers_to_kill[function]:
                         function_cpu_usage += worker_cpu_usage
                         last_active_docker = docker
+                        c_id = int(docker.replace('zion_', ''))
+                        queued += containers[c_id].get_queued_invocations()
 
                     if active_function_workers == 0 and docker in workers_to_kill[function] \
                        and worker_cpu_usage > LOW_CPU_THRESHOLD:
                         logger.info("Reusing worker: "+docker)
                         function_cpu_usage += worker_cpu_usage
                         del workers_to_kill[function][docker]
-                        r.zadd(function, {docker: 0})
+                        r.zadd(function, {docker: 0}, nx=True)
                         active_function_workers += 1
 
                 logger.info("WTK:" + str(workers_to_kill))
@@ -301,6 +330,7 @@ def monitoring_info_auditor(containers, monitoring_info):
                 scale_up = active_function_workers*HIGH_CPU_THRESHOLD
                 scale_down = (active_function_workers-1)*HIGH_CPU_THRESHOLD
                 logger.info("Total CPU: "+str(function_cpu_usage)+"% - Scale Up: "+str(scale_up)+"% - Scale Down: "+str(scale_down)+"%")
+                logger.info("Queued invocations: "+str(queued)+" - Interactive: "+str(interactive_queued))
 
                 if active_function_workers == 0:
                     continue
@@ -308,16 +338,19 @@ def monitoring_info_auditor(containers, monitoring_info):
                 mean_function_cpu_usage = function_cpu_usage / active_function_workers
 
                 # Scale Up
-                if mean_function_cpu_usage > HIGH_CPU_THRESHOLD:
-                    if workers_to_grow[function] >= TIMEOUT_TO_GROW_UP:
+                if mean_function_cpu_usage > HIGH_CPU_THRESHOLD or queued > 0:
+                    # Queued interactive invocations grow the function at once
+                    if workers_to_grow[function] >= TIMEOUT_TO_GROW_UP or interactive_queued > 0:
                         workers_to_grow[function] = 0
                         if len(workers_to_kill[function]) > 0:
                             docker = random.sample(workers_to_kill[function], 1)[0]
                             logger.info("Reusing worker: "+docker)
                             del workers_to_kill[function][docker]
-                            r.zadd(function, {docker: 0})
-                        else:
+                            r.zadd(function, {docker: 0}, nx=True)
+                        elif interactive_queued > 0:
                             start_worker(containers, function)
+                        else:
+                            start_worker(containers, function, INTERACTIVE_RESERVED_DOCKERS)
                         continue
                     else:
                         workers_to_grow[function] += 1
@@ -325,6 +358,9 @@ def monitoring_info_auditor(containers, monitoring_info):
                     workers_to_grow[function] = 0
 
                 # Scale Down
+                if queued > 0:
+                    continue
+
                 if active_function_workers > 1:
                     if function_cpu_usage < ((active_function_workers-1)*HIGH_CPU_THRESHOLD):
                         if last_active_docker not in workers_to_kill[function]:
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from zion.common.cache import OutputCache, CacheTeeIter
+
+OUTPUT = b'function output\n' * 64
+
+
+class ClosableIter(object):
+
+    def __init__(self, chunks):
+        self.iterator = iter(chunks)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+
+    def close(self):
+        self.closed = True
+
+
+class TestOutputCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = self._make_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _make_cache(self, disk_size=1024 * 1024, max_object_size=1024 * 1024,
+                    ram_object_size=16):
+        return OutputCache(self.path, 1024 * 1024, disk_size, max_object_size,
+                           ram_object_size, mock.MagicMock())
+
+    def _tee(self, key, chunks, length=len(OUTPUT)):
+        app_iter = ClosableIter(chunks)
+        return CacheTeeIter(app_iter, self.cache.writer(key, {'X-Header': 'value'}),
+                            length), app_iter
+
+    def _read(self, key):
+        cached = self.cache.get(key)
+        if cached is None:
+            return None
+        headers, app_iter, length = cached
+        body = b''.join(app_iter)
+        self.assertEqual(len(body), length)
+        return headers, body
+
+    def test_commit(self):
+        tee, _ = self._tee('key', [OUTPUT[:100], OUTPUT[100:]])
+        self.assertEqual(b''.join(tee), OUTPUT)
+
+        headers, body = self._read('key')
+        self.assertEqual(body, OUTPUT)
+        self.assertEqual(headers['X-Header'], 'value')
+        self.assertTrue(headers['Etag'])
+        self.assertFalse([name for name in os.listdir(self.path) if name.endswith('.tmp')])
+
+    def test_truncated_output(self):
+        tee, _ = self._tee('key', [OUTPUT[:100]])
+        self.assertEqual(b''.join(tee), OUTPUT[:100])
+        self.assertIsNone(self.cache.get('key'))
+        self.assertFalse(os.listdir(self.path))
+
+    def test_abort_on_close(self):
+        tee, app_iter = self._tee('key', [OUTPUT[:100], OUTPUT[100:]])
+        next(tee)
+        tee.close()
+        self.assertTrue(app_iter.closed)
+        self.assertIsNone(self.cache.get('key'))
+        self.assertFalse(os.listdir(self.path))
+
+    def test_abort_on_error(self):
+        def chunks():
+            yield OUTPUT[:100]
+            raise IOError('Function output failed')
+
+        tee, _ = self._tee('key', chunks())
+        self.assertRaises(IOError, b''.join, tee)
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_too_large(self):
+        self.cache = self._make_cache(max_object_size=100)
+        tee, _ = self._tee('key', [OUTPUT[:100], OUTPUT[100:]])
+        self.assertEqual(b''.join(tee), OUTPUT)
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_ram_tier(self):
+        self.cache.put('key', {}, b'small')
+        for name in os.listdir(self.path):
+            os.unlink(os.path.join(self.path, name))
+        self.assertEqual(self._read('key')[1], b'small')
+
+    def test_disk_eviction(self):
+        self.cache = self._make_cache(disk_size=len(OUTPUT) * 2)
+        for key in ('key1', 'key2'):
+            self.cache.put(key, {}, OUTPUT)
+        # key1 is now the most recently used
+        self._read('key1')
+        self.cache.put('key3', {}, OUTPUT)
+
+        self.assertIsNone(self.cache.get('key2'))
+        self.assertEqual(self._read('key1')[1], OUTPUT)
+        self.assertEqual(self._read('key3')[1], OUTPUT)
+
+    def test_index_reload(self):
+        self.cache.put('key', {'X-Header': 'value'}, OUTPUT)
+        writer = self.cache.writer('other', {})
+        writer.write(OUTPUT)
+
+        # Temporary files of other processes are kept
+        cache = self._make_cache()
+        self.assertTrue(os.path.exists(writer.tmp_path))
+        self.assertEqual(cache.get('key')[0]['X-Header'], 'value')
+        writer.commit()
+        self.assertIsNotNone(self.cache.get('other'))
+
+
+if __name__ == '__main__':
+    unittest.main()
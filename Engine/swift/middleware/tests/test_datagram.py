@@ -0,0 +1,64 @@
+import os
+import re
+import unittest
+
+from zion.gateways.docker.datagram import Datagram, DATAGRAM_V1, DATAGRAM_V2, \
+    SBUS_CMD_EXECUTE, STRING_TABLE, pack_files_metadata_v2, unpack_files_metadata_v2
+
+BUS_DATAGRAM_JAVA = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'bus',
+                                 'DockerJavaFacade', 'src', 'com', 'urv', 'zion', 'bus',
+                                 'BusDatagram.java')
+
+FILES_METADATA = [{'type': 'INPUT_FD',
+                   'inline': True,
+                   'inline_output_max_size': 65536,
+                   'request_headers': {'X-Trans-Id': 'tx1234', 'Range': 'bytes=0-9'},
+                   'object_metadata': {'Content-Length': '10', 'X-Object-Meta-Ñ': 'válue'},
+                   'parameters': {}},
+                  {'type': 'OUTPUT_FD'},
+                  {'type': 'COMMAND_FD', 'not in the table': 'not in the table either'}]
+
+# Values as the runtime parses them
+EXPECTED_METADATA = [dict(FILES_METADATA[0], inline='true', inline_output_max_size='65536'),
+                     FILES_METADATA[1],
+                     FILES_METADATA[2]]
+
+
+class TestDatagramV2(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = pack_files_metadata_v2(FILES_METADATA)
+        self.assertEqual(unpack_files_metadata_v2(data), EXPECTED_METADATA)
+
+    def test_string_table(self):
+        data = pack_files_metadata_v2([{'type': 'OUTPUT_FD'}])
+        # Version, number of files, number of fields, key, kind and value
+        self.assertEqual(len(data), 1 + 2 + 2 + 4 + 1 + 4)
+
+    def test_unsupported_version(self):
+        data = bytearray(pack_files_metadata_v2(FILES_METADATA))
+        data[0] = DATAGRAM_V1
+        self.assertRaises(ValueError, unpack_files_metadata_v2, bytes(data))
+
+    def test_datagram(self):
+        dtg = Datagram()
+        dtg.set_version(DATAGRAM_V2)
+        dtg.set_files([3, 4, 5])
+        dtg.set_metadata(FILES_METADATA)
+        dtg.set_command(SBUS_CMD_EXECUTE)
+
+        received = Datagram()
+        received.from_raw_data([3, 4, 5], dtg.get_files_metadata(),
+                               dtg.get_params_and_cmd_as_json())
+        self.assertEqual(received.get_version(), DATAGRAM_V2)
+        self.assertEqual(received.get_metadata(), EXPECTED_METADATA)
+        self.assertEqual(received.get_command(), SBUS_CMD_EXECUTE)
+
+    def test_java_string_table(self):
+        with open(BUS_DATAGRAM_JAVA) as source:
+            table = re.search(r'STRING_TABLE = \{(.*?)\};', source.read(), re.S).group(1)
+        self.assertEqual(re.findall(r'"([^"]*)"', table), STRING_TABLE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+from unittest import mock
+
+from zion.common.health import ComputeNodePool
+
+NODES = ['node1:8585', 'node2:8585']
+
+
+class TestComputeNodePool(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = {'compute_nodes': ','.join(NODES),
+                     'compute_node_timeout': 60,
+                     'compute_node_max_failures': 3,
+                     'compute_node_ejection_time': 10,
+                     'compute_node_max_ejection_time': 40,
+                     'compute_node_backpressure_time': 5,
+                     'spill_over_max_concurrency': 1,
+                     'hedge_min_samples': 2}
+        self.pool = ComputeNodePool(self.conf, mock.MagicMock())
+
+    def test_ejection_on_failures(self):
+        node = self.pool.nodes[NODES[0]]
+        for _ in range(self.conf['compute_node_max_failures'] - 1):
+            self.pool.failure(NODES[0])
+        self.assertEqual(node.ejected_until, 0)
+
+        self.pool.failure(NODES[0])
+        self.assertEqual(node.ejection_time, 10)
+        self.assertGreater(node.ejected_until, 0)
+        for _ in range(10):
+            self.assertEqual(self.pool.choose(), NODES[1])
+
+    def test_ejection_backoff(self):
+        node = self.pool.nodes[NODES[0]]
+        for _ in range(self.conf['compute_node_max_failures']):
+            self.pool.failure(NODES[0])
+        # Failed probes double the ejection time, up to the max
+        for ejection_time in (20, 40, 40):
+            self.pool.failure(NODES[0])
+            self.assertEqual(node.ejection_time, ejection_time)
+
+        self.pool.success(NODES[0], 0.1)
+        self.assertEqual(node.ejected_until, 0)
+        self.assertEqual(node.ejection_time, 0)
+        self.assertEqual(node.failures, 0)
+
+    def test_probe_after_ejection(self):
+        node = self.pool.nodes[NODES[0]]
+        for _ in range(self.conf['compute_node_max_failures']):
+            self.pool.failure(NODES[0])
+        with mock.patch('zion.common.health.time.time',
+                        return_value=node.ejected_until + 1):
+            self.assertEqual(self.pool.choose(), NODES[0])
+            # Only one request probes the node
+            self.assertEqual(self.pool.choose(), NODES[1])
+
+    def test_backpressure_does_not_eject(self):
+        for address in NODES:
+            self.pool.saturated(address)
+        self.assertTrue(self.pool.is_saturated())
+        for address in NODES:
+            node = self.pool.nodes[address]
+            self.assertEqual(node.failures, 0)
+            self.assertEqual(node.ejected_until, 0)
+
+        with mock.patch('zion.common.health.time.time',
+                        return_value=self.pool.nodes[NODES[0]].saturated_until + 1):
+            self.assertFalse(self.pool.is_saturated())
+
+    def test_spill_over(self):
+        slot = self.pool.spill_over()
+        self.assertIsNotNone(slot)
+        self.assertIsNone(self.pool.spill_over())
+        slot.release()
+        slot.release()
+        self.assertEqual(self.pool.local_running, 0)
+
+    def test_hedge_delay(self):
+        self.pool.success(NODES[0])
+        self.assertIsNone(self.pool.hedge_delay())
+        self.pool.success(NODES[0], 0.1)
+        self.pool.success(NODES[1], 0.3)
+        self.assertEqual(self.pool.hedge_delay(), 0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
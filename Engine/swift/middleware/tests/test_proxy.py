@@ -0,0 +1,123 @@
+import os
+import unittest
+from unittest import mock
+
+from swift.common.swob import Request, Response
+
+from zion.common import health
+from zion.handlers import ProxyHandler
+
+COMPUTE_NODE = 'compute-node:8585'
+OBJECT_DATA = b'object data'
+OUTPUT = b'function output\n' * 1024
+
+
+def object_server(env, start_response):
+    return Response(app_iter=iter([OBJECT_DATA]),
+                    headers={'Content-Length': str(len(OBJECT_DATA)),
+                             'Etag': 'object-etag'})(env, start_response)
+
+
+class TestSpillOver(unittest.TestCase):
+
+    def setUp(self):
+        health._compute_node_pool = None
+        self.conf = {'execution_server': 'proxy',
+                     'functions_container': 'functions',
+                     'disaggregated_compute': True,
+                     'compute_nodes': COMPUTE_NODE,
+                     'compute_node_timeout': 60,
+                     'compute_node_backpressure_time': 5,
+                     'spill_over': True,
+                     'spill_over_max_concurrency': 1,
+                     'output_chunk_size': 1024,
+                     'output_etag_hash': 'md5'}
+        self.pool = health.get_compute_node_pool(self.conf, mock.MagicMock())
+        self.pool.saturated(COMPUTE_NODE)
+
+    def tearDown(self):
+        health._compute_node_pool = None
+
+    def _make_gateway(self):
+        def execute_function(function_info, input_range=None):
+            read_fd, write_fd = os.pipe()
+            with os.fdopen(write_fd, 'wb', buffering=0) as pipe:
+                # The output fits in the pipe buffer
+                pipe.write(OUTPUT)
+            return {'command': 'DW', 'fd': read_fd, 'content_length': len(OUTPUT)}
+
+        gateway = mock.MagicMock()
+        gateway.execute_function.side_effect = execute_function
+        return gateway
+
+    def test_spilled_over_output(self):
+        req = Request.blank('/v1/AUTH_test/container/object')
+        handler = ProxyHandler(req, self.conf, object_server, mock.MagicMock(),
+                               mock.MagicMock())
+        functions_data = {'onget': {'function': {}}}
+
+        with mock.patch.object(handler, '_setup_docker_gateway',
+                               return_value=self._make_gateway()):
+            response = handler._handle_get_with_spill_over(functions_data)
+
+        self.assertEqual(self.pool.local_running, 1)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_length, len(OUTPUT))
+        self.assertEqual(response.body, OUTPUT)
+        # The local slot is freed once the output is read
+        self.assertEqual(self.pool.local_running, 0)
+
+
+class TestComputeNodeHealth(unittest.TestCase):
+
+    def setUp(self):
+        health._compute_node_pool = None
+        self.conf = {'execution_server': 'proxy',
+                     'functions_container': 'functions',
+                     'disaggregated_compute': True,
+                     'compute_nodes': COMPUTE_NODE,
+                     'compute_node_timeout': 60,
+                     'compute_node_max_failures': 1,
+                     'compute_node_ejection_time': 10,
+                     'compute_node_max_ejection_time': 300,
+                     'compute_node_backpressure_time': 5}
+        self.pool = health.get_compute_node_pool(self.conf, mock.MagicMock())
+
+    def tearDown(self):
+        health._compute_node_pool = None
+
+    def _request(self, method, status):
+        req = Request.blank('/v1/AUTH_test/container/object')
+        handler = ProxyHandler(req, self.conf, object_server, mock.MagicMock(),
+                               mock.MagicMock())
+        conn = mock.MagicMock()
+        conn.getresponse.return_value.status = status
+        conn.putrequest.return_value.status = status
+        with mock.patch.object(handler, '_prepare_connection',
+                               return_value=(conn, '/path')):
+            handler._request_compute_node(method, 'object', None, {})
+
+    def test_backpressure(self):
+        for status in (429, 503):
+            self._request('GET', status)
+            node = self.pool.nodes[COMPUTE_NODE]
+            self.assertEqual(node.ejected_until, 0)
+            self.assertTrue(self.pool.is_saturated())
+
+    def test_failure(self):
+        for status in (502, 504):
+            health._compute_node_pool = None
+            self.pool = health.get_compute_node_pool(self.conf, mock.MagicMock())
+            self._request('GET', status)
+            self.assertGreater(self.pool.nodes[COMPUTE_NODE].ejected_until, 0)
+
+    def test_latency_samples(self):
+        self._request('PUT', 201)
+        self._request('POST', 200)
+        self.assertEqual(len(self.pool.latencies), 0)
+        self._request('GET', 200)
+        self.assertEqual(len(self.pool.latencies), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+from swift.common.swob import HTTPServiceUnavailable, status_map
+from zion.common.utils import wrap_app_iter
+from collections import defaultdict
+import time
+
+# Redis counters of the invocations per second, by account or function
+RATE_KEY = 'function_rate:'
+RETRY_AFTER = '1'
+
+# Swob has no reason phrase for 429, so it is given with the status
+HTTPTooManyRequests = status_map['429 Too Many Requests']
+
+_admission_control = None
+
+
+def get_admission_control(conf, logger):
+    """
+    Returns the admission control of this process.
+
+    :param conf: middleware configuration
+    :param logger: logger instance
+    :returns: AdmissionControl instance
+    """
+    global _admission_control
+    if _admission_control is None:
+        _admission_control = AdmissionControl(conf, logger)
+    return _admission_control
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def take(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AdmissionControl(object):
+    """
+    Limits the rate and the concurrency of the function invocations, per
+    account and per function, before any connection is opened or any
+    object data is read. Rates are kept in token buckets of this process,
+    or in per-second counters shared in redis. Concurrency is counted in
+    this process.
+    """
+
+    def __init__(self, conf, logger):
+        self.conf = conf
+        self.logger = logger
+        self.buckets = dict()
+        self.running = defaultdict(int)
+
+    def _get_limits(self, scope):
+        return (self.conf[scope + '_rate_limit'],
+                self.conf[scope + '_rate_burst'],
+                self.conf[scope + '_max_concurrency'])
+
+    def _take_token(self, redis, key, rate, burst):
+        if self.conf['rate_limit_redis_sync']:
+            counter = RATE_KEY + key + ':' + str(int(time.time()))
+            pipe = redis.pipeline()
+            pipe.incr(counter)
+            pipe.expire(counter, 2)
+            return pipe.execute()[0] <= max(rate, burst)
+
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(rate, burst)
+        return self.buckets[key].take()
+
+    def admit(self, redis, account, f_names):
+        """
+        Admits the invocation of functions.
+
+        :param redis: redis connection
+        :param account: account of the request
+        :param f_names: names of the functions to run
+        :returns: AdmissionSlot, to release once the invocation ends
+        :raises HTTPServiceUnavailable: if a concurrency limit is reached
+        :raises HTTPTooManyRequests: if a rate limit is exceeded
+        """
+        limits = [(account, self._get_limits('account'))]
+        for f_name in f_names:
+            limits.append((account + '/' + f_name, self._get_limits('function')))
+
+        # Concurrency first, so rejected requests do not take tokens
+        for key, (_, _, max_concurrency) in limits:
+            if max_concurrency and self.running[key] >= max_concurrency:
+                self.logger.info('Concurrency limit reached for ' + key)
+                raise HTTPServiceUnavailable(body='Too many running functions for ' +
+                                             key + '\n', headers={'Retry-After': RETRY_AFTER})
+
+        for key, (rate, burst, _) in limits:
+            if rate and not self._take_token(redis, key, rate, burst):
+                self.logger.info('Rate limit exceeded for ' + key)
+                raise HTTPTooManyRequests(body='Rate limit exceeded for ' +
+                                          key + '\n', headers={'Retry-After': RETRY_AFTER})
+
+        keys = [key for key, _ in limits]
+        for key in keys:
+            self.running[key] += 1
+        return AdmissionSlot(self, keys)
+
+    def release(self, keys):
+        for key in keys:
+            self.running[key] -= 1
+            if self.running[key] <= 0:
+                del self.running[key]
+
+
+class AdmissionSlot(object):
+    """
+    Concurrency taken by an admitted invocation.
+    """
+
+    def __init__(self, admission_control=None, keys=None):
+        self.admission_control = admission_control
+        self.keys = keys or []
+
+    def release(self):
+        if self.admission_control:
+            admission_control, self.admission_control = self.admission_control, None
+            admission_control.release(self.keys)
+
+    def attach(self, response):
+        """
+        Keeps the slot until the output of the response is read.
+
+        :param response: swob.Response of the invocation
+        """
+        app_iter = response.app_iter
+        if app_iter is None or isinstance(app_iter, (list, tuple)):
+            self.release()
+        else:
+            wrap_app_iter(response, SlotIter(app_iter, self))
+
+
+class SlotIter(object):
+    """
+    Releases an admission slot at the end of a function output.
+    """
+
+    def __init__(self, app_iter, slot):
+        self.app_iter = app_iter
+        self.iterator = iter(app_iter)
+        self.slot = slot
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.iterator)
+        except Exception:
+            self.slot.release()
+            raise
+
+    def close(self):
+        self.slot.release()
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
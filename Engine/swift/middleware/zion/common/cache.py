@@ -0,0 +1,318 @@
+from collections import OrderedDict
+from hashlib import md5, sha256
+import json
+import os
+import time
+import uuid
+
+CACHEABLE_HEADER = "X-Object-Meta-Function-Cacheable"
+DISK_CHUNK = 64 * 1024
+TMP_MAX_AGE = 3600  # Temporary files not written for this long are abandoned
+
+# Output cache of this process, created on first use
+_output_cache = None
+
+
+def get_output_cache(conf, logger):
+    """
+    Returns the function output cache of this process.
+
+    :param conf: middleware configuration
+    :param logger: logger instance
+    :returns: OutputCache instance
+    """
+    global _output_cache
+    if _output_cache is None:
+        path = os.path.join(conf['main_dir'], conf['output_cache_dir'])
+        _output_cache = OutputCache(path, conf['output_cache_ram_size'],
+                                    conf['output_cache_disk_size'],
+                                    conf['output_cache_max_object_size'],
+                                    conf['output_cache_ram_object_size'],
+                                    logger)
+    return _output_cache
+
+
+def make_cache_key(object_etag, function_etag, function_name, parameters):
+    """
+    Builds the key of a function output.
+
+    :param object_etag: ETag of the input object
+    :param function_etag: ETag of the function object, i.e. its content hash
+    :param function_name: name of the function
+    :param parameters: parameters of the function
+    :returns: hex string key
+    """
+    data = json.dumps([object_etag, function_etag, function_name, parameters],
+                      sort_keys=True, default=repr)
+    return sha256(data.encode('utf-8')).hexdigest()
+
+
+class FileIter(object):
+    """
+    Iterator over a cached output on disk.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self.fp.read(DISK_CHUNK)
+        if not chunk:
+            self.close()
+            raise StopIteration()
+        return chunk
+
+    def close(self):
+        self.fp.close()
+
+
+class OutputCache(object):
+    """
+    Size-bounded LRU cache of function outputs, with a RAM tier for small
+    outputs and a disk tier for all of them. Each entry is the output and
+    the headers the function set on the response. The size bounds and the
+    LRU order are kept per process, while the disk tier is shared by the
+    processes of the server: each one evicts only the entries it knows.
+    """
+
+    def __init__(self, path, ram_size, disk_size, max_object_size,
+                 ram_object_size, logger):
+        self.path = path
+        self.ram_size = ram_size
+        self.disk_size = disk_size
+        self.max_object_size = max_object_size
+        self.ram_object_size = ram_object_size
+        self.logger = logger
+
+        self.ram = OrderedDict()  # key -> (headers, body)
+        self.ram_used = 0
+        self.disk = OrderedDict()  # key -> size
+        self.disk_used = 0
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self._load_disk_index()
+
+    def _data_path(self, key):
+        return os.path.join(self.path, key + '.data')
+
+    def _meta_path(self, key):
+        return os.path.join(self.path, key + '.meta')
+
+    def _load_disk_index(self):
+        """
+        Rebuilds the LRU order of the disk tier from the access times.
+        """
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.path):
+            file_path = os.path.join(self.path, name)
+            if name.endswith('.tmp'):
+                # Other processes may still be writing recent ones
+                try:
+                    if now - os.stat(file_path).st_mtime > TMP_MAX_AGE:
+                        os.unlink(file_path)
+                except OSError:
+                    pass
+            elif name.endswith('.data'):
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    # Evicted by another process
+                    continue
+                entries.append((st.st_atime, name[:-len('.data')], st.st_size))
+
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_used += size
+        self._evict_disk()
+
+    def _remove_disk(self, key):
+        self.disk_used -= self.disk.pop(key, 0)
+        for file_path in (self._data_path(key), self._meta_path(key)):
+            try:
+                os.unlink(file_path)
+            except OSError:
+                pass
+
+    def _evict_disk(self):
+        while self.disk_used > self.disk_size and self.disk:
+            key = next(iter(self.disk))
+            self._remove_disk(key)
+
+    def _put_ram(self, key, headers, body):
+        if len(body) > self.ram_object_size or key in self.ram:
+            return
+        self.ram[key] = (headers, body)
+        self.ram_used += len(body)
+        while self.ram_used > self.ram_size and self.ram:
+            _, (_, old_body) = self.ram.popitem(last=False)
+            self.ram_used -= len(old_body)
+
+    def get(self, key):
+        """
+        Looks up a function output.
+
+        :param key: key built with make_cache_key
+        :returns: (headers, app_iter, length) tuple, or None on miss
+        """
+        entry = self.ram.get(key)
+        if entry:
+            self.ram.move_to_end(key)
+            headers, body = entry
+            return dict(headers), [body], len(body)
+
+        if key not in self.disk:
+            return None
+        try:
+            with open(self._meta_path(key)) as meta:
+                headers = json.load(meta)
+            fp = open(self._data_path(key), 'rb')
+        except (IOError, OSError, ValueError):
+            self._remove_disk(key)
+            return None
+        self.disk.move_to_end(key)
+
+        size = os.fstat(fp.fileno()).st_size
+        if size <= self.ram_object_size:
+            body = fp.read()
+            fp.close()
+            self._put_ram(key, headers, body)
+            return dict(headers), [body], size
+
+        return headers, FileIter(fp), size
+
+    def put(self, key, headers, body):
+        """
+        Stores a complete function output.
+
+        :param key: key built with make_cache_key
+        :param headers: headers set by the function
+        :param body: bytes of the output
+        """
+        writer = self.writer(key, headers)
+        writer.write(body)
+        writer.commit()
+
+    def writer(self, key, headers):
+        """
+        :param key: key built with make_cache_key
+        :param headers: headers set by the function
+        :returns: CacheWriter to store an output while it is streamed
+        """
+        return CacheWriter(self, key, headers)
+
+    def _add(self, key, headers, tmp_path, size, body):
+        if key in self.disk:
+            self._remove_disk(key)
+        meta_tmp_path = tmp_path + '.meta.tmp'
+        with open(meta_tmp_path, 'w') as meta:
+            json.dump(headers, meta)
+        os.rename(meta_tmp_path, self._meta_path(key))
+        os.rename(tmp_path, self._data_path(key))
+        self.disk[key] = size
+        self.disk_used += size
+        self._evict_disk()
+
+        if body is not None:
+            self._put_ram(key, headers, body)
+
+
+class CacheWriter(object):
+    """
+    Stores an output while it is sent to the client. The entry is only
+    added if the whole output is written and is not too large.
+    """
+
+    def __init__(self, cache, key, headers):
+        self.cache = cache
+        self.key = key
+        self.headers = dict(headers)
+        self.size = 0
+        self.md5 = md5()
+        self.chunks = []  # Copy for the RAM tier, while the output is small
+        self.tmp_path = os.path.join(cache.path, key + '.' + uuid.uuid4().hex + '.tmp')
+        self.fp = open(self.tmp_path, 'wb')
+        self.done = False
+
+    def write(self, chunk):
+        if self.done:
+            return
+        self.size += len(chunk)
+        if self.size > self.cache.max_object_size:
+            self.abort()
+            return
+        self.md5.update(chunk)
+        self.fp.write(chunk)
+        if self.chunks is not None:
+            if self.size <= self.cache.ram_object_size:
+                self.chunks.append(chunk)
+            else:
+                self.chunks = None
+
+    def commit(self):
+        if self.done:
+            return
+        self.done = True
+        self.fp.close()
+        self.headers['Etag'] = self.md5.hexdigest()
+        body = b''.join(self.chunks) if self.chunks is not None else None
+        try:
+            self.cache._add(self.key, self.headers, self.tmp_path, self.size, body)
+        except (IOError, OSError):
+            self.cache.logger.exception('Output cache - Unable to store ' + self.key)
+            self._unlink()
+
+    def abort(self):
+        if self.done:
+            return
+        self.done = True
+        self.fp.close()
+        self._unlink()
+
+    def _unlink(self):
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
+
+
+class CacheTeeIter(object):
+    """
+    Passes an output through to the client while it is stored in the cache.
+    The output is only stored if it has the length declared by the function.
+    """
+
+    def __init__(self, app_iter, writer, length):
+        self.app_iter = app_iter
+        self.iterator = iter(app_iter)
+        self.writer = writer
+        self.length = length  # Length declared by the function
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self.iterator)
+        except StopIteration:
+            if self.writer.size == self.length:
+                self.writer.commit()
+            else:
+                # Truncated output
+                self.writer.abort()
+            raise
+        except Exception:
+            self.writer.abort()
+            raise
+        self.writer.write(chunk)
+        return chunk
+
+    def close(self):
+        # Outputs not read until the end are not stored
+        self.writer.abort()
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
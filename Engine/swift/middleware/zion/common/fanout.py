@@ -0,0 +1,208 @@
+from zion.common.utils import wrap_app_iter
+from collections import deque
+from eventlet.event import Event
+from eventlet import Timeout
+import eventlet
+
+LAG_TIMEOUT = 10  # Time the slowest readers can stall the shared output
+
+# Invocations of this process that can still be joined, by output key
+_flights = dict()
+
+
+def join_flight(key):
+    """
+    Joins the running invocation that produces an output, or registers a
+    new one.
+
+    :param key: output key, as built with make_cache_key
+    :returns: (Flight, whether the caller leads the invocation) tuple
+    """
+    flight = _flights.get(key)
+    if flight is not None:
+        return flight, False
+
+    flight = Flight(key)
+    _flights[key] = flight
+    return flight, True
+
+
+class Flight(object):
+    """
+    A single invocation whose output is shared by all the concurrent
+    requests of the same output. Streamed outputs are read once and
+    fanned out through a bounded buffer: new requests can join while the
+    output streamed so far is still buffered.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.result = Event()
+        self.status = None
+        self.headers = None
+        self.body = None
+        self.max_buffer = 0
+
+        self.chunks = deque()
+        self.base = 0  # Position of the first buffered chunk
+        self.buffered = 0
+        self.streamed = 0
+        self.readers = set()
+        self.eof = False
+        self.error = False
+        self.changed = Event()
+
+    def _close(self):
+        # New requests start their own invocation
+        if _flights.get(self.key) is self:
+            del _flights[self.key]
+
+    def _notify(self):
+        changed, self.changed = self.changed, Event()
+        changed.send()
+
+    def _wait_change(self, timeout=None):
+        try:
+            with Timeout(timeout):
+                self.changed.wait()
+            return True
+        except Timeout:
+            return False
+
+    def fail(self):
+        """
+        Called by the leader when the invocation fails.
+        """
+        self._close()
+        if not self.result.ready():
+            self.result.send(False)
+
+    def wait(self):
+        """
+        Waits for the leader to get the response of the function.
+
+        :returns: whether the output can be shared
+        """
+        return self.result.wait()
+
+    def publish(self, response, max_buffer):
+        """
+        Shares the response of the leader, whose app_iter is replaced by a
+        reader of the shared output.
+
+        :param response: swob.Response processed by the function
+        :param max_buffer: max bytes buffered for the readers
+        """
+        self.status = response.status
+        self.headers = dict(response.headers)
+        app_iter = response.app_iter
+        if app_iter is None or isinstance(app_iter, (list, tuple)):
+            self.body = [response.body]
+            self._close()
+            self.result.send(True)
+            return
+
+        self.max_buffer = max_buffer
+        # The original output is read, and closed, by the pump
+        wrap_app_iter(response, self.subscribe())
+        eventlet.spawn(self._pump, app_iter)
+        self.result.send(True)
+
+    def subscribe(self):
+        """
+        :returns: app_iter of the shared output, or None if the beginning of
+                  the output is no longer buffered
+        """
+        if self.body is not None:
+            return list(self.body)
+        if self.base > 0:
+            return None
+
+        reader = FanoutIter(self)
+        self.readers.add(reader)
+        return reader
+
+    def unsubscribe(self, reader):
+        self.readers.discard(reader)
+        self._trim()
+        self._notify()
+
+    def _trim(self):
+        if self.streamed <= self.max_buffer:
+            # Keep the beginning of the output for new requests
+            return
+        position = min([r.position for r in self.readers] or [self.base + len(self.chunks)])
+        while self.base < position:
+            self.buffered -= len(self.chunks.popleft())
+            self.base += 1
+
+    def _detach_laggards(self):
+        position = min(r.position for r in self.readers)
+        for reader in [r for r in self.readers if r.position == position]:
+            reader.detached = True
+            self.readers.discard(reader)
+        self._trim()
+        self._notify()
+
+    def _pump(self, app_iter):
+        try:
+            for chunk in app_iter:
+                if not chunk:
+                    continue
+                while self.buffered > self.max_buffer and self.readers:
+                    if not self._wait_change(LAG_TIMEOUT):
+                        self._detach_laggards()
+                if not self.readers:
+                    # Nobody reads the output anymore
+                    break
+                self.chunks.append(chunk)
+                self.buffered += len(chunk)
+                self.streamed += len(chunk)
+                if self.streamed > self.max_buffer:
+                    self._close()
+                    self._trim()
+                self._notify()
+        except Exception:
+            self.error = True
+        finally:
+            self.eof = True
+            self._close()
+            self._notify()
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+class FanoutIter(object):
+    """
+    Reader of the output of a Flight.
+    """
+
+    def __init__(self, flight):
+        self.flight = flight
+        self.position = flight.base
+        self.detached = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        flight = self.flight
+        while True:
+            if self.detached:
+                raise IOError('Reader too slow for the shared function output')
+            index = self.position - flight.base
+            if index < len(flight.chunks):
+                chunk = flight.chunks[index]
+                self.position += 1
+                flight._trim()
+                flight._notify()
+                return chunk
+            if flight.eof:
+                self.close()
+                if flight.error:
+                    raise IOError('Function output failed')
+                raise StopIteration()
+            flight._wait_change()
+
+    def close(self):
+        self.flight.unsubscribe(self)
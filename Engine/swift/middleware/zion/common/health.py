@@ -0,0 +1,157 @@
+from zion.common.admission import AdmissionSlot
+from collections import deque
+import random
+import time
+
+LATENCY_SAMPLES = 200  # Response times kept to compute the hedging delay
+HEDGE_PERCENTILE = 0.95
+
+_compute_node_pool = None
+
+
+def get_compute_node_pool(conf, logger):
+    """
+    Returns the compute node pool of this process.
+
+    :param conf: middleware configuration
+    :param logger: logger instance
+    :returns: ComputeNodePool instance
+    """
+    global _compute_node_pool
+    if _compute_node_pool is None:
+        _compute_node_pool = ComputeNodePool(conf, logger)
+    return _compute_node_pool
+
+
+class ComputeNode(object):
+
+    def __init__(self, address):
+        self.address = address
+        self.failures = 0  # Consecutive failures
+        self.ejection_time = 0
+        self.ejected_until = 0
+        self.probe_time = 0  # Start of the request that probes an ejected node
+        self.saturated_until = 0
+
+
+class ComputeNodePool(object):
+    """
+    Passive health tracking of the compute nodes. Nodes that fail
+    several requests in a row are ejected; once the ejection expires a
+    single request probes the node, and the ejection time doubles each
+    time the probe fails. Response times of the healthy nodes give the
+    delay after which idempotent requests are hedged. When no node has
+    free capacity, a share of the functions can run in this proxy.
+    """
+
+    def __init__(self, conf, logger):
+        self.conf = conf
+        self.logger = logger
+        self.nodes = dict()
+        for address in conf['compute_nodes'].split(','):
+            address = address.strip()
+            if address:
+                self.nodes[address] = ComputeNode(address)
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.local_running = 0  # Functions spilled over to this proxy
+
+    def choose(self, exclude=()):
+        """
+        Chooses a compute node at random among the healthy ones. If all
+        the nodes are ejected, any of them is chosen.
+
+        :param exclude: addresses of the nodes not to choose
+        :returns: address of the node, or None if all are excluded
+        """
+        now = time.time()
+        candidates = [n for n in self.nodes.values() if n.address not in exclude]
+        if not candidates:
+            return None
+
+        healthy = [n for n in candidates if n.ejected_until == 0]
+        probes = [n for n in candidates if 0 < n.ejected_until <= now and
+                  now - n.probe_time > self.conf['compute_node_timeout']]
+        if probes:
+            node = random.choice(probes)
+            node.probe_time = now
+            self.logger.info('Probing ejected compute node ' + node.address)
+        else:
+            node = random.choice(healthy or candidates)
+
+        return node.address
+
+    def success(self, address, seconds=None):
+        """
+        :param address: address of the node
+        :param seconds: time until the response headers of a GET were
+                        received, used to compute the hedging delay
+        """
+        node = self.nodes.get(address)
+        if node is None:
+            return
+        if node.ejected_until:
+            self.logger.info('Compute node %s is healthy again' % address)
+        node.failures = 0
+        node.ejection_time = 0
+        node.ejected_until = 0
+        node.probe_time = 0
+        if seconds is not None:
+            self.latencies.append(seconds)
+
+    def failure(self, address):
+        """
+        :param address: address of the node
+        """
+        node = self.nodes.get(address)
+        if node is None:
+            return
+        node.failures += 1
+        if node.ejected_until or node.failures >= self.conf['compute_node_max_failures']:
+            node.ejection_time = min(max(node.ejection_time * 2,
+                                         self.conf['compute_node_ejection_time']),
+                                     self.conf['compute_node_max_ejection_time'])
+            node.ejected_until = time.time() + node.ejection_time
+            node.probe_time = 0
+            self.logger.info('Compute node %s ejected for %d seconds' %
+                             (address, node.ejection_time))
+
+    def saturated(self, address):
+        """
+        Records a response of a compute node without free capacity.
+
+        :param address: address of the node
+        """
+        node = self.nodes.get(address)
+        if node is not None:
+            node.saturated_until = time.time() + self.conf['compute_node_backpressure_time']
+
+    def is_saturated(self):
+        """
+        :returns: whether no compute node can take more requests
+        """
+        now = time.time()
+        return all(n.ejected_until or n.saturated_until > now for n in self.nodes.values())
+
+    def spill_over(self):
+        """
+        Takes a slot to run a function in this proxy.
+
+        :returns: AdmissionSlot, or None if the local share is exhausted
+        """
+        if self.local_running >= self.conf['spill_over_max_concurrency']:
+            return None
+        self.local_running += 1
+        return AdmissionSlot(self, ['local'])
+
+    def release(self, keys):
+        self.local_running -= len(keys)
+
+    def hedge_delay(self):
+        """
+        :returns: seconds after which a request is hedged, or None if there
+                  are not enough samples yet
+        """
+        if len(self.latencies) < self.conf['hedge_min_samples']:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * HEDGE_PERCENTILE), len(latencies) - 1)]
@@ -0,0 +1,146 @@
+from zion.common.utils import PRIORITY_HEADER, BATCH
+from swift.common.swob import Request
+from eventlet import GreenPool
+import eventlet
+import json
+import time
+import uuid
+
+# Redis keys of the asynchronous onput jobs
+ONPUT_QUEUE = 'onput_jobs'
+ONPUT_PROCESSING = 'onput_jobs:processing'  # Jobs being executed
+ONPUT_STARTED = 'onput_jobs:started'  # Start time of the jobs being executed
+ONPUT_DELAYED = 'onput_jobs:delayed'  # Jobs waiting to be retried, by due time
+
+POP_TIMEOUT = 5
+RETRY_DELAY = 5
+REAP_INTERVAL = 30
+
+
+def enqueue_onput_job(redis, path, function_info, etag):
+    """
+    Queues the execution of an asynchronous onput function.
+
+    :param redis: redis connection
+    :param path: path of the stored object
+    :param function_info: function information
+    :param etag: ETag of the stored object
+    """
+    job = {'id': uuid.uuid4().hex,
+           'path': path,
+           'function': function_info,
+           'etag': etag,
+           'attempts': 0}
+    redis.lpush(ONPUT_QUEUE, json.dumps(job))
+
+
+class OnputJobConsumer(object):
+    """
+    Executes the asynchronous onput jobs in this process. Jobs stay in
+    redis while they run, so the jobs of a failed process are queued
+    again once their lease expires: the lease of running jobs is renewed.
+    Failed jobs are retried with an exponential backoff.
+    """
+
+    def __init__(self, conf, app, logger, redis, handler_class):
+        self.conf = conf
+        self.app = app
+        self.logger = logger
+        self.redis = redis
+        self.handler_class = handler_class
+        self.retries = conf['async_onput_retries']
+        self.lease = conf['async_onput_lease']
+        self.pool = GreenPool(conf['async_onput_concurrency'])
+
+    def start(self):
+        self.logger.info('Starting asynchronous onput job consumer')
+        eventlet.spawn(self._consume)
+        eventlet.spawn(self._reap)
+
+    def _consume(self):
+        while True:
+            try:
+                self._queue_due_jobs()
+                if not self.pool.free():
+                    # Concurrency limit reached
+                    eventlet.sleep(0.1)
+                    continue
+                data = self.redis.brpoplpush(ONPUT_QUEUE, ONPUT_PROCESSING, POP_TIMEOUT)
+                if data:
+                    self.redis.hset(ONPUT_STARTED, data, time.time())
+                    self.pool.spawn_n(self._execute, data)
+            except Exception:
+                self.logger.exception('Unable to get asynchronous onput jobs')
+                eventlet.sleep(RETRY_DELAY)
+
+    def _queue_due_jobs(self):
+        for data in self.redis.zrangebyscore(ONPUT_DELAYED, 0, time.time()):
+            # Only the consumer that removes the job queues it
+            if self.redis.zrem(ONPUT_DELAYED, data):
+                self.redis.lpush(ONPUT_QUEUE, data)
+
+    def _reap(self):
+        while True:
+            eventlet.sleep(REAP_INTERVAL)
+            try:
+                now = time.time()
+                for data in self.redis.lrange(ONPUT_PROCESSING, 0, -1):
+                    started = self.redis.hget(ONPUT_STARTED, data)
+                    if started is None:
+                        self.redis.hsetnx(ONPUT_STARTED, data, now)
+                    elif now - float(started) > self.lease:
+                        if self.redis.lrem(ONPUT_PROCESSING, 1, data):
+                            self.logger.info('Asynchronous onput job lease expired, '
+                                             'queuing it again')
+                            self.redis.rpush(ONPUT_QUEUE, data)
+                        self.redis.hdel(ONPUT_STARTED, data)
+            except Exception:
+                self.logger.exception('Unable to reap asynchronous onput jobs')
+
+    def _run_job(self, job):
+        req = Request.blank(job['path'], environ={'REQUEST_METHOD': 'GET',
+                                                  'swift.authorize_override': True,
+                                                  'swift.authorize': lambda req: None},
+                            headers={PRIORITY_HEADER: BATCH})
+        handler = self.handler_class(req, self.conf, self.app, self.logger, self.redis)
+        status = handler.execute_onput_job(job['function'], job['etag'])
+        if status in (404, 412):
+            self.logger.info('Object %s no longer exists or was overwritten, '
+                             'asynchronous onput job discarded' % job['path'])
+        elif status // 100 != 2:
+            raise ValueError('Unable to get %s: %d' % (job['path'], status))
+
+    def _renew_lease(self, data):
+        while True:
+            eventlet.sleep(self.lease / 3.0)
+            try:
+                self.redis.hset(ONPUT_STARTED, data, time.time())
+            except Exception:
+                self.logger.exception('Unable to renew the lease of an asynchronous onput job')
+
+    def _execute(self, data):
+        pipe = self.redis.pipeline()
+        try:
+            job = json.loads(data.decode())
+        except ValueError:
+            self.logger.error('Invalid asynchronous onput job discarded')
+            job = None
+        renewal = eventlet.spawn(self._renew_lease, data)
+        try:
+            if job:
+                self._run_job(job)
+        except Exception:
+            job['attempts'] += 1
+            if job['attempts'] <= self.retries:
+                self.logger.exception('Asynchronous onput job failed, retrying: ' +
+                                      job['path'])
+                delay = RETRY_DELAY * 2 ** (job['attempts'] - 1)
+                pipe.zadd(ONPUT_DELAYED, {json.dumps(job): time.time() + delay})
+            else:
+                self.logger.exception('Asynchronous onput job failed %d times, '
+                                      'discarded: %s' % (job['attempts'], job['path']))
+        finally:
+            renewal.kill()
+        pipe.lrem(ONPUT_PROCESSING, 1, data)
+        pipe.hdel(ONPUT_STARTED, data)
+        pipe.execute()
@@ -0,0 +1,124 @@
+from eventlet.queue import Queue, Full
+from hashlib import sha256
+import eventlet
+import json
+
+MATERIALIZE_HEADER = "X-Object-Meta-Function-Materialize"
+SOURCE_ETAG_SYSMETA = "X-Object-Sysmeta-Zion-Source-Etag"
+FUNCTION_ETAG_SYSMETA = "X-Object-Sysmeta-Zion-Function-Etag"
+FUNCTION_OUTPUT_HEADER = "X-Zion-Function-Output"  # Responses with a function output
+QUEUE_DEPTH = 16  # Chunks buffered between the client and the derived PUT
+QUEUE_TIMEOUT = 10
+
+
+def get_materialized_object_name(container, obj, function_name, parameters):
+    """
+    Builds the name of the derived object in the shadow container.
+
+    :param container: container of the source object
+    :param obj: name of the source object
+    :param function_name: name of the function
+    :param parameters: parameters of the function
+    :returns: object name
+    """
+    data = json.dumps(parameters, sort_keys=True, default=repr)
+    params_hash = sha256(data.encode('utf-8')).hexdigest()[:16]
+    return '%s/%s/%s.%s' % (container, obj, function_name, params_hash)
+
+
+class MaterializeAbort(Exception):
+    pass
+
+
+class QueueInput(object):
+    """
+    wsgi.input of the derived object PUT, fed with the chunks sent to the
+    client.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.buf = b''
+
+    def read(self, size=-1):
+        while not self.buf:
+            chunk = self.queue.get()
+            if chunk is None:
+                return b''
+            if isinstance(chunk, Exception):
+                raise chunk
+            self.buf = chunk
+        if size is None or size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+
+class MaterializeTeeIter(object):
+    """
+    Passes a function output through to the client while it is stored as
+    a derived object. The derived object is only created if the whole
+    output is read and it is not too large: otherwise its PUT is aborted
+    before the last chunk, so Swift does not commit it.
+    """
+
+    def __init__(self, app_iter, container_req, put_req, app, max_size, logger):
+        self.app_iter = app_iter
+        self.iterator = iter(app_iter)
+        self.max_size = max_size
+        self.logger = logger
+        self.size = 0
+        self.done = False
+        self.queue = Queue(QUEUE_DEPTH)
+        put_req.environ['wsgi.input'] = QueueInput(self.queue)
+        self.thread = eventlet.spawn(self._put, container_req, put_req, app)
+
+    def _put(self, container_req, put_req, app):
+        # The shadow container is created on demand
+        container_req.get_response(app)
+        resp = put_req.get_response(app)
+        if resp.is_success:
+            self.logger.info('Materialized function output in ' + put_req.path)
+        else:
+            self.logger.info('Unable to materialize function output in %s: %s' %
+                             (put_req.path, resp.status))
+
+    def _feed(self, item):
+        try:
+            self.queue.put(item, timeout=QUEUE_TIMEOUT)
+        except Full:
+            # The PUT does not progress: do not slow down the client
+            self.done = True
+            self.thread.kill()
+
+    def _finish(self, item):
+        if not self.done:
+            self.done = True
+            if not self.thread.dead:
+                self._feed(item)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self.iterator)
+        except StopIteration:
+            self._finish(None)
+            raise
+        except Exception:
+            self._finish(MaterializeAbort('Function output failed'))
+            raise
+        if not self.done and not self.thread.dead:
+            self.size += len(chunk)
+            if self.size > self.max_size:
+                self._finish(MaterializeAbort('Function output too large'))
+            elif chunk:
+                self._feed(chunk)
+        return chunk
+
+    def close(self):
+        # Outputs not read until the end are not materialized
+        self._finish(MaterializeAbort('Function output not fully read'))
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
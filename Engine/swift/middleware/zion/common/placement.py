@@ -0,0 +1,103 @@
+import time
+
+# Redis hashes of the execution statistics, per account and function
+STATS_KEY = 'function_stats:'
+OBJECT_NODE = 'object'
+COMPUTE_NODE = 'compute'
+MiB = 1024 * 1024
+
+# Adds an execution to the statistics, halving them once the window is
+# full, atomically so concurrent executions are neither lost nor halved twice
+RECORD_STATS_SCRIPT = """
+local samples = tonumber(redis.call('HINCRBYFLOAT', KEYS[1], 'samples', 1))
+redis.call('HINCRBYFLOAT', KEYS[1], 'input', ARGV[1])
+redis.call('HINCRBYFLOAT', KEYS[1], 'output', ARGV[2])
+redis.call('HINCRBYFLOAT', KEYS[1], 'seconds', ARGV[3])
+if samples > tonumber(ARGV[4]) then
+    local stats = redis.call('HGETALL', KEYS[1])
+    for i = 1, #stats, 2 do
+        redis.call('HSET', KEYS[1], stats[i], tostring(tonumber(stats[i + 1]) / 2))
+    end
+end
+"""
+
+
+def _stats_key(account, f_name):
+    return STATS_KEY + account + '/' + f_name
+
+
+def record_function_stats(redis, conf, account, f_name, input_bytes, output_bytes, seconds):
+    """
+    Adds an execution to the statistics of a function. Old executions are
+    progressively forgotten, so the statistics follow the current
+    behaviour of the function.
+
+    :param redis: redis connection
+    :param conf: middleware configuration
+    :param account: account of the function
+    :param f_name: function name
+    :param input_bytes: length of the object
+    :param output_bytes: length of the function output
+    :param seconds: time from the invocation to the end of the output
+    """
+    redis.eval(RECORD_STATS_SCRIPT, 1, _stats_key(account, f_name),
+               input_bytes, output_bytes, seconds, conf['placement_window'])
+
+
+def choose_placement(redis, conf, account, f_name):
+    """
+    Chooses where to run a function. Functions that reduce the data and
+    are cheap to run go to the object nodes, so less data crosses the
+    network; the rest go to the compute nodes, so they do not take the
+    CPU of the storage nodes.
+
+    :param redis: redis connection
+    :param conf: middleware configuration
+    :param account: account of the function
+    :param f_name: function name
+    :returns: OBJECT_NODE or COMPUTE_NODE
+    """
+    default = COMPUTE_NODE if conf['disaggregated_compute'] else OBJECT_NODE
+    stats = {field.decode(): float(value) for field, value in
+             redis.hgetall(_stats_key(account, f_name)).items()}
+    if stats.get('samples', 0) < conf['placement_min_samples'] or not stats.get('input'):
+        return default
+
+    ratio = stats['output'] / stats['input']
+    seconds_per_mib = stats['seconds'] / (stats['input'] / MiB)
+    if ratio <= conf['placement_reduction_ratio'] and \
+       seconds_per_mib <= conf['placement_object_node_cost']:
+        return OBJECT_NODE
+    return COMPUTE_NODE
+
+
+class StatsIter(object):
+    """
+    Counts the output of a function, and reports it with the execution
+    time once the output was read to the end.
+    """
+
+    def __init__(self, app_iter, start_time, callback):
+        self.app_iter = app_iter
+        self.iterator = iter(app_iter)
+        self.start_time = start_time
+        self.callback = callback
+        self.length = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self.iterator)
+        except StopIteration:
+            if self.callback:
+                callback, self.callback = self.callback, None
+                callback(self.length, time.time() - self.start_time)
+            raise
+        self.length += len(chunk)
+        return chunk
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
@@ -1,17 +1,44 @@
 from swift.common.exceptions import DiskFileXattrNotSupported
 from swift.common.exceptions import DiskFileNoSpace, DiskFileNotExist
-from swift.common.internal_client import InternalClient
+from swift.common.internal_client import InternalClient, UnexpectedResponse
+from swift.common.swob import multi_range_iterator, status_map
 from eventlet import Timeout
+from eventlet.pools import Pool
+from eventlet.queue import Queue, Empty, Full
+from eventlet.hubs import trampoline
+from eventlet.patcher import original
+import hashlib
+import tempfile
 import xattr
-import select
 import logging
 import pickle
+import fcntl
+import io
 import errno
+import stat
+import time
 import os
 
 PICKLE_PROTOCOL = 2
 SWIFT_METADATA_KEY = 'user.swift.metadata'
 LOCAL_PROXY = '/etc/swift/zion-proxy-server.conf'
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+SPLICE_CHUNK = 1024 * 1024
+INTERNAL_CLIENT_POOL_SIZE = 4
+INTERNAL_CLIENT_REQUEST_TRIES = 3
+OUTPUT_CHUNK = 64 * 1024
+DEADLINE_HEADER = 'X-Zion-Deadline'  # Absolute deadline of the request, as an epoch time
+HTTPGatewayTimeout = status_map[504]  # Not exported by swob
+
+# Priority classes of the requests
+PRIORITY_HEADER = 'X-Zion-Priority'
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+PRIORITY_CLASSES = (INTERACTIVE, BATCH)
+
+# The green os.read/os.write wait without timeout on non-blocking fds
+_os = original('os')
+TEE_QUEUE_DEPTH = 16
 
 
 def read_metadata(fd, md_key=None):
@@ -138,123 +165,520 @@ def get_filename(fd):
     return fd
 
 
+class InternalClientPool(Pool):
+    """
+    Process-wide pool of internal clients. Each client loads the local
+    proxy pipeline, so they are only created on demand and then reused.
+    """
+
+    def create(self):
+        return InternalClient(LOCAL_PROXY, 'Zion', INTERNAL_CLIENT_REQUEST_TRIES)
+
+
+_internal_client_pool = InternalClientPool(max_size=INTERNAL_CLIENT_POOL_SIZE)
+
+
 def make_swift_request(op, account, container=None, obj=None):
     """
-    Makes a swift request via a local proxy (cost expensive)
+    Makes a swift request via a local proxy. Failed requests are retried
+    by the internal client, and the body of the response is not read, so
+    it can be streamed from its app_iter.
+
     :param op: opertation (PUT, GET, DELETE, HEAD)
     :param account: swift account
     :param container: swift container
     :param obj: swift object
     :returns: swift.common.swob.Response instance
     """
-    iclient = InternalClient(LOCAL_PROXY, 'Zion', 1)
-    path = iclient.make_path(account, container, obj)
-    resp = iclient.make_request(op, path, {'PATH_INFO': path}, [200])
+    with _internal_client_pool.item() as iclient:
+        path = iclient.make_path(account, container, obj)
+        try:
+            resp = iclient.make_request(op, path, {'PATH_INFO': path}, [200])
+        except UnexpectedResponse as e:
+            resp = e.resp
 
     return resp
 
 
+def set_pipe_size(fd, size):
+    """
+    Enlarges the kernel buffer of a pipe, so that fewer context switches
+    are needed to move the data. Best effort: the size is capped by
+    /proc/sys/fs/pipe-max-size for unprivileged processes.
+
+    :param fd: any end of the pipe
+    :param size: buffer size in bytes
+    """
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        pass
+
+
+def create_sealed_memfd(data):
+    """
+    Creates an in-memory file with the data, sealed against any further
+    modification, to be passed to a worker as a single fd.
+
+    :param data: bytes of the file
+    :returns: file descriptor positioned at the start of the data
+    """
+    fd = os.memfd_create('zion-input', os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.lseek(fd, 0, os.SEEK_SET)
+        fcntl.fcntl(fd, fcntl.F_ADD_SEALS, fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW |
+                    fcntl.F_SEAL_WRITE | fcntl.F_SEAL_SEAL)
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
+
+def get_splice_fd(stream):
+    """
+    Returns a raw fd from which the data of the stream can be moved
+    without passing through Python memory.
+
+    :param stream: object stream
+    :returns: file descriptor, or None if the stream has buffered data
+              or is not backed by an fd
+    """
+    if hasattr(stream, 'splice_fd'):
+        return stream.splice_fd()
+    if isinstance(stream, io.FileIO):
+        return stream.fileno()
+    return None
+
+
+def splice_data(src_fd, dst_fd, timeout):
+    """
+    Moves all the data from src_fd to dst_fd in kernel space with splice(),
+    or with sendfile() for regular files when splice() is not available.
+    dst_fd must be a non-blocking pipe.
+
+    :param src_fd: source file descriptor
+    :param dst_fd: destination file descriptor
+    :param timeout: seconds to wait for each step
+    :returns: the number of bytes moved
+    """
+    regular = stat.S_ISREG(os.fstat(src_fd).st_mode)
+    if not hasattr(os, 'splice') and not regular:
+        raise ValueError('splice() is not available for fd %d' % src_fd)
+
+    total = 0
+    while True:
+        if not regular:
+            trampoline(src_fd, read=True, timeout=timeout)
+        try:
+            if hasattr(os, 'splice'):
+                moved = os.splice(src_fd, dst_fd, SPLICE_CHUNK,
+                                  flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            else:
+                moved = os.sendfile(dst_fd, src_fd, None, SPLICE_CHUNK)
+        except BlockingIOError:
+            trampoline(dst_fd, write=True, timeout=timeout)
+            continue
+        if moved == 0:
+            return total
+        total += moved
+
+
+def get_deadline(headers):
+    """
+    :param headers: request headers
+    :returns: deadline of the request, as an epoch time, or None
+    """
+    try:
+        return float(headers[DEADLINE_HEADER])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def get_priority(headers):
+    """
+    :param headers: request headers
+    :returns: priority class of the request, interactive by default
+    """
+    priority = headers.get(PRIORITY_HEADER, INTERACTIVE)
+    return priority if priority in PRIORITY_CLASSES else INTERACTIVE
+
+
+def time_left(deadline, timeout):
+    """
+    :param deadline: deadline of the request, or None
+    :param timeout: seconds to wait without a deadline
+    :returns: seconds to wait, bounded by the deadline
+    """
+    if deadline is None:
+        return timeout
+    return max(0, min(timeout, deadline - time.time()))
+
+
+def wrap_app_iter(response, app_iter):
+    """
+    Replaces the app_iter of a response with a wrapper of it. Unlike the
+    swob setter, the wrapped iterator is not closed and the Content-Length
+    of the response is kept.
+
+    :param response: swob.Response
+    :param app_iter: iterator that wraps response.app_iter
+    """
+    response._app_iter = app_iter
+
+
+def write_data(fd, data, timeout):
+    """
+    Writes the whole chunk to a non-blocking fd, yielding to other
+    green threads while the fd is not writable.
+
+    :param fd: file descriptor
+    :param data: bytes-like object
+    :param timeout: seconds to wait for the fd to be writable
+    """
+    view = memoryview(data)
+    while view:
+        try:
+            written = _os.write(fd, view)
+        except BlockingIOError:
+            trampoline(fd, write=True, timeout=timeout)
+            continue
+        view = view[written:]
+
+
+class TeeInput(object):
+    """
+    wsgi.input that passes the object to Swift while an observer function
+    reads a copy of it. The last chunk is held back from Swift until the
+    function decides, so a rejected object is never committed.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.queue = Queue(TEE_QUEUE_DEPTH)
+        self.pending = None
+        self.eof = False
+        self.stopped = False
+        self.verdict = None  # Callable that waits for the function decision
+
+    def function_stream(self):
+        """
+        :returns: iterator over the chunks for the function
+        """
+        return iter(self.queue.get, None)
+
+    def _feed(self, chunk):
+        if not self.stopped:
+            self.queue.put(chunk)
+
+    def stop(self, *args):
+        """
+        Stops copying data once the function finished.
+        """
+        self.stopped = True
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+        try:
+            self.queue.put_nowait(None)
+        except Full:
+            pass
+
+    def read(self, size=-1):
+        while not self.eof:
+            chunk = self.stream.read(size)
+            if chunk:
+                self._feed(chunk)
+                if self.pending is None:
+                    self.pending = chunk
+                    continue
+                data, self.pending = self.pending, chunk
+                return data
+
+            # End of the object: wait for the function
+            self._feed(None)
+            self.eof = True
+            if not self.verdict():
+                raise IOError('Object rejected by the function')
+            data, self.pending = self.pending, None
+            if data:
+                return data
+
+        return b''
+
+
+class SpoolFileIter(object):
+    """
+    Function output spooled to an anonymous temporary file, so that its
+    length and ETag are known and byte ranges of it can be served. Outputs
+    larger than max_size are not fully spooled: the rest is streamed after
+    the spooled data, and the length is unknown.
+    """
+
+    def __init__(self, app_iter, spool_dir, max_size, chunk_size=OUTPUT_CHUNK):
+        self.chunk_size = chunk_size
+        self.fp = tempfile.TemporaryFile(dir=spool_dir)
+        self.md5 = hashlib.md5()
+        self.length = 0
+        self.app_iter = app_iter
+        self.rest = None
+
+        iterator = iter(app_iter)
+        try:
+            for chunk in iterator:
+                self.fp.write(chunk)
+                self.md5.update(chunk)
+                self.length += len(chunk)
+                if self.length > max_size:
+                    self.rest = iterator
+                    break
+        except Exception:
+            self.close()
+            raise
+        if self.rest is None:
+            self._close_app_iter()
+
+    @property
+    def complete(self):
+        return self.rest is None
+
+    def get_etag(self):
+        return self.md5.hexdigest()
+
+    def _close_app_iter(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+        self.app_iter = None
+
+    def __iter__(self):
+        for chunk in self.app_iter_range(0, self.length):
+            yield chunk
+        if self.rest is not None:
+            for chunk in self.rest:
+                yield chunk
+            self.close()
+
+    def app_iter_range(self, start, stop):
+        self.fp.seek(start)
+        remaining = (stop if stop is not None else self.length) - start
+        while remaining > 0:
+            chunk = self.fp.read(min(self.chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def app_iter_ranges(self, ranges, content_type, boundary, size):
+        return multi_range_iterator(ranges, content_type, boundary, size,
+                                    self.app_iter_range)
+
+    def close(self):
+        self.fp.close()
+        if self.app_iter is not None:
+            self._close_app_iter()
+
+
 class DataFdIter(object):
-    def __init__(self, fd):
+    """
+    File-like iterator over the output of a function, read from a pipe.
+
+    The pipe is read in non-blocking mode and the green thread waits in
+    the hub while it is empty. Chunks are returned as read by os.read(),
+    so every byte is copied once. Line-oriented reads keep the pending
+    data in a bytearray, consumed from the front without re-copying it.
+
+    If hash_callback is given, the output is hashed as it is read, and the
+    callback receives the hex digest once the whole output was read.
+    Reads are aborted once the deadline of the request expires.
+    """
+
+    def __init__(self, fd, close_callback=None, chunk_size=OUTPUT_CHUNK, timeout=10,
+                 hash_callback=None, hash_name='md5', deadline=None):
         self.closed = False
         self.data_fd = fd
-        self.timeout = 10
-        self.buf = b''
+        self.timeout = timeout
+        self.deadline = deadline
+        self.chunk_size = chunk_size
+        self.buf = bytearray()  # Data read but not consumed yet
+        self.cancel_func = None
+        self.close_callback = close_callback
+        self.hash_callback = hash_callback
+        self.hasher = hashlib.new(hash_name) if hash_callback else None
+        os.set_blocking(fd, False)
+
+    def _run_close_callback(self):
+        if self.close_callback:
+            callback = self.close_callback
+            self.close_callback = None
+            callback()
+
+    def _end_of_output(self):
+        if self.hash_callback:
+            callback = self.hash_callback
+            self.hash_callback = None
+            callback(self.hasher.hexdigest())
+        # Free the pipe and the worker slot
+        self._release()
 
     def __iter__(self):
         return self
 
-    def read_with_timeout(self, size):
+    def _wait_readable(self):
         try:
-            with Timeout(self.timeout):
-                chunk = os.read(self.data_fd, size)
+            trampoline(self.data_fd, read=True, timeout=time_left(self.deadline, self.timeout))
         except Timeout:
             if self.cancel_func:
                 self.cancel_func()
             self.close()
             raise
-        except Exception:
-            self.close()
-            raise
-        return chunk
 
-    def __next__(self, size=64 * 1024):
-        if len(self.buf) < size:
-            r, _, _ = select.select([self.data_fd], [], [], self.timeout)
-            if len(r) == 0:
-                self.close()
+    def _release(self):
+        if self.data_fd is not None:
+            os.close(self.data_fd)
+            self.data_fd = None
+        self._run_close_callback()
 
-            if self.data_fd in r:
-                self.buf += self.read_with_timeout(size - len(self.buf))
-                if self.buf == b'':
-                    raise StopIteration('Stopped iterator ex')
-            else:
-                raise StopIteration('Stopped iterator ex')
+    def _read_chunk(self, size):
+        """
+        Reads up to size bytes from the pipe.
+
+        :returns: the read bytes, empty at the end of the output
+        """
+        if self.data_fd is None:
+            return b''
+        while True:
+            try:
+                chunk = _os.read(self.data_fd, size)
+                break
+            except BlockingIOError:
+                self._wait_readable()
+            except Exception:
+                self.close()
+                raise
+        if not chunk:
+            self._end_of_output()
+        elif self.hasher:
+            self.hasher.update(chunk)
+        return chunk
 
-        if len(self.buf) > size:
-            data = self.buf[:size]
-            self.buf = self.buf[size:]
+    def _take(self, size=-1):
+        if size < 0 or size >= len(self.buf):
+            data = bytes(self.buf)
+            self.buf.clear()
         else:
-            data = self.buf
-            self.buf = b''
+            data = bytes(self.buf[:size])
+            del self.buf[:size]
         return data
 
+    def __next__(self):
+        if self.buf:
+            return self._take(self.chunk_size)
+        if self.closed:
+            raise StopIteration('Stopped iterator ex')
+        chunk = self._read_chunk(self.chunk_size)
+        if not chunk:
+            raise StopIteration('Stopped iterator ex')
+        return chunk
+
+    def splice_fd(self):
+        if self.closed or self.buf or self.hasher:
+            return None
+        return self.data_fd
+
     def _close_check(self):
         if self.closed:
             raise ValueError('I/O operation on closed file')
 
-    def read(self, size=64 * 1024):
+    def readinto(self, b):
+        """
+        Reads directly into a caller provided buffer, without intermediate
+        copies.
+
+        :param b: writable bytes-like object
+        :returns: number of bytes read, 0 at the end of the output
+        """
         self._close_check()
-        return self.next(size)
+        view = memoryview(b).cast('B')
+        if self.buf:
+            data = self._take(len(view))
+            view[:len(data)] = data
+            return len(data)
+        if self.data_fd is None:
+            return 0
+        while True:
+            try:
+                length = os.readv(self.data_fd, [view])
+                break
+            except BlockingIOError:
+                self._wait_readable()
+            except Exception:
+                self.close()
+                raise
+        if length == 0 and len(view) > 0:
+            self._end_of_output()
+        elif self.hasher:
+            self.hasher.update(view[:length])
+        return length
+
+    def read(self, size=-1):
+        self._close_check()
+        if size is None or size < 0:
+            chunks = [self._take()]
+            chunk = self._read_chunk(self.chunk_size)
+            while chunk:
+                chunks.append(chunk)
+                chunk = self._read_chunk(self.chunk_size)
+            return b''.join(chunks)
+        if self.buf:
+            return self._take(size)
+        return self._read_chunk(size)
 
     def readline(self, size=-1):
         self._close_check()
 
-        # read data into self.buf if there is not enough data
-        while b'\n' not in self.buf and \
-              (size < 0 or len(self.buf) < size):
-            if size < 0:
-                chunk = self.read()
-            else:
-                chunk = self.read(size - len(self.buf))
+        # read data into self.buf until there is a whole line, only
+        # searching the newly read data each time
+        start = 0
+        while True:
+            end = self.buf.find(b'\n', start)
+            if end >= 0:
+                end += 1
+                break
+            if 0 <= size <= len(self.buf):
+                break
+            start = len(self.buf)
+            chunk = self._read_chunk(self.chunk_size)
             if not chunk:
                 break
             self.buf += chunk
 
-        # Retrieve one line from buf
-        data, sep, rest = self.buf.partition(b'\n')
-        data += sep
-        self.buf = rest
-
-        # cut out size from retrieved line
-        if size >= 0 and len(data) > size:
-            self.buf = data[size:] + self.buf
-            data = data[:size]
-
-        return data
+        if end < 0 or (0 <= size < end):
+            end = len(self.buf) if size < 0 else size
+        return self._take(end)
 
     def readlines(self, sizehint=-1):
         self._close_check()
         lines = []
-        try:
-            while True:
-                line = self.readline(sizehint)
-                if not line:
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            if sizehint >= 0:
+                sizehint -= len(line)
+                if sizehint <= 0:
                     break
-                lines.append(line)
-                if sizehint >= 0:
-                    sizehint -= len(line)
-                    if sizehint <= 0:
-                        break
-        except StopIteration:
-            pass
         return lines
 
     def close(self):
         if self.closed:
             return
-        os.close(self.data_fd)
         self.closed = True
+        self._release()
 
     def __del__(self):
         self.close()
@@ -4,6 +4,8 @@ from zion.handlers import ProxyHandler
 from zion.handlers import ComputeHandler
 from zion.handlers import ObjectHandler
 from zion.handlers.base import NotFunctionRequest
+from zion.common.jobs import OnputJobConsumer
+from zion.gateways.docker.channel import MAX_INLINE_SIZE
 from distutils.util import strtobool
 import redis
 
@@ -25,6 +27,7 @@ class FunctionHandlerMiddleware(object):
                                                     db=redis_db)
 
         self.handler_class = self._get_handler(self.exec_server)
+        self.onput_job_consumer = None
 
     def _get_handler(self, exec_server):
         """
@@ -44,8 +47,20 @@ class FunctionHandlerMiddleware(object):
             raise ValueError('configuration error: execution_server must be '
                              'either proxy, object or compute but is %s' % exec_server)
 
+    def _start_onput_job_consumer(self):
+        """
+        Compute nodes execute the asynchronous onput functions. The consumer
+        is started on the first request, once the server worker is running.
+        """
+        r = redis.Redis(connection_pool=self.redis_conn_pool)
+        self.onput_job_consumer = OnputJobConsumer(self.conf, self.app, self.logger,
+                                                   r, self.handler_class)
+        self.onput_job_consumer.start()
+
     @wsgify
     def __call__(self, req):
+        if self.exec_server == 'compute' and self.onput_job_consumer is None:
+            self._start_onput_job_consumer()
         try:
             r = redis.Redis(connection_pool=self.redis_conn_pool)
             handler = self.handler_class(req, self.conf, self.app, self.logger, r)
@@ -92,10 +107,89 @@ def filter_factory(global_conf, **local_conf):
     conf['default_function_timeout'] = int(conf.get('default_function_timeout', 10))
     conf['default_function_memory'] = int(conf.get('default_function_memory', 1024))
     conf['max_function_memory'] = int(conf.get('max_function_memory', 1024))
+    # Invocations run at once by each worker: 0 is unlimited
+    conf['default_function_max_concurrency'] = int(conf.get('default_function_max_concurrency', 0))
     # Compute Nodes
     conf['disaggregated_compute'] = strtobool(conf.get('disaggregated_compute', 'True'))
     conf['compute_nodes'] = conf.get('compute_nodes', 'localhost:8585')
     conf['docker_pool_dir'] = conf.get('docker_pool_dir', 'docker_pool')
+    conf['compute_node_timeout'] = float(conf.get('compute_node_timeout', 60))
+    conf['compute_node_max_failures'] = int(conf.get('compute_node_max_failures', 3))
+    conf['compute_node_ejection_time'] = int(conf.get('compute_node_ejection_time', 10))
+    conf['compute_node_max_ejection_time'] = int(conf.get('compute_node_max_ejection_time', 300))
+    conf['compute_node_backpressure_time'] = int(conf.get('compute_node_backpressure_time', 5))
+    # Spill-over: GET functions run in the proxy while the compute nodes are saturated
+    conf['spill_over'] = strtobool(conf.get('spill_over', 'False'))
+    conf['spill_over_max_concurrency'] = int(conf.get('spill_over_max_concurrency', 4))
+    # Hedged GETs to the compute nodes, after the p95 response time
+    conf['hedged_requests'] = strtobool(conf.get('hedged_requests', 'False'))
+    conf['hedge_min_samples'] = int(conf.get('hedge_min_samples', 20))
+    # Adaptive placement: requires the middleware on both compute and object nodes
+    conf['adaptive_placement'] = strtobool(conf.get('adaptive_placement', 'False'))
+    conf['placement_window'] = int(conf.get('placement_window', 100))
+    conf['placement_min_samples'] = int(conf.get('placement_min_samples', 10))
+    conf['placement_reduction_ratio'] = float(conf.get('placement_reduction_ratio', 0.5))
+    conf['placement_object_node_cost'] = float(conf.get('placement_object_node_cost', 0.05))
+    # Priority classes: share of the worker slots reserved to interactive requests
+    conf['interactive_reserved_share'] = float(conf.get('interactive_reserved_share', 0.25))
+    # Workers
+    conf['worker_ping'] = strtobool(conf.get('worker_ping', 'True'))
+    conf['worker_ping_ttl'] = float(conf.get('worker_ping_ttl', 5))
+    conf['worker_ping_timeout'] = float(conf.get('worker_ping_timeout', 0.5))
+    conf['worker_invoke_retries'] = int(conf.get('worker_invoke_retries', 1))
+    conf['persistent_channels'] = strtobool(conf.get('persistent_channels', 'True'))
+    conf['binary_datagrams'] = strtobool(conf.get('binary_datagrams', 'True'))
+    # Data plane
+    conf['splice_data_plane'] = strtobool(conf.get('splice_data_plane', 'True'))
+    conf['pipe_size'] = int(conf.get('pipe_size', 1024 * 1024))
+    conf['output_chunk_size'] = int(conf.get('output_chunk_size', 64 * 1024))
+    conf['inline_object_max_size'] = min(int(conf.get('inline_object_max_size', 64 * 1024)),
+                                         MAX_INLINE_SIZE)
+    conf['inline_output_max_size'] = min(int(conf.get('inline_output_max_size', 64 * 1024)),
+                                         MAX_INLINE_SIZE)
+    # Deadline of the function requests set at the proxy, in seconds: 0 disables it
+    conf['request_deadline'] = float(conf.get('request_deadline', 0))
+    # Load shedding at the proxy: 0 disables a limit
+    conf['load_shedding'] = strtobool(conf.get('load_shedding', 'False'))
+    conf['rate_limit_redis_sync'] = strtobool(conf.get('rate_limit_redis_sync', 'False'))
+    conf['account_rate_limit'] = float(conf.get('account_rate_limit', 0))
+    conf['account_rate_burst'] = int(conf.get('account_rate_burst', 0))
+    conf['account_max_concurrency'] = int(conf.get('account_max_concurrency', 0))
+    conf['function_rate_limit'] = float(conf.get('function_rate_limit', 0))
+    conf['function_rate_burst'] = int(conf.get('function_rate_burst', 0))
+    conf['function_max_concurrency'] = int(conf.get('function_max_concurrency', 0))
+    # Container map requests
+    conf['map_concurrency'] = int(conf.get('map_concurrency', 16))
+    # Asynchronous onput functions
+    conf['async_onput_concurrency'] = int(conf.get('async_onput_concurrency', 4))
+    conf['async_onput_retries'] = int(conf.get('async_onput_retries', 3))
+    conf['async_onput_lease'] = int(conf.get('async_onput_lease', 300))
+    # Function output ETags
+    conf['output_etags'] = strtobool(conf.get('output_etags', 'True'))
+    conf['output_etag_hash'] = conf.get('output_etag_hash', 'md5')
+    conf['output_etag_ttl'] = int(conf.get('output_etag_ttl', 7 * 24 * 3600))
+    # Spooled function outputs
+    conf['spool_dir'] = conf.get('spool_dir', 'spool')
+    conf['spool_max_size'] = int(conf.get('spool_max_size', 1024 ** 3))
+    # Single-flight invocations
+    conf['single_flight'] = strtobool(conf.get('single_flight', 'True'))
+    conf['single_flight_buffer_size'] = int(conf.get('single_flight_buffer_size',
+                                                     4 * 1024 * 1024))
+    # Materialized views
+    conf['materialized_views'] = strtobool(conf.get('materialized_views', 'True'))
+    conf['materialized_container'] = conf.get('materialized_container', '.materialized')
+    conf['materialize_max_object_size'] = int(conf.get('materialize_max_object_size',
+                                                       1024 ** 3))
+    # Output cache: the sizes are budgets of each worker process, which all
+    # share output_cache_dir, so the disk use can reach workers * disk size
+    conf['output_cache'] = strtobool(conf.get('output_cache', 'True'))
+    conf['output_cache_dir'] = conf.get('output_cache_dir', 'output_cache')
+    conf['output_cache_ram_size'] = int(conf.get('output_cache_ram_size', 256 * 1024 * 1024))
+    conf['output_cache_disk_size'] = int(conf.get('output_cache_disk_size', 10 * 1024 ** 3))
+    conf['output_cache_max_object_size'] = int(conf.get('output_cache_max_object_size',
+                                                        64 * 1024 * 1024))
+    conf['output_cache_ram_object_size'] = int(conf.get('output_cache_ram_object_size',
+                                                        1024 * 1024))
 
     def swift_functions(app):
         return FunctionHandlerMiddleware(app, conf)
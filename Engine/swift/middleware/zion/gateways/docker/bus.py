@@ -10,6 +10,7 @@ class Bus(object):
               to be used with Python
     '''
     BUS_SO_NAME = '/opt/zion/runtime/java/lib/bus.so'
+    _instance = None  # Loaded library shared by all the sends
 
     def __init__(self):
         '''@summary:             CTOR
@@ -154,8 +155,9 @@ class Bus(object):
 
         # Serialize the datagram into JSON strings and C integer array
         str_json_params = datagram.get_params_and_cmd_as_json()
-        p_params = c_char_p(str_json_params.encode('utf-8'))
-        n_params = c_int(len(str_json_params))
+        bytes_params = str_json_params.encode('utf-8')
+        p_params = c_char_p(bytes_params)
+        n_params = c_int(len(bytes_params))
 
         n_files = c_int(0)
         h_files = None
@@ -164,8 +166,9 @@ class Bus(object):
 
         if datagram.get_num_files() > 0:
             str_json_metadata = datagram.get_files_metadata_as_json()
-            p_metadata = c_char_p(str_json_metadata.encode('utf-8'))
-            n_metadata = c_int(len(str_json_metadata))
+            bytes_metadata = str_json_metadata.encode('utf-8')
+            p_metadata = c_char_p(bytes_metadata)
+            n_metadata = c_int(len(bytes_metadata))
 
             n_fds = datagram.get_num_files()
             n_files = c_int(n_fds)
@@ -177,7 +180,9 @@ class Bus(object):
                 h_files[i] = file_fds[i]
 
         # Invoke C function
-        bus = Bus()
+        if Bus._instance is None:
+            Bus._instance = Bus()
+        bus = Bus._instance
         n_status = bus.bus_back_.bus_send_msg(bus_name.encode('utf-8'),
                                               h_files,
                                               n_files,
@@ -0,0 +1,213 @@
+from zion.gateways.docker.green_bus import GreenBus, pack_datagram
+from zion.gateways.docker.datagram import Datagram, SBUS_CMD_DESCRIPTOR, SBUS_CMD_EXECUTE, \
+    DATAGRAM_V1, DATAGRAM_V2
+from zion.gateways.docker.frame import unpack_frame
+from eventlet.green import socket
+from eventlet.hubs import trampoline
+from eventlet.semaphore import Semaphore
+from eventlet.timeout import Timeout
+from eventlet.queue import Queue, Empty
+import eventlet
+import array
+import time
+
+# Must hold a command frame with an inline output
+MAX_RECORD_SIZE = 256 * 1024
+# Inline data leaves room for the JSON payload of its frame
+MAX_INLINE_SIZE = MAX_RECORD_SIZE - 64 * 1024
+CHANNEL_HELLO_TIMEOUT = 1  # seconds
+CHANNEL_RETRY_INTERVAL = 60  # seconds
+
+# Open channels of this gateway process, by worker bus path
+_channels = dict()
+_unsupported = dict()
+_channels_lock = Semaphore()
+
+
+class Invocation:
+    """
+    An in-flight invocation multiplexed over a worker channel.
+    """
+
+    def __init__(self, channel, invocation_id):
+        self.channel = channel
+        self.id = invocation_id
+        self.commands = Queue()
+        self.started = False
+        self.finished = False
+
+    def put_record(self, record):
+        if 'event' in record:
+            if record['event'] == 'STARTED':
+                self.started = True
+            elif record['event'] == 'END':
+                self.finished = True
+                self.close()
+        else:
+            self.commands.put(record)
+
+    def get_command(self, timeout):
+        """
+        Waits for the next command sent by the function.
+
+        :param timeout: seconds to wait
+        :raises Timeout: if the function does not send any command in time
+        :returns: command dictionary
+        """
+        try:
+            return self.commands.get(timeout=timeout)
+        except Empty:
+            raise Timeout('Timeout while waiting for Function output')
+
+    def close(self):
+        self.channel.invocations.pop(self.id, None)
+
+
+class Channel:
+    """
+    Long-lived control channel between this gateway process and a worker.
+
+    A SEQPACKET socket pair is created and one end is handed to the worker
+    through its bus. Afterwards, each invocation is one framed message with
+    its data fds, and the worker replies with command frames tagged with the
+    invocation id over the same socket.
+    """
+
+    def __init__(self, bus_path, logger):
+        self.bus_path = bus_path
+        self.logger = logger
+        self.sock = None
+        self.closed = False
+        self.invocations = dict()
+        self.next_id = 0
+        self.worker_info = dict()
+        self.datagram_version = DATAGRAM_V1
+
+    def open(self):
+        """
+        Hands one end of the channel to the worker and waits for its hello.
+
+        :raises Exception: if the worker does not support channels
+        """
+        self.sock, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            dtg = Datagram()
+            dtg.set_files([remote.fileno()])
+            dtg.set_metadata([{'type': 'CHANNEL_FD'}])
+            dtg.set_command(SBUS_CMD_DESCRIPTOR)
+            rc = GreenBus.send(self.bus_path, dtg)
+        finally:
+            remote.close()
+
+        try:
+            if (rc < 0):
+                raise Exception("Failed to send channel to the worker")
+            self.sock.settimeout(CHANNEL_HELLO_TIMEOUT)
+            hello = unpack_frame(self.sock.recv(MAX_RECORD_SIZE))
+            if hello.get('event') != 'HELLO':
+                raise Exception("Unexpected channel handshake: " + str(hello))
+            self.worker_info = hello
+            if DATAGRAM_V2 in hello.get('datagram_versions', []):
+                self.datagram_version = DATAGRAM_V2
+            self.sock.settimeout(None)
+        except Exception:
+            self.sock.close()
+            self.closed = True
+            raise
+
+        eventlet.spawn_n(self._reader)
+        self.logger.info('Channel - Opened channel to ' + self.bus_path)
+
+    def _reader(self):
+        try:
+            while True:
+                data = self.sock.recv(MAX_RECORD_SIZE)
+                if not data:
+                    break
+                record = unpack_frame(data)
+                invocation = self.invocations.get(record.get('id'))
+                if invocation:
+                    invocation.put_record(record)
+        except Exception:
+            self.logger.exception('Channel - Error reading from ' + self.bus_path)
+        finally:
+            self.close()
+
+    def _send(self, message, fds):
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+        while True:
+            try:
+                return self.sock.sendmsg([message], ancdata)
+            except BlockingIOError:
+                trampoline(self.sock, write=True)
+
+    def invoke(self, fds, fdmd, version=DATAGRAM_V1):
+        """
+        Sends an invocation to the worker.
+
+        :param fds: remote side file descriptors
+        :param fdmd: metadata of the file descriptors
+        :param version: wire format of the metadata, supported by the worker
+        :returns: Invocation instance to read the function commands from
+        """
+        self.next_id += 1
+        invocation = Invocation(self, str(self.next_id))
+        self.invocations[invocation.id] = invocation
+
+        dtg = Datagram()
+        dtg.set_files(fds)
+        dtg.set_metadata(fdmd)
+        dtg.set_command(SBUS_CMD_EXECUTE)
+        dtg.set_task_id(invocation.id)
+        dtg.set_version(version)
+        try:
+            self._send(pack_datagram(dtg), dtg.get_files())
+        except Exception:
+            invocation.close()
+            self.close()
+            raise
+
+        return invocation
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if _channels.get(self.bus_path) is self:
+            del _channels[self.bus_path]
+        self.sock.close()
+        for invocation in list(self.invocations.values()):
+            invocation.put_record({'cmd': 'RE', 'message': 'Worker channel closed'})
+            invocation.close()
+        self.logger.info('Channel - Closed channel to ' + self.bus_path)
+
+
+def get_channel(bus_path, logger):
+    """
+    Returns the open channel to a worker, opening it if needed.
+
+    :param bus_path: bus path of the worker
+    :param logger: logger instance
+    :returns: Channel instance, or None if the worker does not support it
+    """
+    channel = _channels.get(bus_path)
+    if channel and not channel.closed:
+        return channel
+
+    with _channels_lock:
+        channel = _channels.get(bus_path)
+        if channel and not channel.closed:
+            return channel
+        if _unsupported.get(bus_path, 0) > time.time():
+            return None
+
+        channel = Channel(bus_path, logger)
+        try:
+            channel.open()
+        except Exception as e:
+            logger.warning('Channel - Unable to open channel to ' + bus_path + ': ' + str(e))
+            _unsupported[bus_path] = time.time() + CHANNEL_RETRY_INTERVAL
+            return None
+
+        _channels[bus_path] = channel
+        return channel
@@ -1,11 +1,136 @@
 import json
 import os
+import struct
 from io import IOBase
 import syslog
 
 SBUS_FD_OUTPUT_OBJECT = 1
+
+# Commands, synchronized with BusDatagram.eStorletCommand
+SBUS_CMD_HALT = 0
+SBUS_CMD_EXECUTE = 1
+SBUS_CMD_START_DAEMON = 2
+SBUS_CMD_STOP_DAEMON = 3
+SBUS_CMD_DAEMON_STATUS = 4
+SBUS_CMD_STOP_DAEMONS = 5
+SBUS_CMD_PING = 6
+SBUS_CMD_DESCRIPTOR = 7
+SBUS_CMD_CANCEL = 8
 SBUS_CMD_NOP = 9
 
+# Files metadata wire formats. Version 1 is JSON encoded twice; version 2
+# is a single pass binary encoding, synchronized with BusDatagram:
+#   u8 version, u16 number of files and, for each file, u16 number of
+#   fields followed by (key, kind, value). Values are strings or, for the
+#   MAP kind, u16 number of pairs followed by (key, value) strings.
+#   Strings are an u32 length and the UTF-8 bytes, or an u32 index in
+#   STRING_TABLE with the STRING_INDEX_FLAG bit set.
+DATAGRAM_V1 = 1
+DATAGRAM_V2 = 2
+FIELD_STRING = 0
+FIELD_MAP = 1
+STRING_INDEX_FLAG = 0x80000000
+STRING_TABLE = ['type', 'OUTPUT_FD', 'COMMAND_FD', 'INPUT_FD', 'CHANNEL_FD',
+                'inline', 'inline_output_max_size', 'true', 'false',
+                'object_metadata', 'request_headers', 'parameters',
+                'Content-Length', 'Content-Type', 'Etag', 'Last-Modified',
+                'X-Timestamp', 'X-Backend-Timestamp', 'X-Trans-Id',
+                'X-Openstack-Request-Id', 'X-Auth-Token', 'X-Storage-Token',
+                'Host', 'User-Agent', 'Accept', 'Accept-Encoding',
+                'X-Current-Server', 'X-Current-Location', 'X-Method',
+                'X-Project-Id', 'X-Container', 'X-Object', 'object', 'proxy',
+                'get', 'put', 'application/octet-stream']
+_STRING_INDEX = dict((value, i) for i, value in enumerate(STRING_TABLE))
+_V2_HEADER = struct.Struct('!BH')
+_V2_COUNT = struct.Struct('!H')
+_V2_KIND = struct.Struct('!B')
+_V2_STRING = struct.Struct('!I')
+
+
+def _metadata_value(value):
+    # Same textual values the JSON parser of the runtime produces
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def _pack_string(out, value):
+    index = _STRING_INDEX.get(value)
+    if index is not None:
+        out += _V2_STRING.pack(STRING_INDEX_FLAG | index)
+    else:
+        data = value.encode('utf-8')
+        out += _V2_STRING.pack(len(data))
+        out += data
+
+
+def _unpack_string(data, offset):
+    length = _V2_STRING.unpack_from(data, offset)[0]
+    offset += _V2_STRING.size
+    if length & STRING_INDEX_FLAG:
+        return STRING_TABLE[length & ~STRING_INDEX_FLAG], offset
+    return bytes(data[offset:offset + length]).decode('utf-8'), offset + length
+
+
+def pack_files_metadata_v2(files_metadata):
+    """
+    Encodes the metadata of the files with the version 2 format.
+
+    :param files_metadata: list of dictionaries. Values are strings, or
+                           dictionaries of strings
+    :returns: bytes of the encoded metadata
+    """
+    out = bytearray(_V2_HEADER.pack(DATAGRAM_V2, len(files_metadata)))
+    for md in files_metadata:
+        out += _V2_COUNT.pack(len(md))
+        for key, value in md.items():
+            _pack_string(out, str(key))
+            if isinstance(value, dict):
+                out += _V2_KIND.pack(FIELD_MAP)
+                out += _V2_COUNT.pack(len(value))
+                for map_key, map_value in value.items():
+                    _pack_string(out, str(map_key))
+                    _pack_string(out, _metadata_value(map_value))
+            else:
+                out += _V2_KIND.pack(FIELD_STRING)
+                _pack_string(out, _metadata_value(value))
+    return bytes(out)
+
+
+def unpack_files_metadata_v2(data):
+    """
+    Decodes metadata encoded with pack_files_metadata_v2.
+
+    :param data: bytes of the encoded metadata
+    :raises ValueError: if the data is not in the version 2 format
+    :returns: list of dictionaries
+    """
+    version, n_files = _V2_HEADER.unpack_from(data)
+    if version != DATAGRAM_V2:
+        raise ValueError('Unsupported datagram version: ' + str(version))
+    offset = _V2_HEADER.size
+    files_metadata = []
+    for _ in range(n_files):
+        md = {}
+        n_fields = _V2_COUNT.unpack_from(data, offset)[0]
+        offset += _V2_COUNT.size
+        for _ in range(n_fields):
+            key, offset = _unpack_string(data, offset)
+            kind = _V2_KIND.unpack_from(data, offset)[0]
+            offset += _V2_KIND.size
+            if kind == FIELD_MAP:
+                value = {}
+                n_pairs = _V2_COUNT.unpack_from(data, offset)[0]
+                offset += _V2_COUNT.size
+                for _ in range(n_pairs):
+                    map_key, offset = _unpack_string(data, offset)
+                    value[map_key], offset = _unpack_string(data, offset)
+            else:
+                value, offset = _unpack_string(data, offset)
+            md[key] = value
+        files_metadata.append(md)
+    return files_metadata
+
 
 class Datagram:
 
@@ -28,6 +153,7 @@ class Datagram:
                                is the same as in h_files_, i.e. n_files_.
         '''
         self.e_command_ = SBUS_CMD_NOP
+        self.version_ = DATAGRAM_V1
         self.task_id_ = None
         self.h_files_ = None
         self.n_files_ = 0
@@ -81,11 +207,16 @@ class Datagram:
         '''@summary:                 Extract files_metadata array
                                   of dictionaries form a JSON string
         @requires:                n_files_ has to be se
-        @param str_json_metadata: JSON encoding of file descriptors meta-data.
-        @type  str_json_metadata: String.
+        @param str_json_metadata: JSON encoding of file descriptors meta-data,
+                                  or its version 2 binary encoding.
+        @type  str_json_metadata: String or bytes.
         @rtype:                   void
         '''
-        if self.get_num_files() > 0:
+        if self.get_num_files() > 0 and isinstance(str_json_metadata, bytes) \
+                and str_json_metadata[:1] == bytes([DATAGRAM_V2]):
+            self.version_ = DATAGRAM_V2
+            self.files_metadata_ = unpack_files_metadata_v2(str_json_metadata)
+        elif self.get_num_files() > 0:
             all_metadata = json.loads(str_json_metadata)
             self.files_metadata_ = []
             for i in range(self.get_num_files()):
@@ -154,6 +285,33 @@ class Datagram:
             str_result = json.dumps(all_metadata)
         return str_result
 
+    def get_files_metadata(self):
+        '''@summary: Encode the files meta-data with the datagram version.
+        @return:  The encoded meta-data, None if there are no files.
+        @rtype:   bytes
+        '''
+        if self.get_num_files() == 0:
+            return None
+        if self.version_ == DATAGRAM_V2:
+            return pack_files_metadata_v2(self.files_metadata_)
+        return self.get_files_metadata_as_json().encode('utf-8')
+
+    def get_version(self):
+        '''@summary: Getter.
+        @return:  The wire format version of the files meta-data.
+        @rtype:   integer
+        '''
+        return self.version_
+
+    def set_version(self, version):
+        '''@summary:       Setter.
+                        Assign the wire format version of the files meta-data
+        @param version: DATAGRAM_V1 or DATAGRAM_V2
+        @type  version: integer
+        @rtype:         void
+        '''
+        self.version_ = version
+
     def get_num_files(self):
         '''@summary: Getter.
         @return:  The quantity of file descriptors.
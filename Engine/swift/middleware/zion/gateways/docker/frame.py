@@ -0,0 +1,80 @@
+from eventlet.timeout import Timeout
+import select
+import struct
+import json
+import os
+
+# Frame layout: JSON payload length, binary block length (network order),
+# followed by the JSON payload and the optional binary block.
+FRAME_HEADER = struct.Struct('!II')
+
+
+def pack_frame(message, block=b''):
+    """
+    Frames a command message.
+
+    :param message: dictionary to be JSON encoded
+    :param block: optional binary block attached to the message
+    :returns: bytes of the frame
+    """
+    payload = json.dumps(message).encode('utf-8')
+    return FRAME_HEADER.pack(len(payload), len(block)) + payload + block
+
+
+def unpack_frame(data):
+    """
+    Decodes a complete frame.
+
+    :param data: bytes of the frame
+    :raises ValueError: if the frame is truncated
+    :returns: command dictionary. The binary block, if any, is stored
+              under the 'block' key
+    """
+    if len(data) < FRAME_HEADER.size:
+        raise ValueError('Truncated frame header')
+    payload_len, block_len = FRAME_HEADER.unpack_from(data)
+    if len(data) < FRAME_HEADER.size + payload_len + block_len:
+        raise ValueError('Truncated frame')
+
+    start = FRAME_HEADER.size
+    message = json.loads(data[start:start + payload_len].decode())
+    if block_len:
+        start += payload_len
+        message['block'] = bytes(data[start:start + block_len])
+
+    return message
+
+
+def _read_exactly(fd, size, timeout):
+    buf = bytearray()
+    while len(buf) < size:
+        r, _, _ = select.select([fd], [], [], timeout)
+        if len(r) == 0:
+            raise Timeout('Timeout while waiting for Function output')
+        chunk = os.read(fd, size - len(buf))
+        if not chunk:
+            break
+        buf += chunk
+    return buf
+
+
+def read_frame(fd, timeout):
+    """
+    Reads one frame from a stream fd, e.g. the command pipe. The frame is
+    read incrementally, so it can be of any size.
+
+    :param fd: file descriptor to read from
+    :param timeout: seconds to wait for each read
+    :raises ValueError: if the stream is closed before a complete frame
+    :returns: command dictionary
+    """
+    header = _read_exactly(fd, FRAME_HEADER.size, timeout)
+    if not header:
+        raise ValueError('No response from function')
+    if len(header) < FRAME_HEADER.size:
+        raise ValueError('Truncated frame header')
+
+    payload_len, block_len = FRAME_HEADER.unpack(header)
+    body = _read_exactly(fd, payload_len + block_len, timeout)
+
+    return unpack_frame(header + body)
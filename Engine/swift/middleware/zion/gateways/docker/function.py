@@ -1,11 +1,15 @@
 from swift.common.wsgi import make_subrequest
 from zion.common.utils import set_object_metadata, get_object_metadata, make_swift_request
+from zion.common.cache import CACHEABLE_HEADER
+from distutils.util import strtobool
 import tarfile
 import os
 
 TIMEOUT_HEADER = "X-Object-Meta-Function-Timeout"
 MEMORY_HEADER = "X-Object-Meta-Function-Memory"
 MAIN_HEADER = "X-Object-Meta-Function-Main"
+MAX_CONCURRENCY_HEADER = "X-Object-Meta-Function-Max-Concurrency"
+SPOOL_HEADER = "X-Object-Meta-Function-Spool"
 
 
 class Function:
@@ -105,8 +109,17 @@ class Function:
             self.logger.info('Function - It is not possible to update the local cache')
             raise FileNotFoundError
 
-        with open(self.cached_function_obj, 'wb') as fn:
-            fn.write(resp.body)
+        # Streamed to a temporary file, so a failed download never
+        # leaves a truncated function in the cache
+        tmp_function_obj = self.cached_function_obj + '.tmp'
+        try:
+            with open(tmp_function_obj, 'wb') as fn:
+                for chunk in resp.app_iter:
+                    fn.write(chunk)
+            os.rename(tmp_function_obj, self.cached_function_obj)
+        finally:
+            if hasattr(resp.app_iter, 'close'):
+                resp.app_iter.close()
 
         self.logger.info('Function - Local cache updated: '+self.cached_function_obj)
 
@@ -137,6 +150,11 @@ class Function:
             self.memory = int(function_metadata[MEMORY_HEADER])
             self.timeout = int(function_metadata[TIMEOUT_HEADER])
             self.main_class = function_metadata[MAIN_HEADER]
+            self.max_concurrency = int(function_metadata.get(
+                MAX_CONCURRENCY_HEADER, self.conf['default_function_max_concurrency']))
+            self.cacheable = strtobool(function_metadata.get(CACHEABLE_HEADER, 'False'))
+            self.etag = function_metadata.get('Etag')
+            self.spooled = strtobool(function_metadata.get(SPOOL_HEADER, 'False'))
 
     def open_log(self):
         """
@@ -157,6 +175,18 @@ class Function:
     def get_memory(self):
         return self.memory
 
+    def get_max_concurrency(self):
+        return self.max_concurrency
+
+    def is_cacheable(self):
+        return self.cacheable
+
+    def get_etag(self):
+        return self.etag
+
+    def is_spooled(self):
+        return self.spooled
+
     def get_logfd(self):
         return self.logger_file.fileno()
 
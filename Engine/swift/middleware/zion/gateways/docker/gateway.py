@@ -1,6 +1,8 @@
 from zion.gateways.docker.protocol import Protocol
 from zion.gateways.docker.function import Function
-from zion.gateways.docker.worker import Worker
+from zion.gateways.docker.worker import Worker, WorkerUnavailable
+from zion.common.utils import get_deadline, get_priority, HTTPGatewayTimeout
+from io import BytesIO
 import time
 
 
@@ -17,6 +19,7 @@ class DockerGateway:
         self.method = self.req.method.lower()
         self.functions_container = self.conf["functions_container"]
         self.execution_server = self.conf["execution_server"]
+        self.functions = dict()
 
         self.logger.info('DockerGateway - DockerGateway instance created')
 
@@ -43,16 +46,69 @@ class DockerGateway:
 
         return headers
 
-    def execute_function(self, function_info):
+    def _get_inline_object(self, object_stream, object_metadata):
+        """
+        Reads small objects in the gateway, so they can be sent to the
+        worker in a single fd. The request/response is updated to keep
+        the read data available.
+
+        :returns: the object data, or None if it is not small enough
+        """
+        if hasattr(object_stream, '_fp'):
+            # The worker will read directly from the disk file
+            return None
+        length = object_metadata.get('Content-Length')
+        if length is None or int(length) > self.conf['inline_object_max_size']:
+            return None
+
+        self.logger.info('DockerGateway - Reading small object inline')
+        if self.method == 'get':
+            data = b''.join(object_stream)
+            if hasattr(object_stream, 'close'):
+                object_stream.close()
+            self.response.app_iter = [data]
+        else:
+            data = object_stream.read(int(length))
+            self.req.environ['wsgi.input'] = BytesIO(data)
+
+        return data
+
+    def get_function(self, f_name):
+        """
+        Loads a function once per request.
+
+        :param f_name: function object name
+        :returns: Function instance
+        """
+        if f_name not in self.functions:
+            self.functions[f_name] = Function(self.conf, self.app, self.req, self.account,
+                                              self.logger, f_name)
+        return self.functions[f_name]
+
+    def execute_function(self, function_info, object_stream=None, input_range=None):
         """
         Executes the function.
 
         :param function_info: function information
+        :param object_stream: stream to send to the function, instead of the
+                              object of the request
+        :param input_range: (offset, length) of the object to send to the
+                            function, if it is passed as a disk file fd
         :returns: response from the function
         """
         self.logger.info('DockerGateway - Executing function')
-        object_stream = self._get_object_stream()
+        deadline = get_deadline(self.req.headers)
+        if deadline is not None and deadline <= time.time():
+            # The client already gave up
+            msg = 'DockerGateway - Deadline expired before running the function'
+            self.logger.info(msg)
+            raise HTTPGatewayTimeout(msg + '\n')
         object_metadata = self._get_object_metadata()
+        if object_stream is None:
+            object_stream = self._get_object_stream()
+            inline_data = self._get_inline_object(object_stream, object_metadata)
+            if inline_data is not None:
+                object_stream = inline_data
         request_headers = dict(self.req.headers)
 
         f_name = list(function_info.keys())[0]
@@ -63,24 +119,36 @@ class DockerGateway:
             function_parameters = dict()
 
         time1 = time.time()
-        function = Function(self.conf, self.app, self.req, self.account, self.logger, f_name)
+        function = self.get_function(f_name)
         time2 = time.time()
         fc = time2-time1
         self.logger.info('------> FUNCTION took %0.6fs' % ((time2-time1)))
 
-        time1 = time.time()
-        worker = Worker(self.conf, self.account, self.logger, self.redis, function)
-        time2 = time.time()
-        wkr = time2-time1
-        self.logger.info('------> WORKER took %0.6fs' % ((time2-time1)))
-
-        time1 = time.time()
-        protocol = Protocol(self.logger, worker, object_stream, object_metadata,
-                            request_headers, function_parameters)
-        resp = protocol.comunicate()
-        time2 = time.time()
-        ptc = time2-time1
-        self.logger.info('------> PROTOCOL took %0.6fs' % ((time2-time1)))
+        retries = self.conf['worker_invoke_retries']
+        for attempt in range(retries + 1):
+            time1 = time.time()
+            worker = Worker(self.conf, self.account, self.logger, self.redis, function,
+                            deadline, get_priority(self.req.headers))
+            time2 = time.time()
+            wkr = time2-time1
+            self.logger.info('------> WORKER took %0.6fs' % ((time2-time1)))
+
+            time1 = time.time()
+            protocol = Protocol(self.conf, self.logger, worker, object_stream, object_metadata,
+                                dict(request_headers), function_parameters, input_range)
+            try:
+                resp = protocol.comunicate()
+            except WorkerUnavailable:
+                # Nothing was read from the object stream yet
+                worker.remove()
+                if attempt == retries:
+                    raise
+                self.logger.warning('DockerGateway - Retrying invocation on another worker')
+                continue
+            time2 = time.time()
+            ptc = time2-time1
+            self.logger.info('------> PROTOCOL took %0.6fs' % ((time2-time1)))
+            break
 
         total = fc + wkr + ptc
 
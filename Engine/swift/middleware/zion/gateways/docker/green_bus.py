@@ -0,0 +1,142 @@
+from zion.gateways.docker.datagram import Datagram
+from eventlet.hubs import trampoline
+import socket
+import struct
+import array
+import os
+
+# Same layout as dump_data_to_bytestream in bus.c: number of files,
+# metadata length and params length (native integers), followed by the
+# metadata and params JSON strings and a terminating NULL.
+BUS_HEADER = struct.Struct('iii')
+MAX_MSG_LENGTH = 4096  # Receive buffer of bus_recv_msg
+MAX_FDS = 4096
+
+
+def pack_datagram(dtg):
+    """
+    Serializes a datagram with the same layout used by bus_send_msg.
+
+    :param dtg: Datagram instance
+    :returns: bytes of the message
+    """
+    params = dtg.get_params_and_cmd_as_json().encode('utf-8')
+    metadata = dtg.get_files_metadata() or b''
+    header = BUS_HEADER.pack(dtg.get_num_files(), len(metadata), len(params))
+
+    return header + metadata + params + b'\0'
+
+
+def recv_fds(sock, bufsize, maxfds):
+    """
+    Receives a message and the file descriptors sent with it, as
+    socket.recv_fds, which is only available from Python 3.9.
+
+    :param sock: socket
+    :param bufsize: max bytes of the message
+    :param maxfds: max number of file descriptors
+    :returns: (data, fds) tuple
+    """
+    fds = array.array('i')
+    data, ancdata, _, _ = sock.recvmsg(bufsize, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, cmsg_type, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            # Ignore a truncated trailing int
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    return data, list(fds)
+
+
+def unpack_datagram(data, fds):
+    """
+    Deserializes a message with the layout used by bus_recv_msg.
+
+    :param data: bytes of the message
+    :param fds: file descriptors received with the message
+    :raises ValueError: if the message is truncated
+    :returns: Datagram instance
+    """
+    if len(data) < BUS_HEADER.size:
+        raise ValueError('Truncated bus message')
+    n_files, n_metadata, n_params = BUS_HEADER.unpack_from(data)
+    if len(data) < BUS_HEADER.size + n_metadata + n_params:
+        raise ValueError('Truncated bus message')
+
+    offset = BUS_HEADER.size
+    metadata = None
+    if n_metadata > 0:
+        metadata = bytes(data[offset:offset + n_metadata])
+    offset += n_metadata
+    params = bytes(data[offset:offset + n_params])
+
+    dtg = Datagram()
+    dtg.from_raw_data(list(fds[:n_files]), metadata, params)
+    return dtg
+
+
+class GreenBus(object):
+    '''@summary: Native Python implementation of the Bus, interoperable with
+              bus.so and BusJNI. Sockets are non-blocking and wait in
+              the eventlet hub, so sending a datagram never stalls other
+              green threads.
+    '''
+
+    @staticmethod
+    def create(bus_name):
+        '''@summary:        Bind a Bus to a path.
+        @param bus_name: Path to domain socket "file".
+        @type  bus_name: string
+        @return:         The bound socket.
+        @rtype:          socket
+        '''
+        if os.path.exists(bus_name):
+            os.unlink(bus_name)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(bus_name)
+        os.chmod(bus_name, 0o777)
+        sock.setblocking(False)
+        return sock
+
+    @staticmethod
+    def receive(sock):
+        '''@summary:    Wait for a datagram on a bound Bus.
+        @param sock: Socket returned by create.
+        @type  sock: socket
+        @return:     The received datagram.
+        @rtype:      Datagram
+        '''
+        while True:
+            try:
+                data, fds = recv_fds(sock, MAX_MSG_LENGTH, MAX_FDS)
+                return unpack_datagram(data, fds)
+            except BlockingIOError:
+                trampoline(sock, read=True)
+
+    @staticmethod
+    def send(bus_name, datagram):
+        '''@summary:         Send the datagram through Bus.
+        @param bus_name:  Path to domain socket "file".
+        @type  bus_name:  string
+        @param datagram:  The object to send
+        @type  datagram:  Datagram
+        @return:          Status of the operation: sent bytes or -1
+        @rtype:           integer
+        '''
+        message = pack_datagram(datagram)
+        ancdata = []
+        if datagram.get_num_files() > 0:
+            ancdata.append((socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                            array.array('i', datagram.get_files())))
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            while True:
+                try:
+                    # socket.send_fds ignores the address of unconnected sockets
+                    return sock.sendmsg([message], ancdata, 0, bus_name)
+                except BlockingIOError:
+                    trampoline(sock, write=True)
+        except OSError:
+            return -1
+        finally:
+            sock.close()
@@ -1,7 +1,10 @@
-from zion.gateways.docker.bus import Bus
-from zion.gateways.docker.datagram import Datagram
-from eventlet.timeout import Timeout
-import select
+from zion.gateways.docker.green_bus import GreenBus
+from zion.gateways.docker.datagram import Datagram, DATAGRAM_V1, DATAGRAM_V2
+from zion.gateways.docker.channel import get_channel
+from zion.gateways.docker.frame import read_frame
+from zion.gateways.docker.worker import WorkerUnavailable
+from zion.common.utils import set_pipe_size, get_splice_fd, splice_data, write_data, \
+    create_sealed_memfd, get_deadline, get_priority, time_left
 import eventlet
 import json
 import os
@@ -12,14 +15,17 @@ eventlet.monkey_patch()
 
 class Protocol:
 
-    def __init__(self, logger, worker, object_stream, object_metadata,
-                 request_headers, function_parameters):
+    def __init__(self, conf, logger, worker, object_stream, object_metadata,
+                 request_headers, function_parameters, input_range=None):
+        self.conf = conf
         self.worker = worker
         self.object_stream = object_stream
         self.object_metadata = object_metadata
         self.request_headers = request_headers
         self.function_parameters = function_parameters
+        self.input_range = input_range  # (offset, length) of the object to read
         self.function_timeout = self.worker.function.get_timeout()
+        self.deadline = get_deadline(request_headers)
         self.logger = logger
         self.function_name = self.worker.function.get_name()
 
@@ -37,11 +43,18 @@ class Protocol:
         self.input_data_read_fd = None  # Data from the object - remote
         self.input_data_write_fd = None  # Data from the object - local
         self.internal_pipe = False
+        self.inline_input = False  # Small object already read, sent in a memfd
+
+        # persistent channel to the worker, replaces the command pipe
+        self.channel = None
+        self.invocation = None
+        self.datagram_version = DATAGRAM_V1
 
         self.logger.info('Protocol - Protocol instance created')
 
     def _add_output_object_stream(self):
         self.output_data_read_fd, self.output_data_write_fd = os.pipe()
+        set_pipe_size(self.output_data_read_fd, self.conf['pipe_size'])
         self.fds.append(self.output_data_write_fd)
         md = dict()
         md['type'] = "OUTPUT_FD"
@@ -61,9 +74,15 @@ class Protocol:
         # Actual object from swift passed to function
         if hasattr(self.object_stream, '_fp'):
             self.input_data_read_fd = self.object_stream._fp.fileno()
+        elif isinstance(self.object_stream, bytes) and hasattr(os, 'memfd_create'):
+            # Small object read by the gateway: no writer thread nor DR round trip
+            self.inline_input = True
+            self.input_data_read_fd = create_sealed_memfd(self.object_stream)
         else:
             self.internal_pipe = True
             self.input_data_read_fd, self.input_data_write_fd = os.pipe()
+            set_pipe_size(self.input_data_write_fd, self.conf['pipe_size'])
+            os.set_blocking(self.input_data_write_fd, False)
 
         self.fds.append(self.input_data_read_fd)
 
@@ -73,19 +92,35 @@ class Protocol:
         if "Cookie" in self.request_headers:
             del self.request_headers['Cookie']
 
-        metadata = {'request_headers': self.request_headers,
-                    'object_metadata': self.object_metadata,
-                    'parameters': self.function_parameters}
-
         md = dict()
         md['type'] = "INPUT_FD"
-        md['data'] = json.dumps(metadata)
+        if self.datagram_version == DATAGRAM_V2:
+            # Sections are encoded as maps, without nested JSON
+            md['request_headers'] = dict(self.request_headers)
+            md['object_metadata'] = dict(self.object_metadata)
+            md['parameters'] = self.function_parameters or {}
+        else:
+            metadata = {'request_headers': self.request_headers,
+                        'object_metadata': self.object_metadata,
+                        'parameters': self.function_parameters}
+            md['data'] = json.dumps(metadata)
+        md['inline'] = self.inline_input
+        if self.input_range and hasattr(self.object_stream, '_fp'):
+            # The worker reads the range from the disk file fd
+            md['input_offset'], md['input_length'] = self.input_range
+        md['inline_output_max_size'] = self.conf['inline_output_max_size']
+        if self.deadline is not None:
+            # The worker does not start functions past the deadline
+            md['deadline'] = str(self.deadline)
+        # The worker runs queued interactive invocations first
+        md['priority'] = get_priority(self.request_headers)
         self.fdmd.append(md)
 
     def _prepare_invocation_fds(self):
         self.logger.info('Protocol - preparing invoke fds')
         self._add_output_object_stream()
-        self._add_output_command_stream()
+        if not self.channel:
+            self._add_output_command_stream()
         self._add_input_object_stream()
 
     def _close_local_side_descriptors(self):
@@ -98,64 +133,86 @@ class Protocol:
             os.close(self.output_data_write_fd)
         if self.command_write_fd:
             os.close(self.command_write_fd)
-        if self.internal_pipe and self.input_data_read_fd:
+        if (self.internal_pipe or self.inline_input) and self.input_data_read_fd:
             os.close(self.input_data_read_fd)
 
     def _invoke(self):
         self.logger.info('Protocol - Invoking function')
+        if self.channel:
+            try:
+                self.invocation = self.channel.invoke(self.fds, self.fdmd,
+                                                      self.datagram_version)
+            except Exception as e:
+                raise WorkerUnavailable("Failed to send data to function: " + str(e))
+            return
+
         dtg = Datagram()
         dtg.set_files(self.fds)
         dtg.set_metadata(self.fdmd)
         dtg.set_command(1)
         # Send datagram to function worker
         channel = self.worker.get_channel()
-        rc = Bus.send(channel, dtg)
+        rc = GreenBus.send(channel, dtg)
         if (rc < 0):
-            raise Exception("Failed to send data to function")
-
-    def _wait_for_read_with_timeout(self, fd):
-        r, _, _ = select.select([fd], [], [], self.function_timeout)
-        if len(r) == 0:
-            raise Timeout('Timeout while waiting for Function output')
-        if fd in r:
-            return
+            raise WorkerUnavailable("Failed to send data to function")
 
     def _send_data_to_function(self):
-        if self.internal_pipe:
-            eventlet.spawn_n(self._write_input_data,
-                             self.input_data_write_fd,
-                             self.object_stream)
+        if self.internal_pipe and self.input_data_write_fd:
+            source_fd = None
+            if self.conf['splice_data_plane']:
+                source_fd = get_splice_fd(self.object_stream)
+            if source_fd is not None:
+                eventlet.spawn_n(self._splice_input_data,
+                                 self.input_data_write_fd,
+                                 source_fd)
+            else:
+                eventlet.spawn_n(self._write_input_data,
+                                 self.input_data_write_fd,
+                                 self.object_stream)
+            # The writer green thread owns the fd from now on
+            self.input_data_write_fd = None
+
+    def _splice_input_data(self, w_fd, source_fd):
+        try:
+            splice_data(source_fd, w_fd, time_left(self.deadline, self.function_timeout))
+        except Exception:
+            self.logger.exception('Unexpected error at splicing input data')
+        finally:
+            os.close(w_fd)
 
     def _write_input_data(self, w_fd, data_iter):
         try:
-            writer = os.fdopen(w_fd, 'w')
             for chunk in data_iter:
-                with Timeout(self.function_timeout):
-                    writer.write(chunk)
-            writer.close()
+                write_data(w_fd, chunk, time_left(self.deadline, self.function_timeout))
         except Exception:
             self.logger.exception('Unexpected error at writing input data')
+        finally:
+            os.close(w_fd)
+
+    def _read_command(self):
+        """
+        Reads the next command sent by the function, either from the
+        worker channel or from the command pipe
+        """
+        timeout = time_left(self.deadline, self.function_timeout)
+        if self.invocation:
+            return self.invocation.get_command(timeout)
+
+        return read_frame(self.command_read_fd, timeout)
 
     def _read_response(self):
         self.logger.info('Protocol - Reading response from function')
         f_resp = dict()
 
         try:
-            self._wait_for_read_with_timeout(self.command_read_fd)
-            flat_json = os.read(self.command_read_fd, 12).decode()
-
-            if flat_json:
-                f_resp = json.loads(flat_json)
-                self.logger.info('Protocol - Received response: ' + str(f_resp))
-            else:
-                raise ValueError('No response from function')
+            f_resp = self._read_command()
+            self.logger.info('Protocol - Received response: ' + str(f_resp))
 
         except Exception as e:
             f_resp['cmd'] = 'RE'  # Request Error
             f_resp['message'] = ('Error running ' + self.function_name +
                                  ' function: ' + str(e))
 
-        # TODO: read extra data from pipe
         out_data = dict()
         command = f_resp['cmd']
 
@@ -167,7 +224,16 @@ class Protocol:
         if command == 'DW':
             # Data Write
             out_data['command'] = command
-            out_data['fd'] = self.output_data_read_fd
+            if 'inline_length' in f_resp:
+                # Small output returned in the command frame
+                out_data['data'] = f_resp.get('block', b'')
+            else:
+                out_data['fd'] = self.output_data_read_fd
+                if 'content_length' in f_resp:
+                    # Output length declared by the function
+                    out_data['content_length'] = int(f_resp['content_length'])
+                # The worker slot is freed once the output is consumed
+                out_data['close_callback'] = self.worker.release
 
         if command == 'RE':
             # Request Error
@@ -189,24 +255,45 @@ class Protocol:
             out_data['request_headers'] = f_resp['request_headers']
         if 'response_headers' in f_resp:
             out_data['response_headers'] = f_resp['response_headers']
+        if 'block' in f_resp and 'data' not in out_data:
+            out_data['block'] = f_resp['block']
 
-        if out_data['command'] != 'DW':
+        if 'fd' not in out_data:
             self._close_local_side_descriptors()
+            self.worker.release()
 
         return out_data
 
     def comunicate(self):
         self.logger.info('Protocol - Communicating with the worker to run the function')
+        if self.conf['persistent_channels']:
+            self.channel = get_channel(self.worker.get_channel(), self.logger)
+        if self.channel and self.conf['binary_datagrams']:
+            self.datagram_version = self.channel.datagram_version
         self._prepare_invocation_fds()
 
         try:
             self._invoke()
         except Exception as e:
+            self.worker.release()
+            self._close_local_side_descriptors()
+            if self.input_data_write_fd:
+                os.close(self.input_data_write_fd)
+                self.input_data_write_fd = None
+            if self.command_read_fd:
+                os.close(self.command_read_fd)
             raise e
         finally:
             self._close_remote_side_descriptors()
 
         out_data = self._read_response()
-        os.close(self.command_read_fd)
+        if self.input_data_write_fd:
+            # The function did not read the input data
+            os.close(self.input_data_write_fd)
+            self.input_data_write_fd = None
+        if self.invocation:
+            self.invocation.close()
+        else:
+            os.close(self.command_read_fd)
 
         return out_data
@@ -1,23 +1,109 @@
-from zion.gateways.docker.bus import Bus
-from zion.gateways.docker.datagram import Datagram
-import shutil
+from zion.gateways.docker.green_bus import GreenBus
+from zion.gateways.docker.datagram import Datagram, SBUS_CMD_DAEMON_STATUS, SBUS_CMD_PING
+from zion.common.utils import INTERACTIVE, BATCH
+from swift.common.swob import HTTPServiceUnavailable
+import eventlet
 import random
+import select
+import shutil
+import json
+import time
 import os
 
+QUEUED_INVOCATIONS_KEY = 'queued_invocations'
+QUEUED_INTERACTIVE_INVOCATIONS_KEY = 'queued_invocations:interactive'
+SLOT_POLL_INTERVAL = 0.05  # seconds, doubled after each poll
+SLOT_POLL_MAX_INTERVAL = 1  # seconds
+
+# Time of the last answered ping, by worker channel
+_live_workers = dict()
+
+
+class WorkerUnavailable(Exception):
+    """
+    The invocation could not be sent to the worker. No data was read by
+    the function, so it can be sent to another worker.
+    """
+    pass
+
+
+def ping_worker(channel, timeout=1):
+    """
+    Checks that the runtime of a worker answers on its bus.
+
+    :param channel: bus channel of the worker
+    :param timeout: seconds to wait for the answer
+    :returns: whether the worker answered
+    """
+    read_fd, write_fd = os.pipe()
+    try:
+        dtg = Datagram.create_service_datagram(SBUS_CMD_PING, write_fd)
+        rc = GreenBus.send(channel, dtg)
+    finally:
+        os.close(write_fd)
+
+    try:
+        if rc < 0:
+            return False
+        r, _, _ = select.select([read_fd], [], [], timeout)
+        return bool(r) and os.read(read_fd, 16) == b'OK'
+    finally:
+        os.close(read_fd)
+
+
+def get_worker_status(channel, timeout=1):
+    """
+    Asks the runtime of a worker for its active and queued invocations.
+
+    :param channel: bus channel of the worker
+    :param timeout: seconds to wait for the status report
+    :returns: dictionary with the 'active', 'queued' and
+              'max_concurrency' values reported by the worker
+    """
+    read_fd, write_fd = os.pipe()
+    try:
+        dtg = Datagram.create_service_datagram(SBUS_CMD_DAEMON_STATUS, write_fd)
+        rc = GreenBus.send(channel, dtg)
+    finally:
+        os.close(write_fd)
+
+    try:
+        if (rc < 0):
+            raise Exception("Failed to send status command")
+        data = b''
+        while True:
+            r, _, _ = select.select([read_fd], [], [], timeout)
+            if not r:
+                raise Exception("Timeout while waiting for worker status")
+            chunk = os.read(read_fd, 4096)
+            if not chunk:
+                break
+            data += chunk
+        return json.loads(data.decode())
+    finally:
+        os.close(read_fd)
+
 
 class Worker:
     """
     Worker main class.
     """
 
-    def __init__(self, conf, account, logger, redis, function):
+    def __init__(self, conf, account, logger, redis, function, deadline=None,
+                 priority=INTERACTIVE):
         self.conf = conf
+        self.deadline = deadline
+        self.priority = priority
         self.account = account
         self.redis = redis
         self.function = function
         self.logger = logger
         self.function_name = function.get_name()
         self.function_obj = function.get_obj_name()
+        self.max_concurrency = function.get_max_concurrency()
+        self.concurrency_limit = self._get_concurrency_limit()
+        self.docker_id = None
+        self.slot_acquired = False
 
         self.scope = self.account[5:18]
 
@@ -28,29 +114,134 @@ class Worker:
         self.docker_dir = self.conf["docker_pool_dir"]
 
         if not self._get_available_worker():
-            self._get_available_docker()
-            self._link_worker_to_docker()
-            self._link_worker_to_function()
-            self._initiate_function()
+            if self.redis.zcard(self.worker_key) == 0:
+                self._get_available_docker()
+                self._link_worker_to_docker()
+                self._link_worker_to_function()
+                self._initiate_function()
+                self._acquire_slot(self.docker_id)
+            else:
+                self._wait_for_available_worker()
+
+    def _get_concurrency_limit(self):
+        """
+        Batch invocations leave a share of the slots of each worker to the
+        interactive ones.
+        """
+        if self.priority != BATCH or self.max_concurrency <= 0:
+            return self.max_concurrency
+        reserved = int(round(self.max_concurrency * self.conf['interactive_reserved_share']))
+        return max(1, self.max_concurrency - reserved)
+
+    def _set_worker(self, docker_id):
+        self.docker_id = docker_id
+        worker_path = os.path.join(self.main_dir, self.workers_dir,
+                                   self.scope, self.function_name, docker_id)
+        self.worker_channel = os.path.join(worker_path, 'channel', 'pipe')
+
+    def _acquire_slot(self, docker_id):
+        """
+        Reserves an invocation slot in the worker. The score of each worker
+        in the registry is the number of invocations in flight.
+
+        :param docker_id: docker where the worker runs
+        :returns: whether the slot was acquired
+        """
+        active = self.redis.zadd(self.worker_key, {docker_id: 1}, xx=True, incr=True)
+        if active is None:
+            # The worker was removed from the registry meanwhile
+            return False
+        if self.concurrency_limit > 0 and active > self.concurrency_limit:
+            self.redis.zadd(self.worker_key, {docker_id: -1}, xx=True, incr=True)
+            return False
+
+        self._set_worker(docker_id)
+        self.slot_acquired = True
+        if not self._is_alive():
+            self.remove()
+            return False
+        return True
+
+    def _is_alive(self):
+        """
+        Pings the worker before sending it an invocation. Answers are
+        cached for a while, so busy workers are not pinged each time.
+        """
+        if not self.conf['worker_ping']:
+            return True
+        now = time.time()
+        if now - _live_workers.get(self.worker_channel, 0) < self.conf['worker_ping_ttl']:
+            return True
+        if ping_worker(self.worker_channel, self.conf['worker_ping_timeout']):
+            _live_workers[self.worker_channel] = now
+            return True
+        return False
+
+    def remove(self):
+        """
+        Removes a dead worker from the registry, so no more invocations are
+        sent to it.
+        """
+        self.logger.warning("Worker - Worker of "+self.function_obj+" in "+self.docker_id +
+                            " does not answer, removing it")
+        _live_workers.pop(self.worker_channel, None)
+        self.slot_acquired = False
+        self.redis.zrem(self.worker_key, self.docker_id)
 
     def _get_available_worker(self):
-        # docker_id = self.redis.zrange(self.worker_key, 0, 0)
         self.logger.info("Worker - Getting available worker")
-        workers = self.redis.zrange(self.worker_key, 0, -1)
-
-        if workers:
-            docker_id = random.sample(workers, 1)[0].decode()
-            if docker_id:
-                docker_id = docker_id
-                worker_path = os.path.join(self.main_dir, self.workers_dir,
-                                           self.scope, self.function_name, docker_id)
-                self.worker_channel = os.path.join(worker_path, 'channel', 'pipe')
-                self.logger.info("Worker - There is an available worker for "+self.function_obj+" in "+docker_id)
-                return True
-        else:
+        workers = self.redis.zrange(self.worker_key, 0, -1, withscores=True)
+
+        if not workers:
             self.logger.info("Worker - There are no available workers for "+self.function_obj)
             return False
 
+        # Workers are sorted by active invocations, so idle ones go first
+        for docker_id, active in workers:
+            if self.concurrency_limit > 0 and active >= self.concurrency_limit:
+                break
+            if self._acquire_slot(docker_id.decode()):
+                self.logger.info("Worker - There is an available worker for "+self.function_obj+" in "+self.docker_id)
+                return True
+
+        self.logger.info("Worker - All the workers for "+self.function_obj+" are at max concurrency")
+        return False
+
+    def _wait_for_available_worker(self):
+        """
+        Waits for a free invocation slot. Queued invocations are published
+        so that the autoscaler can grow the number of workers.
+        """
+        self.logger.info("Worker - Queuing " + self.priority + " invocation for " +
+                         self.function_obj)
+        self.redis.hincrby(QUEUED_INVOCATIONS_KEY, self.worker_key, 1)
+        if self.priority == INTERACTIVE:
+            self.redis.hincrby(QUEUED_INTERACTIVE_INVOCATIONS_KEY, self.worker_key, 1)
+        try:
+            deadline = time.time() + self.function.get_timeout()
+            if self.deadline is not None:
+                deadline = min(deadline, self.deadline)
+            interval = SLOT_POLL_INTERVAL
+            while time.time() < deadline:
+                # Backoff with jitter, so queued invocations do not poll redis together
+                eventlet.sleep(min(random.uniform(interval / 2, interval),
+                                   max(0, deadline - time.time())))
+                interval = min(interval * 2, SLOT_POLL_MAX_INTERVAL)
+                if self.priority == BATCH and \
+                   int(self.redis.hget(QUEUED_INTERACTIVE_INVOCATIONS_KEY, self.worker_key) or 0):
+                    # Queued interactive invocations take the free slots first
+                    continue
+                if self._get_available_worker():
+                    return
+        finally:
+            self.redis.hincrby(QUEUED_INVOCATIONS_KEY, self.worker_key, -1)
+            if self.priority == INTERACTIVE:
+                self.redis.hincrby(QUEUED_INTERACTIVE_INVOCATIONS_KEY, self.worker_key, -1)
+
+        msg = "Worker - No available workers for "+self.function_obj
+        self.logger.error(msg)
+        raise HTTPServiceUnavailable(msg + '\n')
+
     def _get_available_docker(self):
         self.logger.info("Worker - Getting available docker from pool")
 
@@ -110,6 +301,7 @@ class Worker:
         md = dict()
         md['function'] = self.function.get_obj_name()
         md['main_class'] = self.function.get_main_class()
+        md['max_concurrency'] = str(self.max_concurrency)
         self.fdmd.append(md)
 
         dtg = Datagram()
@@ -119,10 +311,22 @@ class Worker:
 
         # Send datagram to function worker
         self.logger.info("Worker - Pipe: " + self.worker_channel)
-        rc = Bus.send(self.worker_channel, dtg)
+        rc = GreenBus.send(self.worker_channel, dtg)
         if (rc < 0):
             raise Exception("Failed to send execute command")
         self.function.close_log()
+        _live_workers[self.worker_channel] = time.time()
+
+    def release(self):
+        """
+        Frees the invocation slot acquired in the worker
+        """
+        if self.slot_acquired:
+            self.slot_acquired = False
+            self.redis.zadd(self.worker_key, {self.docker_id: -1}, xx=True, incr=True)
+
+    def get_status(self):
+        return get_worker_status(self.worker_channel)
 
     def get_channel(self):
         return self.worker_channel
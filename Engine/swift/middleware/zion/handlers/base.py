@@ -1,7 +1,11 @@
 from zion.gateways import DockerGateway
-from zion.common.utils import DataFdIter
+from zion.common.utils import DataFdIter, TeeInput, get_deadline
+from zion.common.materialize import FUNCTION_OUTPUT_HEADER
 
-from swift.common.swob import Response
+from swift.common.swob import Response, HTTPUnprocessableEntity
+from hashlib import md5
+from io import BytesIO
+import eventlet
 import os
 import time
 
@@ -48,14 +52,23 @@ class BaseHandler(object):
         self.logger = logger
         self.redis = redis
         self.method = self.req.method
+        self.response = None
+        self.docker_gateway = None
+        self.function_resp = None
+        self.output_hash_callback = None  # Receives the ETag of streamed outputs
+        self.input_range = None  # (offset, length) of the object read by the function
         self.execution_server = conf["execution_server"]
         self.functions_container = conf.get('functions_container')
         self.available_set_headers = ['X-Function-Onput',
+                                      'X-Function-Onput-Async',
+                                      'X-Function-Onput-Observe',
                                       'X-Function-Onget',
                                       'X-Function-Onget-Before',
                                       'X-Function-Onget-Manifest',
                                       'X-Function-Ondelete']
         self.available_unset_headers = ['X-Function-Onput-Delete',
+                                        'X-Function-Onput-Async-Delete',
+                                        'X-Function-Onput-Observe-Delete',
                                         'X-Function-Onget-Delete',
                                         'X-Function-Onget-Before-Delete',
                                         'X-Function-Onget-Manifest-Delete',
@@ -63,7 +76,7 @@ class BaseHandler(object):
                                         'X-Function-Delete']
         self.function_methods = ['GET', 'PUT', 'DELETE']
         self.get_keys = ['onget', 'onget-before', 'onget-manifest']
-        self.put_keys = ['onput']
+        self.put_keys = ['onput', 'onput-async', 'onput-observe']
         self.del_keys = ['ondelete']
         self.mandatory_function_metadata = ['Language', 'Memory',
                                             'Timeout', 'Main']
@@ -77,8 +90,13 @@ class BaseHandler(object):
         self.req.headers['X-Container'] = self.container
         self.req.headers['X-Object'] = self.obj
 
-        return DockerGateway(self.conf, self.app, self.req, self.response,
-                             self.account, self.logger, self.redis)
+        if self.docker_gateway is None:
+            self.docker_gateway = DockerGateway(self.conf, self.app, self.req, self.response,
+                                                self.account, self.logger, self.redis)
+        else:
+            self.docker_gateway.response = self.response
+
+        return self.docker_gateway
 
     def _extract_vaco(self):
         """
@@ -230,8 +248,17 @@ class BaseHandler(object):
         """
         if f_data['command'] == 'DW':
             # Data Write from function
-            new_fd = f_data['fd']  # Data from function fd
-            self.req.environ['wsgi.input'] = DataFdIter(new_fd)
+            if 'data' in f_data:
+                # Small output returned inline
+                self.req.environ['wsgi.input'] = BytesIO(f_data['data'])
+                self.req.headers['Content-Length'] = str(len(f_data['data']))
+                self.req.headers.pop('Transfer-Encoding', None)
+                self.req.headers.pop('Etag', None)
+            else:
+                new_fd = f_data['fd']  # Data from function fd
+                self.req.environ['wsgi.input'] = DataFdIter(new_fd, f_data.get('close_callback'),
+                                                         self.conf['output_chunk_size'],
+                                                         deadline=get_deadline(self.req.headers))
             if 'request_headers' in f_data:
                 self.req.headers.update(f_data['request_headers'])
             if 'object_metadata' in f_data:
@@ -268,19 +295,32 @@ class BaseHandler(object):
         """
         if f_data['command'] == 'DW':
             # Data Write from function
-            new_fd = f_data['fd']
-            self.response.app_iter = DataFdIter(new_fd)
             if 'object_metadata' in f_data:
                 self.response.headers.update(f_data['object_metadata'])
             if 'response_headers' in f_data:
                 self.response.headers.update(f_data['response_headers'])
-
-            if 'Content-Length' in self.response.headers:
-                self.response.headers.pop('Content-Length')
-            if 'Transfer-Encoding' in self.response.headers:
-                self.response.headers.pop('Transfer-Encoding')
-            if 'Etag' in self.response.headers:
-                self.response.headers['Etag'] = ''
+            self.response.headers[FUNCTION_OUTPUT_HEADER] = 'True'
+
+            if 'data' in f_data:
+                # Small output returned inline: length and etag are known
+                self.response.body = f_data['data']
+                self.response.headers.pop('Transfer-Encoding', None)
+                self.response.headers['Etag'] = md5(f_data['data']).hexdigest()
+            else:
+                new_fd = f_data['fd']
+                self.response.app_iter = DataFdIter(new_fd, f_data.get('close_callback'),
+                                                    self.conf['output_chunk_size'],
+                                                    hash_callback=self.output_hash_callback,
+                                                    hash_name=self.conf['output_etag_hash'],
+                                                    deadline=get_deadline(self.req.headers))
+                if 'content_length' in f_data:
+                    self.response.content_length = f_data['content_length']
+                elif 'Content-Length' in self.response.headers:
+                    self.response.headers.pop('Content-Length')
+                if 'Transfer-Encoding' in self.response.headers:
+                    self.response.headers.pop('Transfer-Encoding')
+                if 'Etag' in self.response.headers:
+                    self.response.headers['Etag'] = ''
 
         elif f_data['command'] == 'RC':
             # Request Continue: normal req. execution
@@ -316,6 +356,46 @@ class BaseHandler(object):
         else:
             return self.req.get_response(self.app)
 
+    def apply_function_onput_observe(self, function_info):
+        """
+        Stores the object while an observer function reads a copy of it,
+        so the PUT takes as long as the slowest of them. The object is
+        committed unless the function returns an error: it is also committed
+        if the function fails to run.
+        """
+        self.logger.info('There is an observer function to execute: ' +
+                         str(function_info))
+        tee = TeeInput(self.req.environ['wsgi.input'])
+        self.req.environ['wsgi.input'] = tee
+        docker_gateway = self._setup_docker_gateway()
+
+        def observe():
+            try:
+                return docker_gateway.execute_function(function_info, tee.function_stream())
+            except Exception:
+                self.logger.exception('Observer function failed, storing the object')
+                return None
+
+        function_thread = eventlet.spawn(observe)
+        function_thread.link(tee.stop)
+        tee.verdict = lambda: (function_thread.wait() or {}).get('command') != 'RE'
+
+        response = self.req.get_response(self.app)
+        f_data = function_thread.wait()
+        if not f_data:
+            return response
+        if 'fd' in f_data:
+            # Observers cannot change the object: the output is discarded
+            DataFdIter(f_data['fd'], f_data.get('close_callback')).close()
+
+        if f_data['command'] == 'RE':
+            return HTTPUnprocessableEntity(body=f_data['message'] + '\n',
+                                           request=self.req)
+        if 'response_headers' in f_data:
+            response.headers.update(f_data['response_headers'])
+
+        return response
+
     def apply_function_onget(self, functions_data):
         """
         Call gateway module to get result of function execution
@@ -326,7 +406,9 @@ class BaseHandler(object):
             self.logger.info('There are functions to execute: ' +
                              str(functions_data))
             docker_gateway = self._setup_docker_gateway()
-            function_resp = docker_gateway.execute_function(function_info)
+            function_resp = docker_gateway.execute_function(function_info,
+                                                            input_range=self.input_range)
+            self.function_resp = function_resp
             self._process_function_response_onget(function_resp)
 
         if 'Content-Length' not in self.response.headers:
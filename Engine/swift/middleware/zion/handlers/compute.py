@@ -1,8 +1,21 @@
 from zion.handlers import BaseHandler
 from zion.handlers.base import NotFunctionRequest
+from zion.common.cache import get_output_cache, make_cache_key, CacheTeeIter
+from zion.common.fanout import join_flight
+from zion.common.utils import SpoolFileIter, DataFdIter, get_deadline, wrap_app_iter, \
+    HTTPGatewayTimeout
+from zion.common.placement import StatsIter, record_function_stats
+from zion.common.materialize import FUNCTION_OUTPUT_HEADER
+from swift.common.swob import HTTPNotModified, HTTPNoContent, HTTPUnprocessableEntity, Response
 from swift.common.utils import public
+import ast
+import os
 import time
 
+# Redis keys of the ETags of function outputs, by output key
+OUTPUT_ETAG_KEY = 'output_etag:'
+
+
 class ComputeHandler(BaseHandler):
 
     def __init__(self, request, conf, app, logger, redis):
@@ -13,13 +26,17 @@ class ComputeHandler(BaseHandler):
         return self.req.split_path(3, 4, rest_with_last=True)
 
     def _get_functions(self):
-        return eval(self.req.headers.pop('functions_data'))
+        return ast.literal_eval(self.req.headers.pop('functions_data'))
 
     def is_valid_request(self):
         return 'functions_data' in self.req.headers
 
     def handle_request(self):
         if hasattr(self, self.method) and self.is_valid_request():
+            deadline = get_deadline(self.req.headers)
+            if deadline is not None and deadline <= time.time():
+                # The client already gave up: do not read the object
+                raise HTTPGatewayTimeout('Deadline expired before running the function\n')
             try:
                 handler = getattr(self, self.method)
                 getattr(handler, 'publicly_accessible')
@@ -29,24 +46,352 @@ class ComputeHandler(BaseHandler):
         else:
             raise NotFunctionRequest()
 
+    def _get_output_key(self, functions_data):
+        """
+        Returns the key of the output of the onget function, if the
+        function and the request allow to reuse it.
+        """
+        if not (self.conf['output_cache'] or self.conf['single_flight'] or
+                self.conf['output_etags']) or \
+           self.is_range_request or \
+           self.response.status_int != 200 or 'onget' not in functions_data:
+            return None
+        object_etag = self.response.headers.get('Etag')
+        if not object_etag:
+            return None
+
+        function_info = functions_data['onget']
+        f_name = list(function_info.keys())[0]
+        function = self._setup_docker_gateway().get_function(f_name)
+        if not function.is_cacheable():
+            return None
+
+        return make_cache_key(object_etag, function.get_etag(), f_name,
+                              function_info[f_name])
+
+    def _track_function_stats(self, functions_data, input_length, start_time):
+        """
+        Measures the execution, so the proxy can choose where to run
+        the function.
+        """
+        if not self.function_resp or self.function_resp['command'] not in ('DW', 'RC') or \
+           input_length is None:
+            return
+        f_name = list(functions_data['onget'].keys())[0]
+
+        def record(output_length, seconds):
+            record_function_stats(self.redis, self.conf, self.account, f_name,
+                                  input_length, output_length, seconds)
+
+        if self.response.app_iter is None:
+            record(self.response.content_length or 0, time.time() - start_time)
+        else:
+            wrap_app_iter(self.response, StatsIter(self.response.app_iter, start_time, record))
+
+    def _get_output_etag(self, output_key):
+        etag = self.redis.get(OUTPUT_ETAG_KEY + output_key)
+        return etag.decode() if etag else None
+
+    def _set_output_etag(self, output_key, etag):
+        self.redis.set(OUTPUT_ETAG_KEY + output_key, etag, ex=self.conf['output_etag_ttl'])
+
+    def _is_not_modified(self, etag):
+        return etag is not None and self.req.if_none_match is not None and \
+            etag in self.req.if_none_match
+
+    def _record_output_etag(self, output_key, etag):
+        """
+        Keeps the ETag of outputs read before responding, and sends the
+        ETag of streamed outputs if it is known from a previous request.
+        """
+        f_data = self.function_resp
+        if not f_data or f_data['command'] != 'DW':
+            return
+        if self.response.headers.get('Etag'):
+            # Inline and spooled outputs
+            self._set_output_etag(output_key, self.response.headers['Etag'])
+        elif etag:
+            self.response.headers['Etag'] = etag
+
+    def _serve_from_output_cache(self, cache_key):
+        cached = get_output_cache(self.conf, self.logger).get(cache_key)
+        if not cached:
+            return False
+
+        self.logger.info('Serving function output from cache')
+        headers, app_iter, length = cached
+        if hasattr(self.response.app_iter, 'close'):
+            self.response.app_iter.close()
+        self.response.headers.pop('Transfer-Encoding', None)
+        self.response.headers.update(headers)
+        self.response.headers[FUNCTION_OUTPUT_HEADER] = 'True'
+        self.response.app_iter = app_iter
+        self.response.content_length = length
+
+        return True
+
+    def _serve_from_flight(self, flight):
+        self.logger.info('Waiting for a concurrent invocation of the same function')
+        if not flight.wait():
+            return False
+        app_iter = flight.subscribe()
+        if app_iter is None:
+            return False
+
+        self.logger.info('Serving shared function output')
+        if hasattr(self.response.app_iter, 'close'):
+            self.response.app_iter.close()
+        self.response.status = flight.status
+        self.response.app_iter = app_iter
+        # After the app_iter, which resets the Content-Length
+        self.response.headers.clear()
+        self.response.headers.update(flight.headers)
+
+        return True
+
+    def _fill_output_cache(self, cache_key):
+        f_data = self.function_resp
+        if not f_data or f_data['command'] != 'DW':
+            return
+
+        headers = dict(f_data.get('object_metadata', {}))
+        headers.update(f_data.get('response_headers', {}))
+        cache = get_output_cache(self.conf, self.logger)
+        if 'data' in f_data:
+            cache.put(cache_key, headers, f_data['data'])
+        elif 'content_length' in f_data:
+            wrap_app_iter(self.response, CacheTeeIter(self.response.app_iter,
+                                                      cache.writer(cache_key, headers),
+                                                      f_data['content_length']))
+        else:
+            # A streamed output that ends early cannot be told from a complete one
+            self.logger.info('Output cache - Output length not declared, not caching')
+
+    def _is_spooled_function(self, functions_data):
+        if 'onget' not in functions_data:
+            return False
+        f_name = list(functions_data['onget'].keys())[0]
+        return self._setup_docker_gateway().get_function(f_name).is_spooled()
+
+    def _spool_function_output(self):
+        """
+        Buffers the function output on disk, so its length and ETag can be
+        sent to the client and byte ranges of it can be served.
+
+        :returns: whether the whole output was spooled
+        """
+        f_data = self.function_resp
+        if not f_data or f_data['command'] != 'DW' or 'fd' not in f_data:
+            return False
+
+        spool_dir = os.path.join(self.conf['main_dir'], self.conf['spool_dir'])
+        if not os.path.exists(spool_dir):
+            os.makedirs(spool_dir)
+        spool = SpoolFileIter(self.response.app_iter, spool_dir,
+                              self.conf['spool_max_size'], self.conf['output_chunk_size'])
+        # The rest of larger outputs is still read from the function
+        wrap_app_iter(self.response, spool)
+        if not spool.complete:
+            self.logger.info('Function output too large to be spooled')
+            return False
+
+        self.response.content_length = spool.length
+        self.response.headers['Etag'] = spool.get_etag()
+        return True
+
+    def _is_single_range_on_disk_file(self):
+        """
+        On object nodes, single ranges are read by the worker from the fd of
+        the disk file, instead of being streamed through a pipe.
+        """
+        return self.execution_server == 'object' and self.req.range is not None and \
+            len(self.req.range.ranges) == 1
+
+    def _apply_function_onget_range(self, functions_data):
+        """
+        Runs the function over a byte range of the object, from the full
+        response of the object server.
+        """
+        reader = self.response.app_iter
+        total = self.response.content_length
+        ranges = None
+        if self.response.status_int == 200 and total is not None and \
+           hasattr(reader, 'app_iter_range'):
+            ranges = self.req.range.ranges_for_length(total)
+        if not ranges:
+            # Unsatisfiable range or unexpected response: let Swift handle it
+            if hasattr(reader, 'close'):
+                reader.close()
+            self.response = self.req.get_response(self.app)
+            self.apply_function_onget(functions_data)
+            return
+
+        start, stop = ranges[0]
+        if hasattr(reader, '_fp'):
+            self.input_range = (start, stop - start)
+        else:
+            # The reader must stay open for its range iterator
+            wrap_app_iter(self.response, reader.app_iter_range(start, stop))
+        self.response.status = 206
+        self.response.content_length = stop - start
+        self.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, total)
+
+        self.apply_function_onget(functions_data)
+        if self.input_range and self.function_resp and self.function_resp['command'] == 'RC':
+            # The object is returned as is: only the range is sent
+            wrap_app_iter(self.response, reader.app_iter_range(start, stop))
+            self.response.content_length = stop - start
+
     @public
     def GET(self):
         """
         GET handler on Compute node
         """
         functions_data = self._get_functions()
+        spool = self._is_spooled_function(functions_data)
+        range_header = None
+        if self.is_range_request and (spool or self._is_single_range_on_disk_file()):
+            # Swift returns the whole object: the range is applied here
+            range_header = self.req.headers.pop('Range')
         self.response = self.req.get_response(self.app)
         # self.response = Response(body="Test", headers=self.req.headers)
         t0 = time.time()
-        self.apply_function_onget(functions_data)
+        if range_header:
+            self.req.headers['Range'] = range_header
+            if spool:
+                # The range applies to the output of the function
+                self.apply_function_onget(functions_data)
+                if self._spool_function_output():
+                    self.response.conditional_response = True
+            else:
+                self._apply_function_onget_range(functions_data)
+            return self.response
+
+        output_key = self._get_output_key(functions_data)
+        etag = None
+        if output_key and self.conf['output_etags']:
+            etag = self._get_output_etag(output_key)
+            if self._is_not_modified(etag):
+                self.logger.info('Function output not modified')
+                if hasattr(self.response.app_iter, 'close'):
+                    self.response.app_iter.close()
+                self.response = HTTPNotModified(request=self.req, headers={'Etag': etag})
+                return self.response
+            # The ETag of streamed outputs is known once they are read
+            self.output_hash_callback = lambda digest: self._set_output_etag(output_key, digest)
+
+        if output_key and self.conf['output_cache'] and \
+           self._serve_from_output_cache(output_key):
+            return self.response
+
+        flight = None
+        if output_key and self.conf['single_flight']:
+            # Concurrent requests of the same output share one invocation
+            flight, leader = join_flight(output_key)
+            if not leader:
+                if self._serve_from_flight(flight):
+                    return self.response
+                flight = None
+
+        input_length = self.response.content_length
+        try:
+            t1 = time.time()
+            self.apply_function_onget(functions_data)
+            if self.conf['adaptive_placement']:
+                self._track_function_stats(functions_data, input_length, t1)
+            if spool:
+                self._spool_function_output()
+            if output_key and self.conf['output_etags']:
+                self._record_output_etag(output_key, etag)
+        except Exception:
+            if flight:
+                flight.fail()
+            raise
+        if output_key and self.conf['output_cache']:
+            self._fill_output_cache(output_key)
+        if flight:
+            flight.publish(self.response, self.conf['single_flight_buffer_size'])
         self.logger.info('------> TOAL ZION TIME: %0.6fs' % ((time.time()-t0)))
 
         return self.response
 
+    def execute_onput_job(self, function_info, etag):
+        """
+        Runs an asynchronous onput function over the stored object. The
+        function runs for its side effects, so its output is discarded.
+
+        :param function_info: function information
+        :param etag: ETag of the object the job was queued for
+        :returns: status of the execution: 412 if the object was overwritten
+        """
+        self.response = self.req.get_response(self.app)
+        if not self.response.is_success:
+            return self.response.status_int
+        if etag and self.response.headers.get('Etag', '').strip('"') != etag.strip('"'):
+            # The job of the new object will run the function
+            if hasattr(self.response.app_iter, 'close'):
+                self.response.app_iter.close()
+            return 412
+
+        self.apply_function_onget({'onget': function_info})
+        if self.function_resp['command'] == 'RE':
+            raise ValueError(self.function_resp['message'])
+        if self.response.app_iter is not None:
+            for _ in self.response.app_iter:
+                pass
+            if hasattr(self.response.app_iter, 'close'):
+                self.response.app_iter.close()
+
+        return self.response.status_int
+
+    @public
+    def POST(self):
+        """
+        POST handler on Compute node: runs a reduce function over the
+        request body, the outputs of a container map. The output is spooled
+        while the body is read, so both streams progress at once.
+        """
+        if self.execution_server != 'compute':
+            raise NotFunctionRequest()
+        functions_data = self._get_functions()
+        function_info = functions_data.get('onreduce')
+        if not function_info:
+            return self.req.get_response(self.app)
+        chunk_size = self.conf['output_chunk_size']
+        wsgi_input = self.req.environ['wsgi.input']
+        docker_gateway = self._setup_docker_gateway()
+        f_data = docker_gateway.execute_function(
+            function_info, iter(lambda: wsgi_input.read(chunk_size), b''))
+        self.function_resp = f_data
+
+        if f_data['command'] == 'RE':
+            return HTTPUnprocessableEntity(body=f_data['message'] + '\n',
+                                           request=self.req)
+        if f_data['command'] != 'DW':
+            return HTTPNoContent(request=self.req)
+
+        headers = f_data.get('response_headers', {})
+        if 'data' in f_data:
+            return Response(body=f_data['data'], headers=headers, request=self.req)
+
+        spool_dir = os.path.join(self.conf['main_dir'], self.conf['spool_dir'])
+        if not os.path.exists(spool_dir):
+            os.makedirs(spool_dir)
+        output = DataFdIter(f_data['fd'], f_data.get('close_callback'), chunk_size,
+                            deadline=get_deadline(self.req.headers))
+        spool = SpoolFileIter(output, spool_dir, self.conf['spool_max_size'], chunk_size)
+        response = Response(app_iter=spool, headers=headers, request=self.req)
+        if spool.complete:
+            response.content_length = spool.length
+
+        return response
+
     @public
     def PUT(self):
         """
         PUT handler on Compute node
         """
         functions_data = self._get_functions()
+        if 'onput-observe' in functions_data and 'onput' not in functions_data:
+            return self.apply_function_onput_observe(functions_data['onput-observe'])
         return self.apply_function_onput(functions_data)
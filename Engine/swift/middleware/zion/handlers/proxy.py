@@ -1,12 +1,42 @@
 from zion.handlers import BaseHandler
 from zion.handlers.base import NotFunctionRequest
-from swift.common.swob import HTTPNotFound, HTTPUnauthorized, Response
+from zion.common.jobs import enqueue_onput_job
+from zion.common.admission import get_admission_control, AdmissionSlot
+from zion.common.health import get_compute_node_pool
+from zion.common.utils import DEADLINE_HEADER, get_deadline, time_left, PRIORITY_HEADER, \
+    PRIORITY_CLASSES, INTERACTIVE, BATCH, wrap_app_iter
+from zion.common.placement import choose_placement, COMPUTE_NODE
+from zion.common.materialize import MATERIALIZE_HEADER, SOURCE_ETAG_SYSMETA, \
+    FUNCTION_ETAG_SYSMETA, FUNCTION_OUTPUT_HEADER, MaterializeTeeIter, \
+    get_materialized_object_name
+from swift.common.swob import HTTPNotFound, HTTPUnauthorized, HTTPBadRequest, Response
 from swift.common.utils import public
 from swift.common.wsgi import make_subrequest
 from swiftclient.client import http_connection, quote
+from distutils.util import strtobool
+from collections import deque
+from eventlet.queue import Queue, Empty
+from urllib.parse import urlencode
+import eventlet
+import json
 import os
 import pickle
-import random
+import time
+
+# Redis hash, per account, of the ETags of materialized functions
+MATERIALIZED_FUNCTIONS_KEY = 'materialized_functions:'
+
+# Redis hash of the default priority class of the requests, by account
+PRIORITY_CLASSES_KEY = 'priority_classes'
+
+# Container map requests
+MAP_HEADER = 'X-Function-Map'
+REDUCE_HEADER = 'X-Function-Reduce'
+LISTING_LIMIT = 10000
+
+# Responses of overloaded or unreachable compute nodes
+UNHEALTHY_STATUSES = (502, 504)
+BACKPRESSURE_STATUSES = (429, 503)
 
 
 class ProxyHandler(BaseHandler):
@@ -75,6 +105,18 @@ class ProxyHandler(BaseHandler):
         else:
             raise NotFunctionRequest()
 
+    def _make_subrequest(self, method, path, headers=None):
+        new_env = dict(self.req.environ)
+        if 'HTTP_TRANSFER_ENCODING' in new_env.keys():
+            del new_env['HTTP_TRANSFER_ENCODING']
+
+        sub_headers = {'X-Auth-Token': self.req.headers.get('X-Auth-Token')}
+        if headers:
+            sub_headers.update(headers)
+
+        return make_subrequest(new_env, method, path, headers=sub_headers,
+                               swift_source='function_middleware')
+
     def _verify_access(self, cont, obj):
         """
         Verifies access to the specified object in swift
@@ -89,16 +131,7 @@ class ProxyHandler(BaseHandler):
             path = os.path.join('/', self.api_version, self.account, cont)
         self.logger.debug('Verifying access to %s' % path)
 
-        new_env = dict(self.req.environ)
-        if 'HTTP_TRANSFER_ENCODING' in new_env.keys():
-            del new_env['HTTP_TRANSFER_ENCODING']
-
-        auth_token = self.req.headers.get('X-Auth-Token')
-        sub_req = make_subrequest(new_env, 'HEAD', path,
-                                  headers={'X-Auth-Token': auth_token},
-                                  swift_source='function_middleware')
-
-        resp = sub_req.get_response(self.app)
+        resp = self._make_subrequest('HEAD', path).get_response(self.app)
 
         if not resp.is_success:
             if resp.status_int == 401:
@@ -198,62 +231,496 @@ class ProxyHandler(BaseHandler):
         if 'X-Domain-Id' in self.req.headers:
             self.req.headers.pop('X-Domain-Id')
 
-    def _prepare_connection(self):
+    def _prepare_connection(self, obj=None, compute_node=None):
         self._set_headers()
-        compute_nodes = self.compute_nodes.split(',')
-        compute_node = random.sample(compute_nodes, 1)
+        if compute_node is None:
+            compute_node = get_compute_node_pool(self.conf, self.logger).choose()
 
         self.logger.info('Forwarding request to a compute node: ' +
-                         compute_node[0])
-        url = os.path.join('http://', compute_node[0], self.api_version, self.account)
+                         compute_node)
+        url = os.path.join('http://', compute_node, self.api_version, self.account)
 
-        parsed, conn = http_connection(url)
-        path = '%s/%s/%s' % (parsed.path, quote(self.container), quote(self.obj))
+        timeout = time_left(get_deadline(self.req.headers), self.conf['compute_node_timeout'])
+        parsed, conn = http_connection(url, timeout=timeout)
+        obj = self.obj if obj is None else obj
+        path = '%s/%s' % (parsed.path, quote(self.container))
+        if obj:
+            path += '/' + quote(obj)
 
         return conn, path
 
-    def _handle_get_through_compute_node(self):
-        conn, path = self._prepare_connection()
-        conn.request(self.method, path, None, self.req.headers)
-        resp = conn.getresponse()
+    def _get_materialized_function_etag(self, f_name):
+        """
+        Returns the ETag of a function whose outputs are materialized, or
+        None if the function is not materialized. Function metadata is
+        kept in redis until the function object is updated.
+        """
+        key = MATERIALIZED_FUNCTIONS_KEY + self.account
+        f_etag = self.redis.hget(key, f_name)
+        if f_etag is None:
+            path = os.path.join('/', self.api_version, self.account,
+                                self.functions_container, f_name)
+            resp = self._make_subrequest('HEAD', path).get_response(self.app)
+            if not resp.is_success:
+                return None
+            f_etag = ''
+            if strtobool(resp.headers.get(MATERIALIZE_HEADER, 'False')):
+                f_etag = resp.headers['Etag']
+            self.redis.hset(key, f_name, f_etag)
+        elif isinstance(f_etag, bytes):
+            f_etag = f_etag.decode()
+
+        return f_etag or None
+
+    def _get_materialized_view(self, functions_data):
+        """
+        Returns the path of the derived object that stores the output of
+        the onget function, and the ETag of the function, if the function
+        output is materialized.
+        """
+        if not self.conf['materialized_views'] or self.is_range_request or \
+           'onget' not in functions_data:
+            return None, None
+
+        function_info = functions_data['onget']
+        f_name = list(function_info.keys())[0]
+        f_etag = self._get_materialized_function_etag(f_name)
+        if not f_etag:
+            return None, None
+
+        obj_name = get_materialized_object_name(self.container, self.obj, f_name,
+                                                function_info[f_name])
+        path = os.path.join('/', self.api_version, self.account,
+                            self.conf['materialized_container'], obj_name)
 
+        return path, f_etag
+
+    def _get_materialized_response(self, path, f_etag, source_etag):
+        """
+        Gets the derived object, if it was built from the current versions
+        of the source object and the function.
+        """
+        resp = self._make_subrequest('GET', path).get_response(self.app)
+        if resp.status_int == 200 and \
+           resp.headers.get(SOURCE_ETAG_SYSMETA) == source_etag and \
+           resp.headers.get(FUNCTION_ETAG_SYSMETA) == f_etag:
+            self.logger.info('Serving materialized function output: ' + path)
+            return resp
+
+        if hasattr(resp.app_iter, 'close'):
+            resp.app_iter.close()
+        return None
+
+    def _materialize(self, response, path, f_etag, source_etag):
+        """
+        Stores the function output as a derived object while it is sent
+        to the client.
+        """
+        headers = {SOURCE_ETAG_SYSMETA: source_etag,
+                   FUNCTION_ETAG_SYSMETA: f_etag,
+                   'Transfer-Encoding': 'chunked'}
+        for header in response.headers:
+            if header == 'Content-Type' or header.startswith('X-Object-Meta-'):
+                headers[header] = response.headers[header]
+
+        container_path = os.path.join('/', self.api_version, self.account,
+                                      self.conf['materialized_container'])
+        container_req = self._make_subrequest('PUT', container_path)
+        put_req = self._make_subrequest('PUT', path, headers)
+
+        wrap_app_iter(response, MaterializeTeeIter(response.app_iter, container_req, put_req,
+                                                   self.app, self.conf['materialize_max_object_size'],
+                                                   self.logger))
+
+    def _set_deadline(self):
+        """
+        Sets the absolute deadline of the request, honored by the compute
+        nodes and the workers. Clients can only shorten it.
+        """
+        deadline = get_deadline(self.req.headers)
+        if self.conf['request_deadline']:
+            proxy_deadline = time.time() + self.conf['request_deadline']
+            deadline = min(deadline or proxy_deadline, proxy_deadline)
+        if deadline is not None:
+            self.req.headers[DEADLINE_HEADER] = '%.3f' % deadline
+
+    def _set_priority(self, default=INTERACTIVE):
+        """
+        Sets the priority class of the request: the requested one, or the
+        default of the account.
+        """
+        priority = self.req.headers.get(PRIORITY_HEADER)
+        if priority not in PRIORITY_CLASSES:
+            account_priority = self.redis.hget(PRIORITY_CLASSES_KEY, self.account)
+            account_priority = account_priority.decode() if account_priority else None
+            priority = account_priority if account_priority in PRIORITY_CLASSES else default
+        self.req.headers[PRIORITY_HEADER] = priority
+
+    def _admit(self, functions_data):
+        """
+        Sheds the invocations over the rate and concurrency limits, before
+        any connection to the compute nodes is opened.
+
+        :returns: AdmissionSlot, to release once the invocation ends
+        """
+        if not self.conf['load_shedding']:
+            return AdmissionSlot()
+        f_names = [list(function_info.keys())[0] for function_info in functions_data.values()]
+        return get_admission_control(self.conf, self.logger).admit(self.redis, self.account,
+                                                                   f_names)
+
+    def _run_on_compute_node(self, functions_data):
+        """
+        Decides whether the onget function runs on a compute node or on
+        the object node that stores the object.
+        """
+        if not self.conf['adaptive_placement'] or 'onget' not in functions_data:
+            return self.disaggregated_compute
+
+        f_name = list(functions_data['onget'].keys())[0]
+        placement = choose_placement(self.redis, self.conf, self.account, f_name)
+        self.logger.info('Function %s placed on %s node' % (f_name, placement))
+        return placement == COMPUTE_NODE
+
+    def _make_compute_node_response(self, conn, resp):
         def reader():
             try:
                 return resp.read(65535)
             except (ValueError, IOError) as e:
                 raise ValueError(str(e))
 
-        data_source = iter(reader, '')
+        data_source = iter(reader, b'')
 
         response = Response(app_iter=data_source,
+                            status=resp.status,
                             headers=conn.resp.headers,
                             request=self.req)
 
         return response
 
+    def _request_compute_node(self, method, obj, data, headers, compute_node=None):
+        """
+        Sends a request to a compute node, and tracks the health of the
+        node from its outcome.
+
+        :returns: (connection, response) tuple
+        """
+        pool = get_compute_node_pool(self.conf, self.logger)
+        if compute_node is None:
+            compute_node = pool.choose()
+        conn, path = self._prepare_connection(obj, compute_node)
+        start_time = time.time()
+        try:
+            if method == 'PUT':
+                resp = conn.putrequest(path, data, headers)
+            else:
+                conn.request(method, path, data, headers)
+                resp = conn.getresponse()
+        except Exception:
+            pool.failure(compute_node)
+            raise
+
+        if resp.status in BACKPRESSURE_STATUSES:
+            # Full nodes are healthy: they are only avoided for a while
+            pool.saturated(compute_node)
+        elif resp.status in UNHEALTHY_STATUSES:
+            pool.failure(compute_node)
+        elif method == 'GET':
+            pool.success(compute_node, time.time() - start_time)
+        else:
+            # The response time includes the upload of the body
+            pool.success(compute_node)
+
+        return conn, resp
+
+    def _hedged_request(self, obj, headers, delay):
+        """
+        Sends a GET to a compute node, and a second one to another node
+        if there is no response after the delay. The first response wins,
+        and the other request is cancelled.
+        """
+        pool = get_compute_node_pool(self.conf, self.logger)
+        results = Queue()
+
+        def attempt(compute_node):
+            try:
+                results.put(self._request_compute_node('GET', obj, None, headers,
+                                                       compute_node))
+            except Exception as e:
+                results.put(e)
+
+        compute_node = pool.choose()
+        threads = [eventlet.spawn(attempt, compute_node)]
+        try:
+            result = results.get(timeout=delay)
+        except Empty:
+            hedge_node = pool.choose(exclude=[compute_node])
+            if hedge_node:
+                self.logger.info('Hedging request to compute node ' + hedge_node)
+                threads.append(eventlet.spawn(attempt, hedge_node))
+            result = results.get()
+
+        pending = len(threads) - 1
+        while isinstance(result, Exception) and pending:
+            result = results.get()
+            pending -= 1
+
+        # Cancel the slower request
+        for thread in threads:
+            thread.kill()
+        while not results.empty():
+            loser = results.get()
+            if not isinstance(loser, Exception):
+                loser[1].close()
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _handle_get_through_compute_node(self, obj=None, headers=None):
+        headers = headers or self.req.headers
+        delay = None
+        if self.conf['hedged_requests']:
+            delay = get_compute_node_pool(self.conf, self.logger).hedge_delay()
+        if delay is None:
+            conn, resp = self._request_compute_node(self.method, obj, None, headers)
+        else:
+            conn, resp = self._hedged_request(obj, headers, delay)
+
+        return self._make_compute_node_response(conn, resp)
+
+    def _handle_get_locally(self, functions_data):
+        """
+        Runs the onget function in this proxy, through the docker gateway,
+        as the compute nodes do.
+
+        :returns: response, or None if the share of local functions is
+                  exhausted
+        """
+        slot = get_compute_node_pool(self.conf, self.logger).spill_over()
+        if slot is None:
+            return None
+
+        self.logger.info('Compute nodes saturated, running function in the proxy')
+        self.req.headers.pop('functions_data', None)
+        try:
+            self.response = self.req.get_response(self.app)
+            if self.response.is_success:
+                self.apply_function_onget(functions_data)
+        except Exception:
+            slot.release()
+            raise
+        slot.attach(self.response)
+
+        return self.response
+
+    def _handle_get_with_spill_over(self, functions_data):
+        """
+        Forwards the request to a compute node, or runs the function in
+        this proxy if the compute nodes have no free capacity.
+        """
+        spill_over = self.conf['spill_over'] and not self.is_range_request
+        pool = get_compute_node_pool(self.conf, self.logger)
+        if spill_over and pool.is_saturated():
+            response = self._handle_get_locally(functions_data)
+            if response is not None:
+                return response
+
+        response = self._handle_get_through_compute_node()
+        if spill_over and response.status_int in BACKPRESSURE_STATUSES:
+            # Nothing was read from the object yet
+            local_response = self._handle_get_locally(functions_data)
+            if local_response is not None:
+                if hasattr(response.app_iter, 'close'):
+                    response.app_iter.close()
+                return local_response
+
+        return response
+
+    def _handle_reduce_through_compute_node(self, data_source, headers):
+        conn, resp = self._request_compute_node('POST', '', data_source, headers)
+
+        return self._make_compute_node_response(conn, resp)
+
     def _handle_put_through_compute_node(self):
-        conn, path = self._prepare_connection()
         data_source = self.req.environ['wsgi.input']
-        resp = conn.putrequest(path, data_source, self.req.headers)
+        conn, resp = self._request_compute_node('PUT', None, data_source, self.req.headers)
         response = Response(headers=resp.headers, request=self.req)
 
         return response
 
+    @property
+    def is_map_request(self):
+        return not self.obj and MAP_HEADER in self.req.headers
+
+    def _get_map_function_info(self, header):
+        function = self.req.headers[header]
+        self._verify_access(self.functions_container, function)
+        try:
+            params = json.loads(self.req.headers.get(header + '-Parameters', '{}'))
+        except ValueError:
+            raise HTTPBadRequest('Invalid ' + header + '-Parameters header\n')
+
+        return {function: params}
+
+    def _get_map_headers(self, functions_data):
+        headers = dict(self.req.headers)
+        for header in (MAP_HEADER, MAP_HEADER + '-Parameters', REDUCE_HEADER,
+                       REDUCE_HEADER + '-Parameters', 'Range', 'Content-Length',
+                       'Transfer-Encoding'):
+            headers.pop(header, None)
+        headers['functions_data'] = str(functions_data)
+
+        return headers
+
+    def _list_objects(self):
+        """
+        Lists the objects of the container, with the prefix of the request
+        """
+        path = os.path.join('/', self.api_version, self.account, self.container)
+        prefix = self.req.params.get('prefix', '')
+        marker = ''
+        while True:
+            query = urlencode({'format': 'json', 'prefix': prefix,
+                               'marker': marker, 'limit': LISTING_LIMIT})
+            resp = self._make_subrequest('GET', path + '?' + query).get_response(self.app)
+            if not resp.is_success:
+                self.logger.error('Unable to list %s: %s' % (path, resp.status))
+                return
+            listing = json.loads(resp.body) if resp.body else []
+            for entry in listing:
+                if 'name' in entry:
+                    yield entry['name']
+            if len(listing) < LISTING_LIMIT:
+                return
+            marker = listing[-1]['name']
+
+    def _invoke_map_function(self, obj, functions_data):
+        headers = self._get_map_headers(functions_data)
+        if self._run_on_compute_node(functions_data):
+            return self._handle_get_through_compute_node(obj, headers)
+
+        path = os.path.join('/', self.api_version, self.account, self.container, obj)
+        return self._make_subrequest('GET', path, headers).get_response(self.app)
+
+    def _close_map_invocation(self, invocation):
+        if not invocation.dead:
+            invocation.kill()
+            return
+        try:
+            response = invocation.wait()
+        except Exception:
+            return
+        if hasattr(response.app_iter, 'close'):
+            response.app_iter.close()
+
+    def _get_map_output(self, obj, invocation):
+        try:
+            response = invocation.wait()
+        except Exception:
+            self.logger.exception('Map function failed on ' + obj)
+            return
+        if not response.is_success:
+            self.logger.error('Map function failed on %s: %s' % (obj, response.status))
+            if hasattr(response.app_iter, 'close'):
+                response.app_iter.close()
+            return
+        for chunk in response.app_iter:
+            yield chunk
+
+    def _map_outputs(self, functions_data):
+        """
+        Runs the map function over the objects with bounded concurrency,
+        across the compute nodes, and yields the outputs in listing order.
+        """
+        pending = deque()
+        try:
+            for obj in self._list_objects():
+                pending.append((obj, eventlet.spawn(self._invoke_map_function, obj,
+                                                    functions_data)))
+                if len(pending) >= self.conf['map_concurrency']:
+                    for chunk in self._get_map_output(*pending.popleft()):
+                        yield chunk
+            while pending:
+                for chunk in self._get_map_output(*pending.popleft()):
+                    yield chunk
+        finally:
+            # The client went away: do not leave invocations behind
+            for _, invocation in pending:
+                self._close_map_invocation(invocation)
+
+    def _map_container(self):
+        """
+        Applies a function to the objects of a container, and returns the
+        concatenated outputs, or the output of a reduce function over them.
+        """
+        self._verify_access(self.container, None)
+        map_data = {'onget': self._get_map_function_info(MAP_HEADER)}
+        reduce_data = None
+        if REDUCE_HEADER in self.req.headers:
+            reduce_data = {'onreduce': self._get_map_function_info(REDUCE_HEADER)}
+        self._set_headers()
+        self.logger.info('Map request over %s: %s' % (self.container, str(map_data)))
+
+        slot = self._admit(dict(map_data, **(reduce_data or {})))
+        self._set_deadline()
+        self._set_priority(BATCH)
+        try:
+            outputs = self._map_outputs(map_data)
+            if reduce_data:
+                response = self._handle_reduce_through_compute_node(
+                    outputs, self._get_map_headers(reduce_data))
+            else:
+                response = Response(app_iter=outputs, content_type='application/octet-stream',
+                                    request=self.req)
+        except Exception:
+            slot.release()
+            raise
+        slot.attach(response)
+
+        return response
+
     @public
     def GET(self):
         """
         GET handler on Proxy
         """
+        if self.is_map_request:
+            return self._map_container()
+
         functions_data = self._get_functions()
 
         if functions_data:
             self.logger.info('There are functions to execute: ' +
                              str(functions_data))
+            view_path, f_etag = self._get_materialized_view(functions_data)
+            source_etag = None
+            if view_path:
+                source = self._make_subrequest('HEAD', self.req.path).get_response(self.app)
+                source_etag = source.headers.get('Etag') if source.is_success else None
+            if source_etag:
+                response = self._get_materialized_response(view_path, f_etag, source_etag)
+                if response:
+                    return response
+
+            slot = self._admit(functions_data)
+            self._set_deadline()
+            self._set_priority()
             self.req.headers['functions_data'] = functions_data
-            if self.disaggregated_compute:
-                response = self._handle_get_through_compute_node()
-            else:
-                response = self.req.get_response(self.app)
+            try:
+                if self._run_on_compute_node(functions_data):
+                    response = self._handle_get_with_spill_over(functions_data)
+                else:
+                    response = self.req.get_response(self.app)
+            except Exception:
+                slot.release()
+                raise
+            slot.attach(response)
+
+            # Errors of the function are not materialized
+            function_output = response.headers.pop(FUNCTION_OUTPUT_HEADER, None)
+            if source_etag and function_output and response.status_int == 200:
+                self._materialize(response, view_path, f_etag, source_etag)
         else:
             response = self.req.get_response(self.app)
 
@@ -276,14 +743,38 @@ class ProxyHandler(BaseHandler):
                        str(self.mandatory_function_metadata) + '\n')
                 raise HTTPUnauthorized(msg)
 
+            response = self.req.get_response(self.app)
+            if response.is_success:
+                # A new version of the function invalidates its materialized views
+                self.redis.hdel(MATERIALIZED_FUNCTIONS_KEY + self.account, self.obj)
+            return response
+
         elif functions_data:
             self.logger.info('There are functions to execute: ' +
                              str(functions_data))
-            self.req.headers['functions_data'] = functions_data
-            if self.disaggregated_compute:
-                return self._handle_put_through_compute_node()
+            # Asynchronous functions run once the object is stored
+            async_function = functions_data.pop('onput-async', None)
+            if not functions_data:
+                response = self.req.get_response(self.app)
             else:
-                return self.req.get_response(self.app)
+                slot = self._admit(functions_data)
+                self._set_deadline()
+                self._set_priority()
+                self.req.headers['functions_data'] = functions_data
+                try:
+                    if self.disaggregated_compute:
+                        response = self._handle_put_through_compute_node()
+                    else:
+                        response = self.req.get_response(self.app)
+                except Exception:
+                    slot.release()
+                    raise
+                slot.attach(response)
+
+            if async_function and response.is_success:
+                enqueue_onput_job(self.redis, self.req.path, async_function,
+                                  response.headers.get('Etag'))
+            return response
 
         return self.req.get_response(self.app)
 
@@ -0,0 +1,96 @@
+"""
+Compares the ctypes Bus (bus.so) with the pure Python GreenBus by sending
+execution datagrams with 3 file descriptors to a local bus, as the
+gateway does on every invocation. Besides the send rate, it reports the
+longest time the eventlet hub was unable to run other green threads.
+
+Usage: python bus_benchmark.py [iterations]
+"""
+import eventlet
+import eventlet.hubs
+eventlet.monkey_patch()
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../Engine/swift/middleware'))
+
+from zion.gateways.docker.datagram import Datagram, SBUS_CMD_EXECUTE  # noqa
+from zion.gateways.docker.green_bus import GreenBus  # noqa
+
+
+def make_datagram(fds):
+    dtg = Datagram()
+    dtg.set_files(fds)
+    dtg.set_metadata([{'type': 'OUTPUT_FD'}, {'type': 'COMMAND_FD'},
+                      {'type': 'INPUT_FD', 'data': '{"object_metadata": {}}'}])
+    dtg.set_command(SBUS_CMD_EXECUTE)
+    return dtg
+
+
+def start_receiver(bus_path, iterations):
+    sock = GreenBus.create(bus_path)
+    pid = os.fork()
+    if pid == 0:
+        # The epoll hub cannot be shared with the parent process
+        eventlet.hubs.use_hub()
+        for _ in range(iterations):
+            dtg = GreenBus.receive(sock)
+            for fd in dtg.get_files():
+                os.close(fd)
+        os._exit(0)
+    sock.close()
+    return pid
+
+
+def ticker(state):
+    last = time.time()
+    while state['running']:
+        eventlet.sleep(0)
+        now = time.time()
+        state['max_stall'] = max(state['max_stall'], now - last)
+        last = now
+
+
+def run(name, send, iterations):
+    bus_path = os.path.join(tempfile.mkdtemp(), 'bus')
+    pid = start_receiver(bus_path, iterations)
+    r, w = os.pipe()
+    dtg = make_datagram([r, w, r])
+    state = {'running': True, 'max_stall': 0}
+    tick = eventlet.spawn(ticker, state)
+
+    start = time.time()
+    for _ in range(iterations):
+        if send(bus_path, dtg) < 0:
+            raise Exception(name + ': send failed')
+        eventlet.sleep(0)
+    os.waitpid(pid, 0)
+    elapsed = time.time() - start
+
+    state['running'] = False
+    tick.wait()
+    os.close(r)
+    os.close(w)
+    os.unlink(bus_path)
+    print('%-10s %8d msgs  %8.3f s  %8.1f us/msg  max hub stall %8.3f ms' %
+          (name, iterations, elapsed, elapsed * 1e6 / iterations,
+           state['max_stall'] * 1e3))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    run('GreenBus', GreenBus.send, iterations)
+    try:
+        from zion.gateways.docker.bus import Bus
+        run('ctypes', Bus.send, iterations)
+    except OSError as e:
+        print('ctypes     skipped: ' + str(e))
+
+
+if __name__ == '__main__':
+    main()